@@ -3,11 +3,17 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import BaseHTTPServer
+import SocketServer
 import argparse
+import gzip
+import hashlib
 import sys
 import re
+import threading
 import urlparse
+from cStringIO import StringIO
 from telemetry.revision_cache import RevisionCache
+from telemetry.util.lru import LRUCache
 import telemetry.histogram_tools as histogram_tools
 import simplejson as json
 # For compatibility with python 2.6
@@ -23,6 +29,7 @@ startup_histogram_re = re.compile("SQLITE|HTTP|SPDY|CACHE|DNS")
 
 HIST_PATH = "/histograms"
 HIST_BUCKET_PATH = "/histogram_buckets"
+HIST_BATCH_PATH = "/histogram_buckets_batch"
 REVISION_FIELD = "revision"
 HIST_VALID_PREFIX = HIST_PATH + "?" + REVISION_FIELD + "="
 HIST_BUCKET_VALID_PREFIX = HIST_BUCKET_PATH + "?" + REVISION_FIELD + "="
@@ -31,9 +38,64 @@ MINIMAL_JSON = True
 # + 1 to skip the "?"
 HIST_QUERY_OFFSET = len(HIST_PATH) + 1
 HIST_BUCKET_QUERY_OFFSET = len(HIST_BUCKET_PATH) + 1
+HIST_BATCH_QUERY_OFFSET = len(HIST_BATCH_PATH) + 1
+# Most revisions accepted in one batch request.
+MAX_BATCH_REVISIONS = 1000
+
+# Remember this many rendered responses.
+RESPONSE_CACHE_SIZE = 1000
+
+
+class Response:
+    """A rendered response body and its ETags. The gzipped form is only made
+    once a client asks for it, and has an ETag of its own."""
+    def __init__(self, body):
+        self.body = body
+        digest = hashlib.sha1(body).hexdigest()
+        self.etag = '"%s"' % digest
+        self.gzip_etag = '"%s-gz"' % digest
+        self._gzipped = None
+
+    def gzipped(self):
+        if self._gzipped is None:
+            # Two threads may compress the same body at once, but they
+            # produce the same thing.
+            buf = StringIO()
+            gz = gzip.GzipFile(fileobj=buf, mode="wb")
+            gz.write(self.body)
+            gz.close()
+            self._gzipped = buf.getvalue()
+        return self._gzipped
+
+
+class ResponseCache:
+    """Rendered responses (and bucket tables), keyed by the Histograms.json
+    content hash and the kind of response. Shared by all request handler
+    threads."""
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+        self._responses = LRUCache(max_entries=max_entries)
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        with self._lock:
+            response = self._responses.get(key)
+        if response is None:
+            # Rendering happens outside the lock. Two threads may render the
+            # same response at once, but they produce the same thing.
+            response = render()
+            with self._lock:
+                self._responses.put(key, response)
+        return response
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Handles each request in a new thread"""
+    daemon_threads = True
 
 
 class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    response_cache = ResponseCache()
+
     def send_HEAD(self, code, message=None):
         self.send_response(code)
         self.send_header("Content-type", "text/plain")
@@ -41,6 +103,46 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if message is not None:
             self.wfile.write(message)
 
+    def accepts_gzip(self):
+        accepted = self.headers.get("Accept-Encoding", "")
+        return "gzip" in [e.split(";")[0].strip() for e in accepted.split(",")]
+
+    # Whether If-None-Match lists the given ETag. Weak tags (W/"...") match
+    # their strong form, as If-None-Match uses the weak comparison.
+    def etag_matches(self, etag):
+        for tag in self.headers.get("If-None-Match", "").split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == "*" or tag == etag:
+                return True
+        return False
+
+    # Send a rendered response, honouring If-None-Match and Accept-Encoding.
+    def send_cached(self, response):
+        use_gzip = self.accepts_gzip()
+        if use_gzip:
+            etag = response.gzip_etag
+        else:
+            etag = response.etag
+        if self.etag_matches(etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+        body = response.body
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain")
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        if use_gzip:
+            body = response.gzipped()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_HEAD(self):
         self.send_HEAD(200)
 
@@ -49,10 +151,28 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.send_histograms(self.path[HIST_QUERY_OFFSET:], False)
         elif self.path.startswith(HIST_BUCKET_VALID_PREFIX):
             self.send_histograms(self.path[HIST_BUCKET_QUERY_OFFSET:], True)
+        elif self.path == HIST_BATCH_PATH or self.path.startswith(HIST_BATCH_PATH + "?"):
+            params = urlparse.parse_qs(self.path[HIST_BATCH_QUERY_OFFSET:])
+            self.send_batch(params.get(REVISION_FIELD, []))
         else:
             return self.send_HEAD(404, "Not Found")
 
-    def ranges_from_histograms(self, histograms):
+    # The batch endpoint also takes a JSON list of revision URLs as the
+    # request body, for batches too big for a query string.
+    def do_POST(self):
+        if self.path != HIST_BATCH_PATH:
+            return self.send_HEAD(404, "Not Found")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            revisions = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.send_HEAD(400, "Must provide a JSON list of revision URLs")
+        if not isinstance(revisions, list):
+            return self.send_HEAD(400, "Must provide a JSON list of revision URLs")
+        self.send_batch(revisions)
+
+    # The JSON object with the bucket ranges of every histogram.
+    def render_ranges(self, histograms):
         all_histograms = OrderedDict()
         parsed = json.loads(histograms, object_pairs_hook=OrderedDict)
         for (name, definition) in parsed.iteritems():
@@ -86,11 +206,88 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             if startup_histogram_re.search(name) is not None:
                 all_histograms.update({ "STARTUP_" + name: parameters })
         if MINIMAL_JSON:
-            result = json.dumps({'histograms': all_histograms}, separators=(',', ':'))
+            result = json.dumps(all_histograms, separators=(',', ':'))
         else:
-            result = json.dumps({'histograms': all_histograms})
+            result = json.dumps(all_histograms)
         return result
 
+    # Returns (response cache key, raw Histograms.json) for a revision URL.
+    # Revisions with the same Histograms.json share their responses.
+    def get_histograms(self, revision):
+        histograms = self.revision_cache.get_histograms_for_revision(revision, False)
+        if histograms is None:
+            return None, None
+        key = self.revision_cache.get_content_hash(revision)
+        if key is None:
+            key = revision
+        return key, histograms
+
+    def get_ranges(self, key, histograms):
+        return self.response_cache.get((key, "ranges"),
+                lambda: self.render_ranges(histograms))
+
+    def send_batch(self, revisions):
+        """Send the bucket ranges for many revisions at once, as
+            {"histograms": {id: ranges, ...},
+             "revisions": {revision URL: id, ...},
+             "errors": {revision URL: message, ...}}
+        where the ranges are in the same form as from /histogram_buckets, and
+        revisions with identical Histograms.json share the same id."""
+        if len(revisions) < 1:
+            return self.send_HEAD(400, "Must provide a revision URL")
+        if len(revisions) > MAX_BATCH_REVISIONS:
+            return self.send_HEAD(400, "Too many revisions, the limit is %d" % MAX_BATCH_REVISIONS)
+        ids = OrderedDict()
+        errors = OrderedDict()
+        # Look the revisions up in sorted order and without duplicates, so
+        # that the same set of revisions always gives the same response.
+        valid = set()
+        for revision in revisions:
+            if isinstance(revision, basestring):
+                valid.add(revision)
+            else:
+                errors[unicode(revision)] = "Invalid revision URL"
+        histograms_by_key = dict()
+        for revision in sorted(valid):
+            try:
+                key, histograms = self.get_histograms(revision)
+            except ValueError:
+                errors[revision] = "Invalid revision URL"
+                continue
+            except Exception, e:
+                errors[revision] = "Error: " + str(e)
+                continue
+            if histograms is None:
+                errors[revision] = "Not Found"
+                continue
+            ids[revision] = key
+            histograms_by_key[key] = histograms
+        errors = OrderedDict(sorted(errors.iteritems()))
+        # Only the range tables are cached (once per distinct Histograms.json).
+        # Caching whole batches would keep another copy of them for every
+        # combination of revisions.
+        self.send_cached(self.render_batch(ids, errors, histograms_by_key))
+
+    def render_batch(self, ids, errors, histograms_by_key):
+        ranges = OrderedDict()
+        for key in ids.itervalues():
+            if key not in ranges:
+                ranges[key] = self.get_ranges(key, histograms_by_key[key])
+
+        if MINIMAL_JSON:
+            separators = (',', ':')
+        else:
+            separators = (', ', ': ')
+        # The ranges are already rendered, so put the response together
+        # as a string instead of parsing them again.
+        parts = ['{"histograms":{']
+        parts.append(separators[0].join('%s%s%s' % (json.dumps(key),
+                separators[1], table) for key, table in ranges.iteritems()))
+        parts.append('}%s"revisions":%s%s"errors":%s}' % (separators[0],
+                json.dumps(ids, separators=separators), separators[0],
+                json.dumps(errors, separators=separators)))
+        return Response("".join(parts))
+
     def send_histograms(self, query_string, get_buckets):
         params = urlparse.parse_qs(query_string)
         if REVISION_FIELD not in params:
@@ -102,7 +299,7 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         revision = revisions[0]
         # Get revision from cache
         try:
-            histograms = self.revision_cache.get_histograms_for_revision(revision, False)
+            key, histograms = self.get_histograms(revision)
         except Exception, e:
             return self.send_HEAD(500, e.message)
 
@@ -111,24 +308,31 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         if get_buckets:
             # Convert to bucket ranges
-            ranges = self.ranges_from_histograms(histograms)
-            # Write out bucket ranges
-            self.send_HEAD(200)
-            self.wfile.write(ranges)
+            if MINIMAL_JSON:
+                wrapper = '{"histograms":%s}'
+            else:
+                wrapper = '{"histograms": %s}'
+            response = self.response_cache.get((key, "buckets"),
+                    lambda: Response(wrapper % self.get_ranges(key, histograms)))
         else:
             # Send raw Histograms.json
-            self.send_HEAD(200)
-            self.wfile.write(histograms)
+            response = self.response_cache.get((key, "raw"),
+                    lambda: Response(histograms))
+        self.send_cached(response)
 
 def main():
     parser = argparse.ArgumentParser(description='Start a caching histogram server', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-p", "--port", help="Server Port", type=int, default=9898)
     parser.add_argument("-c", "--cache-dir", help="Directory to cache Histograms.json revisions", default="./histogram_cache")
+    parser.add_argument("-t", "--threaded", help="Handle requests concurrently", action="store_true")
     args = parser.parse_args()
     # This is ugly, but seems the easiest way to get this into MyHandler
     MyHandler.revision_cache = RevisionCache(args.cache_dir, "hg.mozilla.org")
 
-    httpd = BaseHTTPServer.HTTPServer(("localhost", args.port), MyHandler)
+    if args.threaded:
+        httpd = ThreadedHTTPServer(("localhost", args.port), MyHandler)
+    else:
+        httpd = BaseHTTPServer.HTTPServer(("localhost", args.port), MyHandler)
     try:
         print "Server running on port", args.port
         httpd.serve_forever()
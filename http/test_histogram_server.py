@@ -0,0 +1,190 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import httplib
+import os
+import shutil
+import threading
+import unittest
+from cStringIO import StringIO
+from http.histogram_server import MyHandler, ResponseCache, ThreadedHTTPServer
+from telemetry.revision_cache import RevisionCache
+import simplejson as json
+
+# python -m unittest http.test_histogram_server
+
+REVISION = "https://hg.mozilla.org/mozilla-central/rev/000000000001"
+
+class TestHandler(MyHandler):
+    def log_message(self, format, *args):
+        pass
+
+class TestHistogramServer(unittest.TestCase):
+    def setUp(self):
+        test_dir = self.get_test_dir()
+        assert not os.path.exists(test_dir)
+        self.histograms = '{"FOO": {"kind": "flag"}, "BAR": {"kind": "exponential", "high": "3000", "n_buckets": 10}}'
+        self.write_cached("mozilla-central", "000000000001", self.histograms)
+        TestHandler.revision_cache = RevisionCache(test_dir, None)
+        TestHandler.response_cache = ResponseCache()
+        self.server = ThreadedHTTPServer(("localhost", 0), TestHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.get_test_dir())
+
+    def get_test_dir(self):
+        return "/tmp/test_histogram_server"
+
+    def write_cached(self, repo, rev, contents):
+        filename = os.path.join(self.get_test_dir(), repo, rev, "Histograms.json")
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, "w") as fout:
+            fout.write(contents)
+
+    # Returns the response and its body.
+    def request(self, path, headers={}, method="GET", body=None):
+        conn = httplib.HTTPConnection("localhost", self.server.server_address[1])
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            return response, response.read()
+        finally:
+            conn.close()
+
+    def test_histograms(self):
+        response, body = self.request("/histograms?revision=" + REVISION)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self.histograms)
+        etag = response.getheader("ETag")
+        self.assertTrue(etag)
+        self.assertEqual(response.getheader("Vary"), "Accept-Encoding")
+        self.assertIs(response.getheader("Content-Encoding"), None)
+        self.assertEqual(response.getheader("Content-Length"), str(len(body)))
+
+        response, body = self.request("/histograms?revision=" + REVISION,
+                {"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.getheader("ETag"), etag)
+        self.assertEqual(body, "")
+
+        # A stale ETag gets the whole response.
+        response, body = self.request("/histograms?revision=" + REVISION,
+                {"If-None-Match": '"stale"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self.histograms)
+
+        response, body = self.request("/histograms?revision=https://hg.mozilla.org/mozilla-central/rev/000000000002")
+        self.assertEqual(response.status, 404)
+
+    def test_gzip(self):
+        response, plain = self.request("/histogram_buckets?revision=" + REVISION)
+        self.assertEqual(response.status, 200)
+        ranges = json.loads(plain)["histograms"]
+        self.assertEqual(sorted(ranges), ["BAR", "FOO"])
+        self.assertEqual(ranges["FOO"]["bucket_count"], 3)
+
+        response, body = self.request("/histogram_buckets?revision=" + REVISION,
+                {"Accept-Encoding": "deflate, gzip;q=0.5"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(response.getheader("Vary"), "Accept-Encoding")
+        self.assertEqual(response.getheader("Content-Length"), str(len(body)))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(), plain)
+
+        # Each encoding has its own ETag, and only matches itself.
+        gzip_etag = response.getheader("ETag")
+        response, plain = self.request("/histogram_buckets?revision=" + REVISION)
+        etag = response.getheader("ETag")
+        self.assertNotEqual(etag, gzip_etag)
+        response, body = self.request("/histogram_buckets?revision=" + REVISION,
+                {"If-None-Match": gzip_etag})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, plain)
+        response, body = self.request("/histogram_buckets?revision=" + REVISION,
+                {"If-None-Match": gzip_etag, "Accept-Encoding": "gzip"})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.getheader("ETag"), gzip_etag)
+
+        # If-None-Match can list several tags, weak or not.
+        response, body = self.request("/histogram_buckets?revision=" + REVISION,
+                {"If-None-Match": '"stale", W/%s' % etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.getheader("ETag"), etag)
+        response, body = self.request("/histogram_buckets?revision=" + REVISION,
+                {"If-None-Match": '"stale", W/"other"'})
+        self.assertEqual(response.status, 200)
+
+    def test_batch_get(self):
+        self.write_cached("mozilla-central", "000000000002", self.histograms)
+        other = "https://hg.mozilla.org/mozilla-central/rev/000000000002"
+        missing = "https://hg.mozilla.org/mozilla-central/rev/000000000003"
+        response, body = self.request("/histogram_buckets_batch?revision=%s&revision=%s"
+                "&revision=%s&revision=%s&revision=bogus" % (REVISION, other, REVISION, missing))
+        self.assertEqual(response.status, 200)
+        batch = json.loads(body)
+        # Both revisions have the same Histograms.json, so share one table.
+        self.assertEqual(batch["revisions"][REVISION], batch["revisions"][other])
+        self.assertEqual(len(batch["histograms"]), 1)
+        self.assertEqual(sorted(batch["histograms"].values()[0]), ["BAR", "FOO"])
+        self.assertEqual(batch["errors"], {missing: "Not Found", "bogus": "Invalid revision URL"})
+
+        # The same revisions in another order get the same response.
+        response, reordered = self.request("/histogram_buckets_batch?revision=bogus"
+                "&revision=%s&revision=%s&revision=%s" % (missing, other, REVISION))
+        self.assertEqual(reordered, body)
+        # Only the one range table is cached, not the batches made from it.
+        self.assertEqual(len(TestHandler.response_cache._responses), 1)
+
+        response, body = self.request("/histogram_buckets_batch")
+        self.assertEqual(response.status, 400)
+        response, body = self.request("/histogram_buckets_batch?foo=bar")
+        self.assertEqual(response.status, 400)
+
+    def test_batch_post(self):
+        revisions = [REVISION, "bogus", 5]
+        response, body = self.request("/histogram_buckets_batch", method="POST",
+                body=json.dumps(revisions))
+        self.assertEqual(response.status, 200)
+        batch = json.loads(body)
+        self.assertEqual(batch["revisions"].keys(), [REVISION])
+        self.assertEqual(batch["errors"], {"bogus": "Invalid revision URL", "5": "Invalid revision URL"})
+
+        # Gzip and ETags work for batches too.
+        response, gzipped = self.request("/histogram_buckets_batch", {"Accept-Encoding": "gzip"},
+                method="POST", body=json.dumps(revisions))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(gzipped)).read(), body)
+        response, empty = self.request("/histogram_buckets_batch",
+                {"If-None-Match": response.getheader("ETag"), "Accept-Encoding": "gzip"},
+                method="POST", body=json.dumps(revisions))
+        self.assertEqual(response.status, 304)
+
+        for invalid in ("not json", '{"revision": "x"}', "[]"):
+            response, body = self.request("/histogram_buckets_batch", method="POST", body=invalid)
+            self.assertEqual(response.status, 400)
+        response, body = self.request("/histogram_buckets_batch", method="POST",
+                body=json.dumps([REVISION] * 1001))
+        self.assertEqual(response.status, 400)
+
+    def test_threaded(self):
+        results = []
+        def fetch():
+            results.append(self.request("/histogram_buckets?revision=" + REVISION))
+        threads = [threading.Thread(target=fetch) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 10)
+        self.assertEqual(set(response.status for response, body in results), set([200]))
+        self.assertEqual(len(set(body for response, body in results)), 1)
+        self.assertEqual(len(set(response.getheader("ETag") for response, body in results)), 1)
+
+if __name__ == "__main__":
+    unittest.main()
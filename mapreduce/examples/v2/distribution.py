@@ -3,6 +3,7 @@ Get the distribution of one or more boolean/enumerated measurements.
 """
 
 import json
+from telemetry.util.histograms import expand_histogram
 
 keys = [
     ("NEWTAB_PAGE_SHOWN", 2), # boolean
@@ -18,7 +19,8 @@ def map(k, d, v, cx):
     counts = ()
     for key, buckets in keys:
         if key in histograms:
-            val = histograms[key]
+            # Pings converted with --sparse-histograms need expanding first.
+            val = expand_histogram(histograms[key])
             if len(val) != buckets + extra_histogram_entries:
                 raise ValueError("Unexpected length for key %s: %s" % (key, val))
             counts += tuple(val[0:buckets])
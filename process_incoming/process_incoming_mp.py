@@ -22,6 +22,7 @@ from boto.exception import S3ResponseError
 import telemetry.util.timer as timer
 import telemetry.util.files as fileutil
 from telemetry.convert import Converter, BadPayloadError
+from telemetry.histogram_store import LayoutStore
 from telemetry.revision_cache import RevisionCache
 from telemetry.persist import StorageLayout
 import boto.sqs
@@ -209,12 +210,11 @@ class ReadRawStep(PipeStep):
                         serialized_data = data
                         data_version = 1
                     else:
-                        parsed_data, parsed_dims = self.converter.convert_json(data, dims[-1])
+                        serialized_data, parsed_dims = self.converter.convert_json_serialized(data, dims[-1])
                         # TODO: take this out if it's too slow
                         for i in range(len(dims)):
                             if dims[i] != parsed_dims[i]:
                                 print self.label, "Record", self.records_read, "mismatched dimension", i, dims[i], "!=", parsed_dims[i]
-                        serialized_data = self.converter.serialize(parsed_data)
                         dims = parsed_dims
                         data_version = 2
                     try:
@@ -459,6 +459,7 @@ def main():
     parser.add_argument("-m", "--max-output-size", metavar="N", help="Rotate output files after N bytes", type=int, default=500000000)
     parser.add_argument("-D", "--dry-run", help="Don't modify remote files", action="store_true")
     parser.add_argument("-C", "--skip-conversion", help="Skip validation/conversion of payloads", action="store_true")
+    parser.add_argument("--histogram-layout-store", help="Shared histogram layout store built by telemetry/histogram_store.py")
     args = parser.parse_args()
 
     if not os.path.isfile(S3FUNNEL_PATH):
@@ -476,7 +477,11 @@ def main():
     if args.skip_conversion:
         converter = None
     else:
-        converter = Converter(cache, schema)
+        # Opened before the readers are forked, so they all share its pages.
+        layout_store = None
+        if args.histogram_layout_store:
+            layout_store = LayoutStore(args.histogram_layout_store)
+        converter = Converter(cache, schema, layout_store=layout_store)
     storage = StorageLayout(schema, args.output_dir, args.max_output_size)
 
     num_cpus = multiprocessing.cpu_count()
@@ -29,9 +29,11 @@ import boto.sqs
 from boto.exception import S3ResponseError
 from boto.s3.connection import S3Connection
 
-from telemetry.convert import Converter, BadPayloadError
+from telemetry.convert import Converter, BadPayloadError, GEOIP_MODE_MMAP
+from telemetry.histogram_store import LayoutStore
 from telemetry.persist import StorageLayout
 from telemetry.revision_cache import RevisionCache
+from telemetry.revision_bundle import RevisionBundle
 from telemetry.telemetry_schema import TelemetrySchema
 from telemetry.util.compress import CompressedFile
 import telemetry.util.timer as timer
@@ -197,6 +199,12 @@ class Stats(object):
         if update_end_time:
             self.update_end_time()
 
+    # Add a group of named counters (such as cache statistics) to the
+    # overall stats as "<prefix>.<name>".
+    def increment_named(self, prefix, values):
+        for name, value in values.iteritems():
+            self.overall["{0}.{1}".format(prefix, name)] += value
+
 
 # Base class for pipline workers
 class PipeStep(object):
@@ -253,6 +261,8 @@ class PipeStep(object):
 # Read from raw input files, validate and convert data, save output to disk
 class ReadRawStep(PipeStep):
     UUID_ONLY_PATH = re.compile('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+    # Convert this many records at a time.
+    CONVERT_BATCH_SIZE = 1000
     def __init__(self, num, name, raw_files, completed_files, log_file,
             stats_file, schema, converter, storage, bad_filename):
         self.schema = schema
@@ -264,6 +274,26 @@ class ReadRawStep(PipeStep):
 
     def setup(self):
         self.expected_dim_count = len(self.schema._dimensions)
+        self.converter_stats = {}
+        # Readers each have their own output shards, if sharding is on.
+        self.storage.set_writer_id(self.num)
+
+    def finish(self):
+        # Flush any output files kept open between records.
+        self.storage.close()
+        PipeStep.finish(self)
+
+    # Report the converter's cache statistics as increments since the last
+    # report, like the rest of the per-file stats.
+    def save_converter_stats(self):
+        if self.converter is None:
+            return
+        current = self.converter.get_stats()
+        for name, values in current.iteritems():
+            previous = self.converter_stats.get(name, {})
+            self.stats.increment_named(name, dict((k, v - previous.get(k, 0))
+                    for k, v in values.iteritems()))
+        self.converter_stats = current
 
     def handle(self, raw_file):
         self.log("Reading " + raw_file)
@@ -274,140 +304,101 @@ class ReadRawStep(PipeStep):
             file_version = fileutil.detect_file_version(raw_file, simple_detection=True)
             self.log("Detected version {0} for file {1}".format(file_version,
                      raw_file))
-            for unpacked in fileutil.unpack(raw_file, file_version=file_version):
-                record_count += 1
-                common_bytes = unpacked.len_path + fileutil.RECORD_PREAMBLE_LENGTH[file_version]
-                current_bytes = common_bytes + unpacked.len_data
-                current_bytes_uncompressed = common_bytes + len(unpacked.data)
-                bytes_read += current_bytes
-                if unpacked.error:
-                    self.log("ERROR: Found corrupted data for record {0} in " \
-                             "{1} path: {2} Error: {3}".format(record_count,
-                                 raw_file, unpacked.path, unpacked.error))
-                    self.stats.increment(records_read=1,
-                            bytes_read=current_bytes,
-                            bytes_uncompressed=current_bytes_uncompressed,
-                            bad_records=1, bad_record_type="corrupted_data")
-                    continue
-                if len(unpacked.data) == 0:
-                    self.log("WARN: Found empty data for record {0} in " \
-                             "{2} path: {2}".format(record_count, raw_file,
-                                 unpacked.path))
-                    self.stats.increment(records_read=1,
-                            bytes_read=current_bytes,
-                            bytes_uncompressed=current_bytes_uncompressed,
-                            bad_records=1, bad_record_type="empty_data")
-                    continue
-
-                submission_date = ts_to_yyyymmdd(unpacked.timestamp)
-                path = fileutil.to_unicode(unpacked.path)
-
-                if unpacked.data[0] != "{":
-                    # Data looks weird, should be JSON.
-                    self.log("Warning: Found unexpected data for record {0}" \
-                             " in {1} path: {2} data:\n{3}".format(record_count,
-                                 raw_file, path, unpacked.data))
-                else:
-                    # Raw JSON, make sure we treat it as unicode.
-                    unpacked.data = fileutil.to_unicode(unpacked.data)
-
-                path_components = path.split("/")
-                if len(path_components) != self.expected_dim_count:
-                    # We're going to pop the ID off, but we'll also add the
-                    # submission date, so it evens out.
-                    bad_record_type = "invalid_path"
-                    if ReadRawStep.UUID_ONLY_PATH.match(path):
-                        bad_record_type = "uuid_only_path"
+            # Records read but not converted yet, see convert_pending.
+            pending = []
+            try:
+                for unpacked in fileutil.unpack(raw_file, file_version=file_version):
+                    record_count += 1
+                    common_bytes = unpacked.len_path + fileutil.RECORD_PREAMBLE_LENGTH[file_version]
+                    current_bytes = common_bytes + unpacked.len_data
+                    current_bytes_uncompressed = common_bytes + len(unpacked.data)
+                    bytes_read += current_bytes
+                    if unpacked.error:
+                        self.log("ERROR: Found corrupted data for record {0} in " \
+                                 "{1} path: {2} Error: {3}".format(record_count,
+                                     raw_file, unpacked.path, unpacked.error))
+                        self.stats.increment(records_read=1,
+                                bytes_read=current_bytes,
+                                bytes_uncompressed=current_bytes_uncompressed,
+                                bad_records=1, bad_record_type="corrupted_data")
+                        continue
+                    if len(unpacked.data) == 0:
+                        self.log("WARN: Found empty data for record {0} in " \
+                                 "{2} path: {2}".format(record_count, raw_file,
+                                     unpacked.path))
+                        self.stats.increment(records_read=1,
+                                bytes_read=current_bytes,
+                                bytes_uncompressed=current_bytes_uncompressed,
+                                bad_records=1, bad_record_type="empty_data")
+                        continue
+
+                    submission_date = ts_to_yyyymmdd(unpacked.timestamp)
+                    path = fileutil.to_unicode(unpacked.path)
+
+                    if unpacked.data[0] != "{":
+                        # Data looks weird, should be JSON.
+                        self.log("Warning: Found unexpected data for record {0}" \
+                                 " in {1} path: {2} data:\n{3}".format(record_count,
+                                     raw_file, path, unpacked.data))
                     else:
-                        self.log("Found an invalid path in record {0}: " \
-                             "{1}".format(record_count, path))
-                    self.stats.increment(records_read=1,
+                        # Raw JSON, make sure we treat it as unicode.
+                        unpacked.data = fileutil.to_unicode(unpacked.data)
+
+                    path_components = path.split("/")
+                    if len(path_components) != self.expected_dim_count:
+                        # We're going to pop the ID off, but we'll also add the
+                        # submission date, so it evens out.
+                        bad_record_type = "invalid_path"
+                        if ReadRawStep.UUID_ONLY_PATH.match(path):
+                            bad_record_type = "uuid_only_path"
+                        else:
+                            self.log("Found an invalid path in record {0}: " \
+                                 "{1}".format(record_count, path))
+                        self.stats.increment(records_read=1,
+                                bytes_read=current_bytes,
+                                bytes_uncompressed=current_bytes_uncompressed,
+                                bad_records=1, bad_record_type=bad_record_type)
+                        continue
+
+                    key = path_components.pop(0)
+                    info = {}
+                    info["reason"] = path_components.pop(0)
+                    info["appName"] = path_components.pop(0)
+                    info["appVersion"] = path_components.pop(0)
+                    info["appUpdateChannel"] = path_components.pop(0)
+                    info["appBuildID"] = path_components.pop(0)
+                    dims = self.schema.dimensions_from(info, submission_date)
+                    channel = self.schema.get_field(dims, "appUpdateChannel",
+                            True, True)
+
+                    self.stats.increment(channel=channel, records_read=1,
                             bytes_read=current_bytes,
-                            bytes_uncompressed=current_bytes_uncompressed,
-                            bad_records=1, bad_record_type=bad_record_type)
-                    continue
-
-                key = path_components.pop(0)
-                info = {}
-                info["reason"] = path_components.pop(0)
-                info["appName"] = path_components.pop(0)
-                info["appVersion"] = path_components.pop(0)
-                info["appUpdateChannel"] = path_components.pop(0)
-                info["appBuildID"] = path_components.pop(0)
-                dims = self.schema.dimensions_from(info, submission_date)
-                channel = self.schema.get_field(dims, "appUpdateChannel",
-                        True, True)
-
-                self.stats.increment(channel=channel, records_read=1,
-                        bytes_read=current_bytes,
-                        bytes_uncompressed=current_bytes_uncompressed)
+                            bytes_uncompressed=current_bytes_uncompressed)
 
-                try:
-                    # Convert data:
                     if self.converter is None:
-                        serialized_data = unpacked.data
                         # TODO: Converter.VERSION_UNCONVERTED
-                        data_version = 1
+                        self.write_record(key, dims, channel, unpacked.data, 1)
                     else:
-                        parsed_data, parsed_dims = self.converter.convert_json(
-                                unpacked.data, dims[-1], unpacked.ip)
-                        # TODO: take this out if it's too slow
-                        for i in range(len(dims)):
-                            if dims[i] != parsed_dims[i]:
-                                self.log("Record {0} mismatched dimension " \
-                                         "{1}: '{2}' != '{3}'".format(
-                                            record_count, i, dims[i],
-                                            parsed_dims[i]))
-                        serialized_data = self.converter.serialize(parsed_data)
-                        dims = parsed_dims
-                        # TODO: Converter.VERSION_CONVERTED
-                        data_version = 2
-                    try:
-                        # Write to persistent storage
-                        n = self.storage.write(key, serialized_data, dims,
-                                data_version)
-                        self.stats.increment(channel=channel, records_written=1,
-                            bytes_written=len(key) + len(serialized_data) + 2)
-                        # Compress rotated files as we generate them
-                        if n.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX):
-                            self.q_out.put(n)
-                    except Exception, e:
-                        self.write_bad_record(key, dims, serialized_data,
-                                str(e), "ERROR Writing to output file:",
-                                "write_failed")
-                except BadPayloadError, e:
-                    self.write_bad_record(key, dims, unpacked.data, e.msg,
-                            "Bad Payload:", "bad_payload")
-                except Exception, e:
-                    err_message = str(e)
-                    if err_message == "Missing in payload: info.revision":
-                        # We don't need to write these bad records out - we know
-                        # why they are being skipped.
-                        self.stats.increment(channel=channel, bad_records=1,
-                                bad_record_type="missing_revision")
-                    elif err_message == "Invalid revision URL: /rev/":
-                        # We do want to log these payloads, but we don't want
-                        # the full stack trace.
-                        self.write_bad_record(key, dims, unpacked.data, err_message,
-                                "Conversion Error", "missing_revision_repo")
-                    # Don't split this long string - we want to be able to find it in the code
-                    elif err_message.startswith("JSONDecodeError: Invalid control character"):
-                        self.write_bad_record(key, dims, unpacked.data, err_message,
-                                "Conversion Error", "invalid_control_char")
-                    else:
-                        # TODO: Recognize other common failure modes and handle
-                        #       them gracefully.
-                        self.write_bad_record(key, dims, unpacked.data, err_message,
-                                "Conversion Error", "conversion_error")
-                        self.log(traceback.format_exc())
-
-                if self.print_stats:
-                    this_update = now()
-                    sec = timer.delta_sec(self.last_update, this_update)
-                    if sec > 10.0:
-                        self.last_update = this_update
-                        self.log(self.stats.get_summary())
-
+                        # Convert records in batches, so the converter can group
+                        # them by revision.
+                        pending.append((record_count, key, dims, channel,
+                                unpacked.data, unpacked.ip))
+                        if len(pending) >= ReadRawStep.CONVERT_BATCH_SIZE:
+                            self.convert_pending(pending)
+
+                    if self.print_stats:
+                        this_update = now()
+                        sec = timer.delta_sec(self.last_update, this_update)
+                        if sec > 10.0:
+                            self.last_update = this_update
+                            self.log(self.stats.get_summary())
+            finally:
+                # Convert what was read even if the rest of the file is bad.
+                if pending:
+                    self.convert_pending(pending)
+
+            self.save_converter_stats()
+            self.storage.flush_expired()
             duration = timer.delta_sec(start, now())
             mb_read = bytes_read / 1024.0 / 1024.0
             # Stats for the current file:
@@ -419,6 +410,70 @@ class ReadRawStep(PipeStep):
                     raw_file, e, traceback.format_exc()))
 
 
+    # Convert a list of (record number, key, dims, channel, data, ip) records
+    # read from a raw file and write them out. Empties the list.
+    def convert_pending(self, pending):
+        results = self.converter.convert_batch([(data, dims[-1], ip)
+                for n, key, dims, channel, data, ip in pending], serialize=True)
+        for (record_count, key, dims, channel, data, ip), \
+                (serialized_data, parsed_dims, e) in zip(pending, results):
+            if e is None:
+                # TODO: take this out if it's too slow
+                for i in range(len(dims)):
+                    if dims[i] != parsed_dims[i]:
+                        self.log("Record {0} mismatched dimension " \
+                                 "{1}: '{2}' != '{3}'".format(
+                                    record_count, i, dims[i],
+                                    parsed_dims[i]))
+                # TODO: Converter.VERSION_CONVERTED
+                self.write_record(key, parsed_dims, channel, serialized_data, 2)
+            elif isinstance(e, BadPayloadError):
+                self.write_bad_record(key, dims, data, e.msg,
+                        "Bad Payload:", "bad_payload")
+            else:
+                self.write_conversion_error(key, dims, channel, data, e)
+        del pending[:]
+
+    def write_record(self, key, dims, channel, serialized_data, data_version):
+        try:
+            # Write to persistent storage
+            n = self.storage.write(key, serialized_data, dims, data_version)
+            self.stats.increment(channel=channel, records_written=1,
+                bytes_written=len(key) + len(serialized_data) + 2)
+            # Compress rotated files as we generate them (with
+            # --compress-output they are finished already)
+            if n.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX):
+                self.q_out.put(n)
+        except Exception, e:
+            self.write_bad_record(key, dims, serialized_data,
+                    str(e), "ERROR Writing to output file:",
+                    "write_failed")
+
+    def write_conversion_error(self, key, dims, channel, data, e):
+        err_message = str(e)
+        if err_message == "Missing in payload: info.revision":
+            # We don't need to write these bad records out - we know
+            # why they are being skipped.
+            self.stats.increment(channel=channel, bad_records=1,
+                    bad_record_type="missing_revision")
+        elif err_message == "Invalid revision URL: /rev/":
+            # We do want to log these payloads, but we don't want
+            # the full stack trace.
+            self.write_bad_record(key, dims, data, err_message,
+                    "Conversion Error", "missing_revision_repo")
+        # Don't split this long string - we want to be able to find it in the code
+        elif err_message.startswith("JSONDecodeError: Invalid control character"):
+            self.write_bad_record(key, dims, data, err_message,
+                    "Conversion Error", "invalid_control_char")
+        else:
+            # TODO: Recognize other common failure modes and handle
+            #       them gracefully.
+            self.write_bad_record(key, dims, data, err_message,
+                    "Conversion Error", "conversion_error")
+            # The converter has already caught the error, so there's no
+            # traceback left to log.
+            self.log("{0}: {1}".format(type(e).__name__, err_message))
+
     def write_bad_record(self, key, dims, data, error, message=None,
             bad_record_type=None):
         try:
@@ -571,10 +626,38 @@ def main():
             help="Log statistics to this file")
     parser.add_argument("--histogram-cache-path", default="./histogram_cache",
             help="Path to store a local cache of histograms")
+    parser.add_argument("--histocache-max-bytes", metavar="N", type=int,
+            default=Converter.HISTOCACHE_MAX_BYTES,
+            help="Evict compiled histogram layouts after they use about N bytes")
+    parser.add_argument("--histogram-bundle",
+            help="Read histograms missing from the cache from this bundle, built by telemetry/revision_bundle.py")
+    parser.add_argument("--histogram-layout-store",
+            help="Shared histogram layout store built by telemetry/histogram_store.py")
+    parser.add_argument("--geoip-mmap", action="store_true",
+            help="Memory-map the GeoIP database and share it between readers")
+    parser.add_argument("--converter-stats", action="store_true",
+            help="Record the time spent in each conversion stage with the rest of the stats")
+    parser.add_argument("--sparse-histograms", action="store_true",
+            help="Write converted histograms in the sparse encoding")
     parser.add_argument("-t", "--telemetry-schema", required=True,
             help="Location of the desired telemetry schema")
     parser.add_argument("-m", "--max-output-size", metavar="N", type=int,
             default=500000000, help="Rotate output files after N bytes")
+    parser.add_argument("--max-open-files", metavar="N", type=int,
+            help="Keep up to N output files open and buffered in each reader, instead of opening them for every record")
+    parser.add_argument("--output-flush-bytes", metavar="N", type=int,
+            default=StorageLayout.WRITE_BUFFER_SIZE,
+            help="With --max-open-files, write out each output file's records once N bytes are buffered")
+    parser.add_argument("--output-max-age", metavar="SEC", type=float,
+            help="With --max-open-files, write out buffered records once they are SEC seconds old")
+    parser.add_argument("--output-buffer-bytes", metavar="N", type=int,
+            help="With --max-open-files, buffer at most about N bytes of records in each reader")
+    parser.add_argument("--compress-output", action="store_true",
+            help="With --max-open-files, compress output as it is written instead of in a separate pass")
+    parser.add_argument("--max-compressed-size", metavar="N", type=int,
+            help="With --compress-output, also finish output files after N compressed bytes")
+    parser.add_argument("--shard-output", action="store_true",
+            help="Give each reader its own output files, merged once all the readers are done")
     parser.add_argument("-D", "--dry-run", action="store_true",
             help="Don't modify remote files")
     parser.add_argument("-n", "--no-clean", action="store_true",
@@ -596,9 +679,30 @@ def main():
     schema_data = open(args.telemetry_schema)
     schema = TelemetrySchema(json.load(schema_data))
     schema_data.close()
-    cache = RevisionCache(args.histogram_cache_path, "hg.mozilla.org")
-    converter = Converter(cache, schema)
-    storage = StorageLayout(schema, args.output_dir, args.max_output_size)
+    bundle = None
+    if args.histogram_bundle:
+        bundle = RevisionBundle(args.histogram_bundle)
+    cache = RevisionCache(args.histogram_cache_path, "hg.mozilla.org",
+            bundle=bundle)
+    geoip_mode = None
+    if args.geoip_mmap:
+        geoip_mode = GEOIP_MODE_MMAP
+    # Opened before the readers are forked, so they all share its pages.
+    layout_store = None
+    if args.histogram_layout_store:
+        layout_store = LayoutStore(args.histogram_layout_store)
+    converter = Converter(cache, schema,
+            histocache_max_bytes=args.histocache_max_bytes,
+            geoip_mode=geoip_mode, instrument=args.converter_stats,
+            sparse_histograms=args.sparse_histograms,
+            layout_store=layout_store)
+    storage = StorageLayout(schema, args.output_dir, args.max_output_size,
+            max_open_files=args.max_open_files,
+            flush_bytes=args.output_flush_bytes, max_age=args.output_max_age,
+            max_buffer_bytes=args.output_buffer_bytes,
+            compress=args.compress_output,
+            max_compressed_size=args.max_compressed_size,
+            sharded=args.shard_output)
     logger = Log(args.log_file, "Master")
     num_cpus = multiprocessing.cpu_count()
     conn = None
@@ -618,7 +722,8 @@ def main():
         logger.log("Removing log files in {}".format(args.output_dir))
         for root, dirs, files in os.walk(args.output_dir):
             for f in files:
-                if f.endswith(".log"):
+                if f.endswith(".log") or f.endswith(StorageLayout.PARTIAL_SUFFIX) \
+                        or f.endswith(StorageLayout.SHARD_SUFFIX):
                     full = os.path.join(root, f)
                     if args.dry_run:
                         logger.log("Would be deleting {}, except it's a " \
@@ -753,6 +858,10 @@ def main():
                     args.log_file, args.stats_file))
             wait_for(logger, raw_readers, "Raw Readers")
 
+            if args.shard_output:
+                merged = storage.merge_shards()
+                logger.log("Merged output shards into {0} files".format(len(merged)))
+
             # `find <out_dir> -type f -not -name ".compressme"`
             # Add them to completed_files
             for root, dirs, files in os.walk(args.output_dir):
@@ -6,6 +6,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import multiprocessing
 import sys
 import getopt
 try:
@@ -14,11 +15,19 @@ except ImportError:
     import json
 import urllib2
 import revision_cache
+from revision_cache import histogram_fingerprint
 from histogram_tools import Histogram, DefinitionException
+from histogram_store import StoredHistogram
 from telemetry_schema import TelemetrySchema
 import traceback
 import persist
+from telemetry.util.lru import LRUCache
+import telemetry.util.jsonscan as jsonscan
+from telemetry.util.histograms import VERSION_SPARSE, VERSION_UNIFIED_SPARSE, \
+        sparse_histogram
+from telemetry.util.fieldpaths import FieldPlan
 from infoFieldsMap import envFieldMap, adapterFieldMap, appFieldMap
+from collections import deque
 from datetime import date
 import time
 try:
@@ -27,12 +36,163 @@ try:
     geo_available = True
 except ImportError:
     geo_available = False
+try:
+    from maxminddb import MODE_MMAP as GEOIP_MODE_MMAP
+except ImportError:
+    GEOIP_MODE_MMAP = None
+
+# Marker for "not in the cache", for caches that store None values.
+NOT_CACHED = object()
+
+# The field maps from infoFieldsMap, compiled once.
+APP_FIELDS = FieldPlan(appFieldMap)
+ENV_FIELDS = FieldPlan(envFieldMap)
+ADAPTER_FIELDS = FieldPlan(adapterFieldMap)
+# Details of the second GPU.
+ADAPTER2_FIELDS = FieldPlan(adapterFieldMap, "2")
+
+
+class SavedSessionPlan:
+    """Makes a unified saved-session ping look like a classic ping.
+
+    Moves the payload fields to the top level, then recreates the classic
+    "info" section from the compiled environment and adapter field plans."""
+    # payload.info is merged instead, and payload.ver has a different meaning.
+    SKIP_PAYLOAD_FIELDS = frozenset(["info", "ver"])
+
+    def __init__(self, env_fields, adapter_fields, adapter2_fields):
+        self.env_fields = env_fields
+        self.adapter_fields = adapter_fields
+        self.adapter2_fields = adapter2_fields
+
+    def apply(self, json_dict):
+        # Step 1 of conversion:
+        #   ping.payload.* => ping.* (histograms, info, etc)
+        payload = json_dict["payload"]
+        skip = SavedSessionPlan.SKIP_PAYLOAD_FIELDS
+        for field, value in payload.iteritems():
+            if field in skip:
+                continue
+            elif field in json_dict:
+                # TODO: Make this throw?
+                json_dict["payload." + str(field)] = value
+            else:
+                json_dict[field] = value
+
+        # Merge ping.payload.info.* fields to ping.info.*
+        info = json_dict["info"]
+        for field, value in payload["info"].iteritems():
+            if field not in info:
+                info[field] = value
+        # Back up payload.ver
+        json_dict["payload.ver"] = payload["ver"]
+
+        # Get rid of duplicated data in the payload field
+        del json_dict["payload"]
+
+        # Step 2 of conversion:
+        #   Recreate the old-style ping.info section from fields that are
+        #   now in ping.environment
+        envFields = json_dict["environment"]
+        self.env_fields.copy(envFields, info)
+
+        # WINNT is reported as Windows_NT in the unified ping, and apparently
+        # we have some Win95 users
+        if info.get("OS", "Other").startswith("Windows_"):
+            info["OS"] = "WINNT"
+
+        adapters = None
+        try:
+            adapters = envFields["system"]["gfx"]["adapters"]
+        except KeyError, TypeError:
+            pass
+
+        if type(adapters) == list and len(adapters):
+            self.adapter_fields.copy(adapters[0], info)
+            if len(adapters) > 1:
+                # Copy details of the second GPU
+                self.adapter2_fields.copy(adapters[1], info)
+                info["isGPU2Active"] = bool(adapters[1].get("GPUActive"))
+
+SAVED_SESSION_PLAN = SavedSessionPlan(ENV_FIELDS, ADAPTER_FIELDS, ADAPTER2_FIELDS)
 
 
 class BadPayloadError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+class StoredHistogramDefinition:
+    """Stands in for a histogram_tools.Histogram when compiling a
+    HistogramLayout from the shared layout store."""
+    def __init__(self, name, n_buckets):
+        self._name = name
+        self._n_buckets = n_buckets
+
+    def name(self):
+        return self._name
+
+    def n_buckets(self):
+        if self._n_buckets is None:
+            raise ValueError("Non-numeric bucket count")
+        return self._n_buckets
+
+    def ranges(self):
+        # Only asked for if the store has no ranges, see StoredHistogram.error
+        raise DefinitionException("no ranges in the layout store")
+
+class HistogramLayout:
+    """The compiled bucket layout of a single histogram definition.
+
+    Maps the bucket labels found in incoming payloads (the JSON string keys
+    of the "values" object) directly to their index in the converted bucket
+    list, so a histogram can be rewritten without re-deriving its ranges.
+    Bucket ranges that were computed ahead of time can be passed in."""
+    # Rough memory use of a layout, for bounding the Converter's histocache.
+    BASE_BYTES = 1024
+    BUCKET_BYTES = 160
+
+    def __init__(self, histogram, ranges=None):
+        self.name = histogram.name()
+        self.n_buckets = None
+        self.bucket_index = None
+        # Why the bucket labels can't be mapped, if they can't.
+        self.error = None
+        self.template = []
+        self.size = HistogramLayout.BASE_BYTES
+        try:
+            self.n_buckets = int(histogram.n_buckets())
+        except ValueError:
+            # TODO: what should we do for non-numeric bucket counts?
+            #   - output buckets based on observed keys?
+            #   - skip this histogram
+            return
+        self.template = [0] * self.n_buckets
+        self.size += HistogramLayout.BUCKET_BYTES * self.n_buckets
+        if ranges is None:
+            try:
+                ranges = histogram.ranges()
+            except DefinitionException, e:
+                self.error = "Could not find ranges for histogram: %s: %s" % (self.name, e)
+                return
+        self.bucket_index = dict((str(r), i) for i, r in enumerate(ranges))
+
+    @staticmethod
+    def from_stored(name, stored):
+        """Make a layout from a histogram_store.StoredHistogram"""
+        if stored.definition_error is not None:
+            raise DefinitionException(stored.definition_error)
+        layout = HistogramLayout(StoredHistogramDefinition(name, stored.n_buckets), stored.ranges)
+        layout.error = stored.error
+        return layout
+
+    def find_bucket(self, bucket):
+        # Slow path for labels that aren't in canonical form (ie. "01" or
+        # non-string keys). Raises ValueError for non-numeric labels.
+        index = self.bucket_index.get(str(int(bucket)))
+        if index is None:
+            raise BadPayloadError("Found invalid bucket %s.values[%s]" % (self.name, str(bucket)))
+        return index
+
 class Converter:
     """A class for converting incoming payloads to a more compact form"""
     VERSION_UNCONVERTED = 1
@@ -42,16 +202,178 @@ class Converter:
     VERSION_UNIFIED = 4
     # A unified ping with a ping.info field added (at a minimum)
     VERSION_UNIFIED_CONVERTED = 5
+    # Converted classic and unified pings with sparse histograms, see
+    # telemetry/util/histograms.py
+    VERSION_SPARSE = VERSION_SPARSE
+    VERSION_UNIFIED_SPARSE = VERSION_UNIFIED_SPARSE
+    # The "ver" of a ping that is already converted.
+    CONVERTED_VERSIONS = (VERSION_CONVERTED, VERSION_UNIFIED_CONVERTED,
+            VERSION_SPARSE, VERSION_UNIFIED_SPARSE)
+    # The "version" of a unified ping that is already converted.
+    UNIFIED_CONVERTED_VERSIONS = (VERSION_UNIFIED_CONVERTED, VERSION_UNIFIED_SPARSE)
     GEOIP_COUNTRY_PATH = "/usr/local/var/GeoIP/GeoLite2-Country.mmdb"
-
-    def __init__(self, cache, schema):
-        self._histocache = {}
+    HISTOCACHE_MAX_BYTES = 256 * 1024 * 1024
+    GEO_CACHE_SIZE = 100000
+    # Remember this many distinct (revision, histogram, kind) problems.
+    DIAGNOSTICS_MAX_KEYS = 10000
+    # Share compiled layouts between revisions for this many distinct
+    # (histogram, fingerprint) pairs.
+    SHARED_LAYOUTS_MAX_ENTRIES = 100000
+    # Readers are shared by all Converters in a process (and, when opened
+    # memory-mapped before forking, by all forked workers too).
+    _geoip_readers = {}
+
+    def __init__(self, cache, schema, histocache_max_entries=None,
+            histocache_max_bytes=HISTOCACHE_MAX_BYTES,
+            geo_cache_size=GEO_CACHE_SIZE, geoip_mode=None, instrument=False,
+            sparse_histograms=False, layout_store=None, passthrough_converted=False):
+        # Compiled layouts for each distinct Histograms.json, bounded by the
+        # number of distinct files and / or their estimated size.
+        self._histocache = LRUCache(histocache_max_entries, histocache_max_bytes)
+        # (histogram name, fingerprint) => layout. Most histograms don't
+        # change between revisions, so a new revision only compiles the
+        # histograms that did.
+        self._shared_layouts = LRUCache(Converter.SHARED_LAYOUTS_MAX_ENTRIES,
+                histocache_max_bytes)
+        # (revision_url, histogram definitions, histocache key, layouts) of
+        # the most recently converted revision.
+        self._last_revision = (None, None, None, None)
         self._cache = cache
         self._schema = schema
+        # Compiled layouts shared by all processes on the host (see
+        # histogram_store.py). Revisions that aren't in it are compiled from
+        # the RevisionCache as usual.
+        self._layout_store = layout_store
+        # Pass pings that are already converted through without decoding
+        # them. Only the top-level structure of those pings is checked, so
+        # this is only for trusted input that we converted ourselves, never
+        # for raw submissions.
+        self._passthrough_converted = passthrough_converted
+        # Write histograms in the sparse encoding, and mark the pings that
+        # have any with VERSION_SPARSE or VERSION_UNIFIED_SPARSE instead of
+        # the usual converted versions.
+        self._sparse = sparse_histograms
+        # Country (or None if the address is unknown) for each IP we've seen.
+        self._geo_cache = LRUCache(max_entries=geo_cache_size)
         if geo_available:
-            self._geoip = geoip2.database.Reader(Converter.GEOIP_COUNTRY_PATH)
+            self._geoip = Converter.open_geoip(Converter.GEOIP_COUNTRY_PATH,
+                    geoip_mode)
         else:
             self._geoip = None
+        # (revision, histogram, kind) => number of occurrences, for problems
+        # we report once instead of for every ping, plus totals per kind.
+        self._diagnostics = LRUCache(max_entries=Converter.DIAGNOSTICS_MAX_KEYS)
+        self._diagnostic_totals = {}
+        # (stage, ping kind) => [calls, seconds, bytes], if instrumented.
+        self._stage_stats = None
+        if instrument:
+            self.instrument()
+
+    # Conversion stages that can be timed, as (stage name, method name).
+    # Stages nest: everything but parse and serialize is counted in convert.
+    # info_fields only covers the application fields; the environment fields
+    # of saved-session pings are copied as part of saved_session.
+    STAGES = (
+        ("parse", "parse"),
+        ("convert", "convert_obj"),
+        ("histograms", "rewrite_hists"),
+        ("saved_session", "convert_saved_session"),
+        ("info_fields", "add_info_fields"),
+        ("geoip", "get_geo_country"),
+        ("dimensions", "get_dimensions"),
+        ("serialize", "serialize"),
+        ("passthrough", "passthrough")
+    )
+
+    def instrument(self):
+        """Count calls, elapsed time and bytes for each conversion stage.
+
+        Stages are counted separately for each kind of ping (see ping_kind).
+        The methods are only wrapped once this is called, so there is no
+        overhead when instrumentation is off."""
+        if self._stage_stats is not None:
+            return
+        self._stage_stats = {}
+        # The kind of the ping currently being converted.
+        self._stage_kind = "unknown"
+        for stage, method in Converter.STAGES:
+            setattr(self, method, self.timed_stage(stage, getattr(self, method)))
+
+    def timed_stage(self, stage, func):
+        stage_stats = self._stage_stats
+        def timed(*args, **kwargs):
+            if stage == "convert":
+                self._stage_kind = self.ping_kind(args[0])
+            elif stage == "passthrough":
+                # We don't know what kind of ping it is yet.
+                self._stage_kind = "passthrough"
+            start = time.time()
+            result = func(*args, **kwargs)
+            elapsed = time.time() - start
+            size = 0
+            kind = self._stage_kind
+            if stage == "parse":
+                size = len(args[0])
+                kind = self._stage_kind = self.ping_kind(result)
+            elif stage == "serialize":
+                size = len(result)
+            elif stage == "passthrough":
+                if result is None:
+                    # The payload gets converted the regular way instead.
+                    kind = "fallback"
+                else:
+                    size = len(result[0])
+                    kind = "converted"
+            stage_kind = (stage, kind)
+            entry = stage_stats.get(stage_kind)
+            if entry is None:
+                entry = stage_stats[stage_kind] = [0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += size
+            return result
+        return timed
+
+    # Describe a ping for the stage stats as "<type>.v<version>", using
+    # "classic" as the type of pre-unification pings.
+    def ping_kind(self, json_dict):
+        try:
+            if "ver" in json_dict:
+                return "classic.v{0}".format(json_dict["ver"])
+            if "version" in json_dict:
+                return "{0}.v{1}".format(json_dict.get("type"), json_dict["version"])
+        except TypeError:
+            pass
+        return "unknown"
+
+    # Snapshot of the stage stats, keyed by "stage.<stage>.<ping kind>".
+    # Empty unless instrumented.
+    def get_stage_stats(self):
+        stats = {}
+        if self._stage_stats is not None:
+            for (stage, kind), (calls, seconds, size) in self._stage_stats.iteritems():
+                stats["stage.{0}.{1}".format(stage, kind)] = {
+                    "calls": calls,
+                    "seconds": seconds,
+                    "bytes": size
+                }
+        return stats
+
+    # Open the GeoIP database once per process. Pass
+    # geoip_mode=GEOIP_MODE_MMAP to memory-map the file, so that
+    # workers forked after the Converter is created share its pages
+    # copy-on-write instead of each loading their own copy.
+    @staticmethod
+    def open_geoip(path, mode=None):
+        key = (path, mode)
+        reader = Converter._geoip_readers.get(key)
+        if reader is None:
+            if mode is None:
+                reader = geoip2.database.Reader(path)
+            else:
+                reader = geoip2.database.Reader(path, mode=mode)
+            Converter._geoip_readers[key] = reader
+        return reader
 
     def map_key(self, histograms, key):
         return key
@@ -65,9 +387,7 @@ class Converter:
                 if candidate == "":
                     continue
                 try:
-                    country = self._geoip.country(candidate).country.iso_code
-                except AddressNotFoundError, e:
-                    pass
+                    country = self.lookup_geo_country(candidate)
                 except Exception, e:
                     err = e
 
@@ -80,66 +400,156 @@ class Converter:
 
         return country
 
-    def map_value(self, histogram, val):
-        rewritten = []
-        try:
-            bucket_count = int(histogram.n_buckets())
-            #sys.stderr.write("Found %d buckets for %s\n" % (bucket_count, histogram.name()))
-            rewritten = [0] * bucket_count
-            value_map = val["values"]
+    # Look up a single IP address, remembering both found and unknown
+    # addresses. Other errors (such as invalid addresses) are not cached.
+    def lookup_geo_country(self, ip):
+        country = self._geo_cache.get(ip, NOT_CACHED)
+        if country is NOT_CACHED:
+            country = None
             try:
-                try:
-                    # Materialize the ranges (since we're caching Histograms)
-                    allowed_ranges = histogram.allowed_ranges
-                except AttributeError:
-                    histogram.allowed_ranges = histogram.ranges()
-                    allowed_ranges = histogram.allowed_ranges
+                country = self._geoip.country(ip).country.iso_code
+            except AddressNotFoundError:
+                pass
+            self._geo_cache.put(ip, country)
+        return country
 
-                try:
-                    # Materialize the range_map too.
-                    range_map = histogram.range_map
-                except AttributeError:
-                    range_map = {}
-                    for index, allowed_range in enumerate(allowed_ranges):
-                        range_map[allowed_range] = index
-                    histogram.range_map = range_map
-
-                for bucket in value_map.keys():
-                    ib = int(bucket)
-                    try:
-                        #sys.stderr.write("Writing %s.values[%s] to buckets[%d] (size %d)\n" % (histogram.name(), bucket, range_map[ib], bucket_count))
-                        bucket_val = value_map[bucket]
-                        # Make sure it's a number:
-                        if isinstance(bucket_val, (int, long)):
-                            rewritten[range_map[ib]] = bucket_val
-                        else:
-                            raise BadPayloadError("Found non-integer bucket value: %s.values[%s] = '%s'" % (histogram.name(), str(bucket), str(bucket_val)))
-                    except KeyError:
-                        raise BadPayloadError("Found invalid bucket %s.values[%s]" % (histogram.name(), str(bucket)))
-            except DefinitionException:
-                sys.stderr.write("Could not find ranges for histogram: %s: %s\n" % (histogram.name(), sys.exc_info()))
-        except ValueError:
-            # TODO: what should we do for non-numeric bucket counts?
-            #   - output buckets based on observed keys?
-            #   - skip this histogram
-            pass
+    def map_value(self, layout, val):
+        rewritten = []
+        if layout.n_buckets is not None:
+            rewritten = layout.template[:]
+            value_map = val["values"]
+            bucket_index = layout.bucket_index
+            if bucket_index is not None:
+                for bucket, bucket_val in value_map.iteritems():
+                    # Make sure it's a number:
+                    if not isinstance(bucket_val, (int, long)):
+                        raise BadPayloadError("Found non-integer bucket value: %s.values[%s] = '%s'" % (layout.name, str(bucket), str(bucket_val)))
+                    index = bucket_index.get(bucket)
+                    if index is None:
+                        try:
+                            index = layout.find_bucket(bucket)
+                        except ValueError:
+                            # TODO: what should we do for non-numeric bucket
+                            #       labels?
+                            break
+                    rewritten[index] = bucket_val
 
         for k in ("sum", "log_sum", "log_sum_squares", "sum_squares_lo", "sum_squares_hi"):
             rewritten.append(val.get(k, -1))
         return rewritten
 
-    # Memoize building the Histogram object from the histogram definition.
+    # Get the histocache key and compiled layouts for a revision. Revisions
+    # with identical Histograms.json contents share the same layouts.
+    def get_layouts(self, revision_url, key=None):
+        if key is None:
+            key = self._cache.get_content_hash(revision_url)
+        if key is None:
+            key = revision_url
+        layouts = self._histocache.get(key)
+        if layouts is None:
+            layouts = {}
+            self._histocache.put(key, layouts)
+        return key, layouts
+
+    def compile_layout(self, key, layouts, name, definition):
+        shared_key = None
+        if isinstance(definition, StoredHistogram):
+            layout = layouts[name] = HistogramLayout.from_stored(name, definition)
+        else:
+            try:
+                shared_key = (name, histogram_fingerprint(definition))
+                layout = self._shared_layouts.get(shared_key)
+            except (AttributeError, TypeError):
+                # Not a dict, or has unhashable fields.
+                shared_key = None
+                layout = None
+            if layout is None:
+                # Use the bucket ranges from the revision cache, if it has them.
+                ranges = self._cache.get_ranges(key)
+                if ranges is not None:
+                    ranges = ranges.get(name)
+                layout = HistogramLayout(Histogram(name, definition), ranges)
+                if shared_key is not None:
+                    self._shared_layouts.put(shared_key, layout, layout.size)
+            layouts[name] = layout
+        # Every revision is charged for all the layouts it keeps alive, even
+        # the shared ones. That overstates the memory used when revisions
+        # share layouts, but a layout evicted from _shared_layouts stays alive
+        # for as long as any revision holds it, so this is what bounds it.
+        if not self._histocache.resize(key, layout.size):
+            # The layouts for this revision have been evicted. Don't keep them
+            # around (uncounted) for the next record either.
+            self._last_revision = (None, None, None, None)
+        return layout
+
+    # Memoize compiling the histogram definition into a HistogramLayout.
     def histocache(self, revision_url, name, definition):
-        key = "%s.%s" % (name, revision_url)
-        if key not in self._histocache:
-            hist = Histogram(name, definition)
-            self._histocache[key] = hist
-        return self._histocache[key]
+        key, layouts = self.get_layouts(revision_url)
+        layout = layouts.get(name)
+        if layout is None:
+            layout = self.compile_layout(key, layouts, name, definition)
+        return layout
+
+    # Look up the histogram definitions and compiled layouts for a revision.
+    # Consecutive payloads usually come from the same build (convert_batch
+    # makes sure they do), so remember the last revision we resolved.
+    def resolve_revision(self, revision_url):
+        last_url, histogram_defs, key, layouts = self._last_revision
+        if revision_url != last_url or histogram_defs is None:
+            histogram_defs = self.lookup_layout_store(revision_url)
+            if histogram_defs is not None:
+                key, layouts = self.get_layouts(revision_url, histogram_defs.content_hash)
+            else:
+                histogram_defs = self._cache.get_histograms_for_revision(revision_url)
+                if histogram_defs is None:
+                    raise ValueError("Failed to fetch histograms for URL: %s" % revision_url)
+                key, layouts = self.get_layouts(revision_url)
+            self._last_revision = (revision_url, histogram_defs, key, layouts)
+        return histogram_defs, key, layouts
+
+    # The histograms of a revision in the shared layout store (which behave
+    # like the histogram definitions as far as rewrite_hists is concerned),
+    # or None.
+    def lookup_layout_store(self, revision_url):
+        if self._layout_store is None:
+            return None
+        repo, revision = self._cache.revision_url_to_parts(revision_url)
+        return self._layout_store.lookup(repo, revision)
+
+    # Count a problem with a histogram in a revision. Only the first
+    # occurrence of each (revision, histogram, kind) is written out, the rest
+    # are summarized by get_stats.
+    def report_problem(self, revision_url, histogram, kind, message):
+        key = (revision_url, histogram, kind)
+        count = self._diagnostics.get(key, 0)
+        if count == 0:
+            sys.stderr.write("ERROR: %s (revision %s)\n" % (message, revision_url))
+        self._diagnostics.put(key, count + 1)
+        self._diagnostic_totals[kind] = self._diagnostic_totals.get(kind, 0) + 1
+
+    # The (revision, histogram, kind, count) problems seen so far, most
+    # frequent first.
+    def get_diagnostics(self):
+        problems = [key + (count,) for key, count in self._diagnostics.items()]
+        problems.sort(key=lambda p: p[3], reverse=True)
+        return problems
+
+    # Cache statistics, keyed by cache name. The hit rate of a cache is
+    # hits / (hits + misses). Also the number of histogram problems of each
+    # kind.
+    def get_stats(self):
+        stats = self.get_stage_stats()
+        stats["histocache"] = self._histocache.get_stats()
+        stats["geocache"] = self._geo_cache.get_stats()
+        stats["shared_layouts"] = self._shared_layouts.get_stats()
+        stats["revision_cache"] = self._cache.get_stats()
+        if self._layout_store is not None:
+            stats["layout_store"] = self._layout_store.get_stats()
+        stats["diagnostics"] = dict(self._diagnostic_totals)
+        return stats
 
     def rewrite_hists(self, revision_url, histograms):
-        histogram_defs = self._cache.get_histograms_for_revision(revision_url)
-        if histogram_defs is None:
-            raise ValueError("Failed to fetch histograms for URL: %s" % revision_url)
+        histogram_defs, cache_key, layouts = self.resolve_revision(revision_url)
         rewritten = dict()
         for key, val in histograms.iteritems():
             real_histogram_name = key
@@ -151,91 +561,132 @@ class Converter:
                 #     in the `gatherStartupHistograms` function.
                 real_histogram_name = key[8:]
             else:
-                # TODO: collect these to be returned
-                sys.stderr.write("ERROR: no histogram definition found for %s\n" % key)
+                self.report_problem(revision_url, key, "unknown_histogram",
+                        "no histogram definition found for %s" % key)
                 continue
 
-            histogram_def = histogram_defs[real_histogram_name]
-            histogram = self.histocache(revision_url, key, histogram_def)
+            layout = layouts.get(key)
+            if layout is None:
+                histogram_def = histogram_defs[real_histogram_name]
+                layout = self.compile_layout(cache_key, layouts, key, histogram_def)
+            if layout.error is not None:
+                self.report_problem(revision_url, key, "missing_ranges", layout.error)
             new_key = self.map_key(histogram_defs, key)
-            new_value = self.map_value(histogram, val)
+            new_value = self.map_value(layout, val)
+            if self._sparse:
+                new_value = sparse_histogram(new_value)
             rewritten[new_key] = new_value
         return rewritten
 
+    def parse(self, jsonstr):
+        return json.loads(jsonstr)
+
     def convert_json(self, jsonstr, date, ip=None):
-        json_dict = json.loads(jsonstr)
+        json_dict = self.parse(jsonstr)
         return self.convert_obj(json_dict, date, ip)
 
-    def add_info_fields(self, info, srcSection, rules, dstSuffix=""):
-        for dstField, srcFields in rules.iteritems():
-            dstField += dstSuffix
-            if dstField in info:
-                # Ping already has this field in info!
-                # TODO: Make this throw?
-                dstField = "environment." + dstField
-            # Recurse into the unified ping's structure according to the map
-            val = srcSection
-            for field in srcFields:
-                if field in val:
-                   val = val[field]
-                else:
-                    # this unified ping doesn't report this particular field
-                    val = None
-                    break
-            # Copy the value into ping.info[field name]
-            if val != None:
-                info[dstField] = val
+    def get_revision_url(self, json_dict):
+        # Classic pings keep the revision in ping.info, unified main and
+        # saved-session pings in ping.payload.info
+        try:
+            info = json_dict.get("info")
+            if info is None and "payload" in json_dict:
+                info = json_dict["payload"].get("info")
+            return info.get("revision")
+        except AttributeError:
+            return None
+
+    # Like convert_json, but returns the serialized ping and its dimensions.
+    def convert_json_serialized(self, jsonstr, date, ip=None):
+        result = None
+        if self._passthrough_converted:
+            result = self.passthrough(jsonstr, date, ip)
+        if result is None:
+            json_dict, dimensions = self.convert_json(jsonstr, date, ip)
+            result = (self.serialize(json_dict), dimensions)
+        return result
 
-    def convert_saved_session(self, json_dict):
-        # Step 1 of conversion:
-        #   ping.payload.* => ping.* (histograms, info, etc)
-        payload = json_dict["payload"]
-        for field in payload:
-            if field == "info" or field == "ver":
-                # info field needs to be merged, ping.ver has different meaning
-                continue
-            elif field in json_dict:
-                # TODO: Make this throw?
-                json_dict["payload." + str(field)] = payload[field]
-                continue
-            else:
-                json_dict[field] = payload[field]
+    # Top-level fields needed to check an already-converted ping.
+    PASSTHROUGH_FIELDS = frozenset(("ver", "version", "type", "info"))
 
-        # Merge ping.payload.info.* fields to ping.info.*
-        payload_info = payload["info"]
-        for field in payload_info:
-            if field not in json_dict["info"]:
-                json_dict["info"][field] = payload_info[field]
-        # Back up payload.ver
-        json_dict["payload.ver"] = payload["ver"]
+    def passthrough(self, jsonstr, date, ip=None):
+        """Get the dimensions of an already-converted ping without decoding
+        and re-encoding the whole payload.
 
-        # Get rid of duplicated data in the payload field
-        del json_dict["payload"]
-
-        # Step 2 of conversion:
-        #   Recreate the old-style ping.info section from fields that are
-        #   now in ping.environment
-        envFields = json_dict["environment"]
-        info = json_dict["info"]
-        self.add_info_fields(info, envFields, envFieldMap)
+        Returns (jsonstr, dimensions) with jsonstr untouched (apart from any
+        surrounding whitespace), or None if the payload has to go through the
+        regular conversion. Only the top-level structure is scanned, so the
+        rest of the payload is trusted to be the valid JSON we wrote when it
+        was converted."""
+        try:
+            keys, fields = jsonscan.scan_top_level(jsonstr, Converter.PASSTHROUGH_FIELDS)
+        except (ValueError, IndexError):
+            return None
+
+        if "ver" in keys:
+            if fields["ver"] not in Converter.CONVERTED_VERSIONS:
+                return None
+        elif "version" in keys:
+            if (fields["version"] not in Converter.UNIFIED_CONVERTED_VERSIONS or
+                not fields.get("type") or
+                "application" not in keys or "payload" not in keys):
+                return None
+        else:
+            return None
 
-        # WINNT is reported as Windows_NT in the unified ping, and apparently
-        # we have some Win95 users
-        if info.get("OS", "Other").startswith("Windows_"):
-            info["OS"] = "WINNT"
+        info = fields.get("info")
+        if not isinstance(info, dict):
+            return None
+        if ip is not None and info.get("appName") == "FirefoxOS":
+            # We need to look up (and add) the country.
+            return None
+        return jsonstr.strip(), self.get_dimensions(info, date)
+
+    def convert_batch(self, records, serialize=False):
+        """Convert a list of (jsonstr, date, ip) tuples.
+
+        Returns a list of (converted, dimensions, error) tuples in the same
+        order as the input. Records are converted grouped by revision, so the
+        histogram definitions for each revision are only resolved once.
+
+        If serialize is True, converted is the serialized ping, and (if the
+        Converter was created with passthrough_converted) pings that are
+        already converted are passed through without decoding."""
+        results = [None] * len(records)
+        by_revision = {}
+        for i, (jsonstr, date, ip) in enumerate(records):
+            if serialize and self._passthrough_converted:
+                passed = self.passthrough(jsonstr, date, ip)
+                if passed is not None:
+                    results[i] = (passed[0], passed[1], None)
+                    continue
+            try:
+                json_dict = self.parse(jsonstr)
+            except Exception, e:
+                results[i] = (None, None, e)
+                continue
+            revision_url = self.get_revision_url(json_dict)
+            group = by_revision.get(revision_url)
+            if group is None:
+                group = by_revision[revision_url] = []
+            group.append((i, json_dict, date, ip))
+
+        for group in by_revision.itervalues():
+            for i, json_dict, date, ip in group:
+                try:
+                    converted, dimensions = self.convert_obj(json_dict, date, ip)
+                    if serialize:
+                        converted = self.serialize(converted)
+                    results[i] = (converted, dimensions, None)
+                except Exception, e:
+                    results[i] = (None, None, e)
+        return results
 
-        adapters = None
-        try:
-            adapters = envFields["system"]["gfx"]["adapters"]
-        except KeyError, TypeError:
-            pass
+    def add_info_fields(self, info, srcSection, plan):
+        plan.copy(srcSection, info)
 
-        if type(adapters) == list and len(adapters):
-            self.add_info_fields(info, adapters[0], adapterFieldMap)
-            if len(adapters) > 1:
-                # Copy details of the second GPU
-                self.add_info_fields(info, adapters[1], adapterFieldMap, "2")
-                info["isGPU2Active"] = bool(adapters[1].get("GPUActive"))
+    def convert_saved_session(self, json_dict):
+        SAVED_SESSION_PLAN.apply(json_dict)
 
         # Fix up clientID
         json_dict["clientID"] = json_dict.get("clientId")
@@ -243,8 +694,10 @@ class Converter:
         # Step 3:
         #   Add a "ver" field to make it look like a classic ping to
         #   existing analysis jobs
-        json_dict["ver"] = Converter.VERSION_UNIFIED_CONVERTED
+        json_dict["ver"] = json_dict["version"]
 
+    # Returns True if the histograms were rewritten (so are in the sparse
+    # encoding if that's what we write).
     def convert_histograms(self, json_dict):
         info = json_dict.get("info", None)
         if info is None:
@@ -257,6 +710,7 @@ class Converter:
             # about revision (since we don't need to convert anything)
             if "histograms" in json_dict:
                 raise ValueError("Missing in payload: info.revision")
+            return False
         else:
             revision = info.get("revision")
             if "histograms" not in json_dict:
@@ -267,14 +721,17 @@ class Converter:
                 raise ValueError("Bad Histogram definition for revision {0}: {1}".format(revision, e))
             except KeyError, e:
                 raise ValueError("Bad Histogram key for revision {0}: {1}".format(revision, e))
+            return True
 
     def convert_obj(self, json_dict, date, ip=None):
         if "ver" in json_dict:
             # This looks like a classic ping (from before Telemetry/FHR unification)
             info = json_dict.get("info", None)
             if (json_dict["ver"] == Converter.VERSION_UNCONVERTED):
-                self.convert_histograms(json_dict)
-                json_dict["ver"] = Converter.VERSION_CONVERTED
+                if self.convert_histograms(json_dict) and self._sparse:
+                    json_dict["ver"] = Converter.VERSION_SPARSE
+                else:
+                    json_dict["ver"] = Converter.VERSION_CONVERTED
             elif json_dict["ver"] == Converter.VERSION_FXOS_1_3:
                 info = {
                     "reason": "ftu",
@@ -289,8 +746,7 @@ class Converter:
                 if "pingID" in json_dict:
                     del json_dict["pingID"]
                 json_dict["ver"] = Converter.VERSION_CONVERTED
-            elif (json_dict["ver"] != Converter.VERSION_CONVERTED and
-                  json_dict["ver"] != Converter.VERSION_UNIFIED_CONVERTED):
+            elif json_dict["ver"] not in Converter.CONVERTED_VERSIONS:
                 raise ValueError("Unknown payload version: " + str(json_dict["ver"]))
             # else it's already converted.
 
@@ -302,7 +758,7 @@ class Converter:
 
             # Verify some basic assumptions
             if (pingVersion != Converter.VERSION_UNIFIED and
-                pingVersion != Converter.VERSION_UNIFIED_CONVERTED):
+                pingVersion not in Converter.UNIFIED_CONVERTED_VERSIONS):
                 raise ValueError("Unknown unified ping version: " + str(json_dict["version"]))
             elif not pingType:
                 raise ValueError("Unified ping has no top-level 'type' field")
@@ -319,7 +775,7 @@ class Converter:
                     raise ValueError("Raw unified ping has an existing ping.info field")
 
                 info = json_dict["info"] = {}
-                self.add_info_fields(info, json_dict["application"], appFieldMap)
+                self.add_info_fields(info, json_dict["application"], APP_FIELDS)
                 info["reason"] = pingType
                 json_dict["version"] = Converter.VERSION_UNIFIED_CONVERTED
 
@@ -332,7 +788,8 @@ class Converter:
                     elif "histograms" not in json_payload:
                         raise ValueError("Unified " + pingType + " missing payload.histograms")
                     # Convert the histograms section to the more compact representation
-                    self.convert_histograms(json_payload)
+                    if self.convert_histograms(json_payload) and self._sparse:
+                        json_dict["version"] = Converter.VERSION_UNIFIED_SPARSE
 
                     # Make unified saved-session pings look like classic pings
                     if pingType == "saved-session":
@@ -344,7 +801,8 @@ class Converter:
                     # Don't alter it further
                     pass
             else:
-                # pingVersion == Converter.VERSION_UNIFIED_CONVERTED:
+                # pingVersion == Converter.VERSION_UNIFIED_CONVERTED or
+                #                Converter.VERSION_UNIFIED_SPARSE:
                 # This unified ping was already converted. Do nothing
                 info = json_dict["info"]
                 pass
@@ -365,10 +823,13 @@ class Converter:
             if country is None:
                 country = "??"
             json_dict["info"]["geoCountry"] = country
-        # Get dimensions in order from schema (field_name)
-        dimensions = self._schema.dimensions_from(info, date)
+        dimensions = self.get_dimensions(info, date)
         return json_dict, dimensions
 
+    # Get dimensions in order from schema (field_name)
+    def get_dimensions(self, info, date):
+        return self._schema.dimensions_from(info, date)
+
     def get_dimension(self, info, key):
         result = "UNKNOWN"
         if info and key in info:
@@ -379,47 +840,136 @@ class Converter:
     def serialize(self, json_dict, sort_keys=False):
         return json.dumps(json_dict, separators=(',', ':'), sort_keys=sort_keys)
 
-def process(converter, target_date=None):
-    line_num = 0
-    bytes_read = 0;
-    if target_date is None:
-        target_date = date.today().strftime("%Y%m%d")
+# Read this many bytes (rounded up to whole lines) of input at a time.
+CHUNK_SIZE = 4 * 1024 * 1024
 
-    start = time.clock()
+# Read an input stream in chunks of whole lines.
+# Yields (line number of the first line, lines)
+def read_chunks(stream, chunk_size=CHUNK_SIZE):
+    line_num = 1
     while True:
-        line_num += 1
-        line = sys.stdin.readline()
-        if line == '':
+        lines = stream.readlines(chunk_size)
+        if not lines:
             break
-        bytes_read += len(line)
-
+        yield line_num, lines
+        line_num += len(lines)
+
+# Convert a chunk of "<uuid>\t<json>" lines.
+# Returns the converted output and a list of (line number, error message)
+def convert_lines(converter, lines, first_line_num, target_date):
+    output = []
+    errors = []
+    batch = []
+    for line_num, line in enumerate(lines, first_line_num):
         if "\t" not in line:
-            sys.stderr.write("Error on line %d: no tab found\n" % (line_num))
+            errors.append((line_num, "Error on line %d: no tab found\n" % (line_num)))
             continue
 
         uuid, jsonstr = line.split("\t", 1)
-        try:
-            json_dict, dimensions = converter.convert_json(jsonstr, target_date)
-            sys.stdout.write(uuid)
-            sys.stdout.write("\t")
-            sys.stdout.write(converter.serialize(json_dict))
-            sys.stdout.write("\n")
-        except BadPayloadError, e:
-            sys.stderr.write("Payload Error on line %d: %s\n%s\n" % (line_num, e.msg, jsonstr))
-        except Exception, e:
-            sys.stderr.write("Error converting line %d: %s\n" % (line_num, e))
-
-    duration = time.clock() - start
+        batch.append((line_num, uuid, jsonstr))
+
+    results = converter.convert_batch([(jsonstr, target_date, None) for n, uuid, jsonstr in batch], serialize=True)
+    for (n, uuid, jsonstr), (serialized, dimensions, e) in zip(batch, results):
+        # convert_batch has already caught the errors, so report them as they
+        # are rather than raising them again here.
+        if e is None:
+            output.append("%s\t%s\n" % (uuid, serialized))
+        elif isinstance(e, BadPayloadError):
+            errors.append((n, "Payload Error on line %d: %s\n%s\n" % (n, e.msg, jsonstr)))
+        else:
+            errors.append((n, "Error converting line %d: %s\n" % (n, e)))
+    errors.sort()
+    return "".join(output), errors
+
+def write_elapsed(duration, bytes_read):
     mb_read = float(bytes_read) / 1024.0 / 1024.0
     if duration > 0:
         sys.stderr.write("Elapsed time: %.02fs (%.02fMB/s)\n" % (duration, mb_read / duration))
     else:
         sys.stderr.write("Elapsed time: %.02fs (??? MB/s)\n" % (duration))
 
+def process(converter, target_date=None, chunk_size=CHUNK_SIZE):
+    bytes_read = 0;
+    if target_date is None:
+        target_date = date.today().strftime("%Y%m%d")
+
+    start = time.clock()
+    for line_num, lines in read_chunks(sys.stdin, chunk_size):
+        bytes_read += sum(len(l) for l in lines)
+        output, errors = convert_lines(converter, lines, line_num, target_date)
+        sys.stdout.write(output)
+        for n, message in errors:
+            sys.stderr.write(message)
+
+    write_elapsed(time.clock() - start, bytes_read)
+
+# Each worker process in process_parallel gets its own Converter (and
+# RevisionCache).
+worker_converter = None
+
+def init_worker(cache_dir, server, schema_spec, converter_options=None):
+    global worker_converter
+    cache = revision_cache.RevisionCache(cache_dir, server)
+    worker_converter = Converter(cache, TelemetrySchema(schema_spec),
+            **(converter_options or {}))
+
+def convert_chunk(args):
+    line_num, lines, target_date = args
+    output, errors = convert_lines(worker_converter, lines, line_num, target_date)
+    return output, errors, sum(len(l) for l in lines)
+
+# Write out the result of convert_chunk. Returns the number of bytes of
+# input it covered.
+def write_chunk(result):
+    output, errors, chunk_bytes = result
+    sys.stdout.write(output)
+    for n, message in errors:
+        sys.stderr.write(message)
+    return chunk_bytes
+
+# Keep at most this many chunks per worker in flight in process_parallel.
+PENDING_CHUNKS_PER_WORKER = 2
+
+# Like process(), but fan chunks of input out to a pool of worker processes.
+# Output (and errors) are written in the original line order.
+def process_parallel(num_workers, cache_dir, server, schema_spec,
+        target_date=None, chunk_size=CHUNK_SIZE, converter_options=None):
+    bytes_read = 0
+    if target_date is None:
+        target_date = date.today().strftime("%Y%m%d")
+
+    start = time.time()
+    pool = multiprocessing.Pool(num_workers, init_worker,
+            (cache_dir, server, schema_spec, converter_options))
+    # Chunks that have been handed to the pool, oldest first. Only read more
+    # input once there's room, so a slow writer (or slow workers) doesn't
+    # let the whole input pile up in memory.
+    pending = deque()
+    max_pending = PENDING_CHUNKS_PER_WORKER * num_workers
+    try:
+        for line_num, lines in read_chunks(sys.stdin, chunk_size):
+            if len(pending) >= max_pending:
+                bytes_read += write_chunk(pending.popleft().get())
+            pending.append(pool.apply_async(convert_chunk,
+                    ((line_num, lines, target_date),)))
+        while pending:
+            bytes_read += write_chunk(pending.popleft().get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    write_elapsed(time.time() - start, bytes_read)
+
 def main(argv=None):
     parser = argparse.ArgumentParser(description="Convert Telemetry data")
     parser.add_argument("-c", "--config-file", help="Read configuration from this file", default="./telemetry_server_config.json")
     parser.add_argument("-d", "--date", help="Use specified date for dimensions")
+    parser.add_argument("-w", "--workers", metavar="N", type=int, default=1, help="Convert using N worker processes")
+    parser.add_argument("--sparse-histograms", action="store_true", help="Write histograms in the sparse encoding")
+    parser.add_argument("--passthrough-converted", action="store_true", help="Copy pings that are already converted without checking more than their top level (only for input converted by us, such as backfills)")
     args = parser.parse_args()
 
     try:
@@ -433,12 +983,18 @@ def main(argv=None):
     server = config.get("revision_cache_server", "hg.mozilla.org")
     schema_filename = config.get("schema_filename", "./telemetry_schema.json")
     schema_data = open(schema_filename)
-    schema = TelemetrySchema(json.load(schema_data))
+    schema_spec = json.load(schema_data)
     schema_data.close()
 
-    cache = revision_cache.RevisionCache(cache_dir, server)
-    converter = Converter(cache, schema)
-    process(converter, args.date)
+    converter_options = {"sparse_histograms": args.sparse_histograms,
+            "passthrough_converted": args.passthrough_converted}
+    if args.workers > 1:
+        process_parallel(args.workers, cache_dir, server, schema_spec, args.date,
+                converter_options=converter_options)
+    else:
+        cache = revision_cache.RevisionCache(cache_dir, server)
+        converter = Converter(cache, TelemetrySchema(schema_spec), **converter_options)
+        process(converter, args.date)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# A read-only store of compiled histogram layouts, shared by all the
+# converters on a host.
+#
+# The store is a single file, written once by build_store (see main below)
+# from a RevisionCache directory and then memory-mapped by every process that
+# converts pings, so its pages are only held in memory once per host. Lookups
+# binary search the file in place. Only the histograms a process actually
+# uses are decoded, and those end up in the Converter's bounded histocache.
+#
+# File format (all integers little-endian):
+#   header:    magic, format version, number of tables, number of revisions
+#   revisions: (sha1 of "repo/short revision", table number), sorted
+#   tables:    (sha1 of the Histograms.json contents, offset and number of
+#              its histogram entries), in table number order
+#   entries:   for each table, (name offset, name length, data offset, data
+#              length), sorted by name
+#   blobs:     histogram names, and marshalled (n_buckets, ranges, error,
+#              definition error) tuples
+
+import argparse
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import sys
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from revision_cache import RevisionCache
+
+MAGIC = "THLS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sIII")
+REVISION = struct.Struct("<20sI")
+TABLE = struct.Struct("<20sQI")
+ENTRY = struct.Struct("<QIQI")
+SHORT_REVISION_LENGTH = 12
+
+
+def revision_key(repo, revision):
+    return hashlib.sha1("%s/%s" % (repo, revision[:SHORT_REVISION_LENGTH])).digest()
+
+
+class StoredHistogram:
+    """The compiled layout of one histogram, as kept in the store.
+
+    definition_error is set if the definition couldn't be used at all, and
+    error if its bucket ranges couldn't be computed."""
+    def __init__(self, n_buckets, ranges, error, definition_error):
+        self.n_buckets = n_buckets
+        self.ranges = ranges
+        self.error = error
+        self.definition_error = definition_error
+
+
+class StoredTable:
+    """The histograms of one distinct Histograms.json. Supports the parts of
+    the dict interface that Converter.rewrite_hists uses on definitions."""
+    def __init__(self, store, content_hash, offset, count):
+        self._store = store
+        self.content_hash = content_hash
+        self._offset = offset
+        self._count = count
+
+    def find(self, name):
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        data = self._store.data
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name_offset, name_len, data_offset, data_len = \
+                    ENTRY.unpack_from(data, self._offset + mid * ENTRY.size)
+            mid_name = data[name_offset:name_offset + name_len]
+            if mid_name < name:
+                lo = mid + 1
+            elif mid_name > name:
+                hi = mid
+            else:
+                return data_offset, data_len
+        return None
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def __getitem__(self, name):
+        found = self.find(name)
+        if found is None:
+            raise KeyError(name)
+        data_offset, data_len = found
+        return StoredHistogram(*marshal.loads(
+                self._store.data[data_offset:data_offset + data_len]))
+
+    def __len__(self):
+        return self._count
+
+
+class LayoutStore:
+    """A memory-mapped histogram layout store, see build_store."""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._n_tables, self._n_revisions = \
+                HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a histogram layout store: %s" % filename)
+        self._revisions_offset = HEADER.size
+        self._tables_offset = self._revisions_offset + self._n_revisions * REVISION.size
+        self._tables = dict()
+
+    def close(self):
+        self.data.close()
+
+    def get_table(self, number):
+        table = self._tables.get(number)
+        if table is None:
+            content_hash, offset, count = TABLE.unpack_from(self.data,
+                    self._tables_offset + number * TABLE.size)
+            table = StoredTable(self, content_hash.encode("hex"), offset, count)
+            self._tables[number] = table
+        return table
+
+    def lookup(self, repo, revision):
+        """Returns the StoredTable for a revision, or None if the store doesn't
+        know that revision."""
+        key = revision_key(repo, revision)
+        lo = 0
+        hi = self._n_revisions
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, number = REVISION.unpack_from(self.data,
+                    self._revisions_offset + mid * REVISION.size)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return self.get_table(number)
+        return None
+
+    def get_stats(self):
+        return {
+            "tables": self._n_tables,
+            "revisions": self._n_revisions,
+            "bytes": len(self.data)
+        }
+
+
+def write_store(filename, tables, revisions):
+    """Write a store file.
+
+    tables maps the content hash of each Histograms.json to a dict of
+    {histogram name: (n_buckets, ranges, error, definition error)} (see
+    StoredHistogram), and revisions maps (repo, revision) to the content
+    hash of its Histograms.json. The file is written to a temporary name
+    first, so readers never see a partial store."""
+    hashes = sorted(tables)
+    numbers = dict((h, i) for i, h in enumerate(hashes))
+    revision_records = sorted((revision_key(repo, revision), numbers[h])
+            for (repo, revision), h in revisions.iteritems() if h in numbers)
+
+    entries_offset = HEADER.size + len(revision_records) * REVISION.size + \
+            len(hashes) * TABLE.size
+    blob_offset = entries_offset + ENTRY.size * sum(len(t) for t in tables.itervalues())
+
+    header = [HEADER.pack(MAGIC, FORMAT_VERSION, len(hashes), len(revision_records))]
+    header.extend(REVISION.pack(key, number) for key, number in revision_records)
+    entries = []
+    blobs = []
+    offset = blob_offset
+    for h in hashes:
+        table = tables[h]
+        header.append(TABLE.pack(h.decode("hex"), entries_offset + len(entries) * ENTRY.size, len(table)))
+        names = sorted((name.encode("utf-8") if isinstance(name, unicode) else name, name)
+                for name in table)
+        for encoded_name, name in names:
+            data = marshal.dumps(tuple(table[name]))
+            entries.append(ENTRY.pack(offset, len(encoded_name),
+                    offset + len(encoded_name), len(data)))
+            blobs.append(encoded_name)
+            blobs.append(data)
+            offset += len(encoded_name) + len(data)
+
+    tmp_name = "%s.tmp.%d" % (filename, os.getpid())
+    with open(tmp_name, "wb") as fout:
+        fout.write("".join(header))
+        fout.write("".join(entries))
+        fout.write("".join(blobs))
+    os.rename(tmp_name, filename)
+
+
+# Work out the layout of every histogram in a Histograms.json, in the form
+# that write_store takes.
+def compile_definitions(histograms):
+    from histogram_tools import Histogram, DefinitionException
+    table = dict()
+    for name, definition in histograms.iteritems():
+        try:
+            histogram = Histogram(name, definition)
+        except (DefinitionException, KeyError), e:
+            table[name] = (None, None, None, str(e))
+            continue
+        try:
+            n_buckets = int(histogram.n_buckets())
+        except ValueError:
+            table[name] = (None, None, None, None)
+            continue
+        try:
+            ranges = list(histogram.ranges())
+            error = None
+        except DefinitionException, e:
+            ranges = None
+            error = "Could not find ranges for histogram: %s: %s" % (name, e)
+        table[name] = (n_buckets, ranges, error, None)
+    return table
+
+
+def build_store(cache, filename):
+    """Compile every Histograms.json in a RevisionCache directory (including
+    the indexes of prefetched repositories) into a store file. Returns the
+    number of (tables, revisions) written."""
+    tables = dict()
+    revisions = dict()
+    content_revisions = dict()
+    for repo, revision, json_path in cache.cached_revisions():
+        with open(json_path, "r") as f:
+            histograms_json = f.read()
+        content_hash = hashlib.sha1(histograms_json).hexdigest()
+        if content_hash not in tables:
+            tables[content_hash] = compile_definitions(json.loads(histograms_json))
+        revisions[(repo, revision)] = content_hash
+        content_revisions[(repo, revision[:SHORT_REVISION_LENGTH])] = content_hash
+
+    for repo in set(repo for repo, revision in content_revisions):
+        for indexed, content_revision in cache.get_index(repo).iteritems():
+            content_hash = content_revisions.get((repo, content_revision))
+            if content_hash is not None:
+                revisions[(repo, indexed)] = content_hash
+
+    write_store(filename, tables, revisions)
+    return len(tables), len(revisions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a shared histogram layout store from a histogram revision cache.")
+    parser.add_argument("-c", "--cache-dir", help="Histogram revision cache directory", required=True)
+    parser.add_argument("-o", "--output", help="Store file to write", required=True)
+    args = parser.parse_args()
+
+    cache = RevisionCache(args.cache_dir, None)
+    n_tables, n_revisions = build_store(cache, args.output)
+    print "Wrote {0} distinct Histograms.json for {1} revisions to {2}".format(
+            n_tables, n_revisions, args.output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,6 +7,7 @@
 
 import os
 import io
+import shutil
 import sys
 try:
     import simplejson as json
@@ -14,7 +15,126 @@ except ImportError:
     import json
 import time
 import logging
+from uuid import uuid4
 import telemetry.util.files as fileutil
+from telemetry.util.compress import CompressedFile
+from telemetry.util.lru import LRUCache
+
+
+class OutputFile:
+    """An open, buffered append handle on one output file, as kept in
+    StorageLayout's pool of open files.
+
+    Buffered records are written with a single write() on an O_APPEND
+    descriptor, so other processes appending to the same file never split a
+    record. The size of the file (as of the last write, plus anything still
+    buffered) is tracked without asking the OS for every record.
+
+    A writer that died part way through a write leaves a file that doesn't
+    end in a newline. That is detected when the file is opened, and the
+    partial record is terminated so it can't run into the next one.
+
+    If shared is False, nothing else writes to (or rotates) the file, so
+    there's no need to check whether it has been rotated before each write."""
+    def __init__(self, filename, buffer_size, shared=True):
+        self.filename = filename
+        self._buffer_size = buffer_size
+        self._shared = shared
+        self._pending = []
+        self.pending_bytes = 0
+        # When the oldest buffered record was written.
+        self.pending_since = None
+        self.open()
+
+    def open(self):
+        self._fd = os.open(self.filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        st = os.fstat(self._fd)
+        self._inode = (st.st_dev, st.st_ino)
+        self.size = st.st_size + self.pending_bytes
+        if st.st_size > 0:
+            os.lseek(self._fd, st.st_size - 1, os.SEEK_SET)
+            if os.read(self._fd, 1) != "\n":
+                logging.warn("Found a partially written record at the end of %s" % (self.filename))
+                self._pending.insert(0, "\n")
+                self.pending_bytes += 1
+                self.size += 1
+
+    def write(self, data, now=None):
+        if self.pending_since is None:
+            self.pending_since = now
+        self._pending.append(data)
+        self.pending_bytes += len(data)
+        self.size += len(data)
+        if self.pending_bytes >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        if self._shared:
+            # Another process may have rotated the file since we opened it,
+            # in which case our descriptor points at a file that is about to
+            # be compressed.
+            try:
+                st = os.stat(self.filename)
+                current = (st.st_dev, st.st_ino)
+            except OSError:
+                current = None
+            if current != self._inode:
+                os.close(self._fd)
+                self.open()
+        data = "".join(self._pending)
+        self._pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+        self.size = os.fstat(self._fd).st_size
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            os.close(self._fd)
+
+
+class CompressedOutputFile(OutputFile):
+    """Like OutputFile, but compresses records straight into a new file of
+    its own instead of appending to a file shared with other writers.
+
+    The file is written under a temporary name, and renamed to final_name
+    (ready to upload) when it is closed. size counts uncompressed bytes, and
+    compressed_size is the size on disk as of the last flush."""
+    def __init__(self, final_name, buffer_size, compression_level=None):
+        self.final_name = final_name
+        self._compression_level = compression_level
+        self.compressed_size = 0
+        OutputFile.__init__(self, final_name + StorageLayout.PARTIAL_SUFFIX,
+                buffer_size)
+
+    def open(self):
+        self._stream = CompressedFile(self.filename, mode="w",
+                compression_type="lzma",
+                compression_level=self._compression_level, open_now=True)
+        self.size = self.pending_bytes
+
+    def flush(self):
+        if not self._pending:
+            return
+        data = "".join(self._pending)
+        self._pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        self._stream.write(data)
+        self.compressed_size = os.path.getsize(self.filename)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._stream.close()
+        os.rename(self.filename, self.final_name)
 
 
 class StorageLayout:
@@ -28,16 +148,113 @@ class StorageLayout:
     DECOMPRESSION_ARGS = ["--decompress", "--stdout"]
 
     PENDING_COMPRESSION_SUFFIX = ".compressme"
+    # Compressed output files that are still being written.
+    PARTIAL_SUFFIX = ".partial"
+    # Output files written by a single writer, see merge_shards.
+    SHARD_SUFFIX = ".shard"
+    COMPRESSION_LEVEL = 1
+    # Buffer up to this many bytes per open file when keeping files open.
+    WRITE_BUFFER_SIZE = 65536
 
-    def __init__(self, schema, basedir, max_log_size):
+    # If max_open_files is set, keep up to that many output files open (and
+    # buffered) between writes instead of opening the file for every record.
+    # Each file's records are written out once it has flush_bytes of them,
+    # once the oldest is max_age seconds old, or when all the files together
+    # buffer more than max_buffer_bytes (whichever comes first). Call close()
+    # to flush them. The pool must be empty when forking, since the children
+    # would otherwise write out the same buffered records.
+    #
+    # If compress is set as well, write() compresses each partition straight
+    # into a file of its own, which is finished (ready to upload, with a name
+    # ending in COMPRESSED_SUFFIX) when it reaches max_log_size bytes before
+    # compression or max_compressed_size bytes after, or is closed.
+    #
+    # If sharded is set, write() gives each writer (see set_writer_id) its
+    # own shard of each partition instead of appending to a file shared with
+    # other processes. Each shard is rotated on its own, and whatever is
+    # left of them is combined by merge_shards once writing is done.
+    def __init__(self, schema, basedir, max_log_size, max_open_files=None,
+            flush_bytes=WRITE_BUFFER_SIZE, max_age=None, max_buffer_bytes=None,
+            compress=False, max_compressed_size=None, sharded=False):
         self._max_log_size = max_log_size
         self._schema = schema
         self._basedir = basedir
+        if compress and not max_open_files:
+            raise ValueError("Compressed output requires max_open_files")
+        self._compress = compress
+        self._max_compressed_size = max_compressed_size
+        self._sharded = sharded
+        self._writer_id = None
+        self._files = None
+        if max_open_files:
+            # filename => OutputFile
+            self._files = LRUCache(max_entries=max_open_files,
+                    on_evict=self.evicted)
+            # Directories we know exist.
+            self._dirs = set()
+            self._flush_bytes = flush_bytes
+            self._max_age = max_age
+            self._max_buffer_bytes = max_buffer_bytes
+            # Bytes buffered in all the open files.
+            self._buffered = 0
+            self._next_age_check = 0
 
     def write(self, uuid, obj, dimensions, version=1):
         filename = self._schema.get_filename(self._basedir, dimensions, version)
+        if self._compress:
+            return self.write_pooled(uuid, obj, filename, compress=True)
+        if self._sharded:
+            filename = self.get_shard_filename(filename)
+            if self._files is not None:
+                return self.write_pooled(uuid, obj, filename, shared=False)
         return self.write_filename(uuid, obj, filename)
 
+    # Name the shards written from now on after writer_id, which must be
+    # unique among the processes writing to basedir (and can't contain
+    # dots). Defaults to the process id.
+    def set_writer_id(self, writer_id):
+        self._writer_id = writer_id
+
+    def get_shard_filename(self, filename):
+        writer_id = self._writer_id
+        if writer_id is None:
+            writer_id = os.getpid()
+        return "%s.%s%s" % (filename, writer_id, self.SHARD_SUFFIX)
+
+    def merge_shards(self):
+        """Combine the shards of each partition under basedir into the
+        partition's .log file, so they are compressed and uploaded as one
+        file. Only call this when nothing is writing to basedir. Returns the
+        names of the merged files."""
+        shards = {}
+        for root, dirs, files in os.walk(self._basedir):
+            for f in files:
+                if f.endswith(self.SHARD_SUFFIX):
+                    # Strip the writer id and suffix.
+                    filename = f[:-len(self.SHARD_SUFFIX)].rsplit(".", 1)[0]
+                    shards.setdefault(os.path.join(root, filename), []).append(
+                            os.path.join(root, f))
+        for filename, parts in shards.iteritems():
+            for part in sorted(parts):
+                if not os.path.exists(filename):
+                    # Usually the only shard, so no copying is needed.
+                    os.rename(part, filename)
+                    continue
+                with open(filename, "rb+") as fout:
+                    # Don't let a partial record run into the next shard.
+                    fout.seek(0, os.SEEK_END)
+                    if fout.tell() > 0:
+                        fout.seek(-1, os.SEEK_END)
+                        if fout.read(1) != "\n":
+                            logging.warn("Found a partially written record at the end of %s" % (filename))
+                            fout.seek(0, os.SEEK_END)
+                            fout.write("\n")
+                    fout.seek(0, os.SEEK_END)
+                    with open(part, "rb") as fin:
+                        shutil.copyfileobj(fin, fout, 1024 * 1024)
+                os.remove(part)
+        return sorted(shards)
+
     def clean_newlines(self, value, tag="value"):
         # Clean any newlines (replace with spaces)
         for eol in ["\r", "\n"]:
@@ -50,6 +267,8 @@ class StorageLayout:
         # Working filename is like
         #   a.b.c.log
         # We want to roll this over (and compress) when it reaches a size limit
+        if self._files is not None:
+            return self.write_pooled(uuid, obj, filename)
 
         if isinstance(obj, basestring):
             jsonstr = self.clean_newlines(unicode(obj), obj)
@@ -75,6 +294,106 @@ class StorageLayout:
         else:
             return filename
 
+    # Like write_filename, using the pool of open files. Returns the name of
+    # the finished file if this record completed one.
+    def write_pooled(self, uuid, obj, filename, compress=False, shared=True):
+        if isinstance(obj, basestring):
+            jsonstr = self.clean_newlines(obj, obj)
+        else:
+            # Use minimal json (without excess spaces)
+            jsonstr = json.dumps(obj, separators=(',', ':'))
+        if isinstance(uuid, unicode):
+            uuid = uuid.encode("utf-8")
+        if isinstance(jsonstr, unicode):
+            jsonstr = jsonstr.encode("utf-8")
+
+        output = self._files.get(filename)
+        if output is None:
+            dirname = os.path.dirname(filename)
+            if dirname != '' and dirname not in self._dirs:
+                if not os.path.exists(dirname):
+                    fileutil.makedirs_concurrent(dirname)
+                self._dirs.add(dirname)
+            if compress:
+                output = CompressedOutputFile("%s.%s%s" % (filename,
+                        uuid4().hex, self.COMPRESSED_SUFFIX),
+                        self._flush_bytes, self.COMPRESSION_LEVEL)
+            else:
+                output = OutputFile(filename, self._flush_bytes, shared)
+            self._buffered += output.pending_bytes
+            self._files.put(filename, output)
+        now = None
+        if self._max_age is not None:
+            now = time.time()
+        before = output.pending_bytes
+        output.write("%s\t%s\n" % (uuid, jsonstr), now)
+        self._buffered += output.pending_bytes - before
+
+        # The size includes what is still buffered, so rotation doesn't need
+        # to wait for a flush.
+        if self.is_full(output):
+            self._files.pop(filename)
+            self._buffered -= output.pending_bytes
+            output.close()
+            if compress:
+                filename = output.final_name
+            else:
+                filename = self.rotate(filename)
+
+        if self._max_buffer_bytes is not None and self._buffered > self._max_buffer_bytes:
+            self.flush_largest(self._max_buffer_bytes // 2)
+        if now is not None and now >= self._next_age_check:
+            self.flush_expired(now)
+        return filename
+
+    def is_full(self, output):
+        if output.size >= self._max_log_size:
+            return True
+        if self._max_compressed_size is not None and \
+                isinstance(output, CompressedOutputFile):
+            return output.compressed_size >= self._max_compressed_size
+        return False
+
+    # Flush the files with the most buffered data until no more than target
+    # bytes are buffered in total.
+    def flush_largest(self, target):
+        outputs = sorted((output for filename, output in self._files.items()),
+                key=lambda output: output.pending_bytes, reverse=True)
+        for output in outputs:
+            if self._buffered <= target:
+                break
+            self._buffered -= output.pending_bytes
+            output.flush()
+
+    # Flush the files whose oldest buffered record is older than max_age.
+    def flush_expired(self, now=None):
+        if self._files is None or self._max_age is None:
+            return
+        if now is None:
+            now = time.time()
+        cutoff = now - self._max_age
+        for filename, output in self._files.items():
+            if output.pending_since is not None and output.pending_since <= cutoff:
+                self._buffered -= output.pending_bytes
+                output.flush()
+        # Don't look through all the files again for a while.
+        self._next_age_check = now + self._max_age / 4.0
+
+    def evicted(self, filename, output):
+        logging.debug("Closing %s" % (filename))
+        self._buffered -= output.pending_bytes
+        output.close()
+
+    # Flush and close any files kept open between writes.
+    def close(self):
+        if self._files is None:
+            return
+        outputs = [output for filename, output in self._files.items()]
+        self._files.clear()
+        self._buffered = 0
+        for output in outputs:
+            output.close()
+
     def rotate(self, filename):
         logging.debug("Rotating %s" % (filename))
 
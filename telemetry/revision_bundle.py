@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Pack the contents of a RevisionCache directory into a single file, so new
+# machines can start with a warm cache instead of fetching every revision of
+# Histograms.json from hg.mozilla.org.
+#
+# Each distinct Histograms.json is compressed separately, so a bundle can be
+# read in place (see RevisionCache's bundle argument) as well as imported
+# into a cache directory. Exporting to an existing bundle only appends the
+# revisions it doesn't have yet.
+#
+# File format:
+#   header:  magic, format version
+#   blobs:   zlib-compressed Histograms.json contents
+#   index:   zlib-compressed JSON of
+#              {"contents": {content hash: [offset, length]},
+#               "files": {repo: {revision: content hash}},
+#               "indexes": {repo: {revision: revision of its Histograms.json}}}
+#            where "indexes" are the indexes of prefetched repositories.
+#   trailer: index offset, index length, magic
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import zlib
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from revision_cache import RevisionCache, SHORT_REVISION_LENGTH
+
+MAGIC = "THRB"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sI")
+TRAILER = struct.Struct("<QQ4s")
+
+
+class RevisionBundle:
+    """Reads Histograms.json revisions from a bundle file in place"""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version = HEADER.unpack_from(self._data, 0)
+            index_offset, index_length, trailer_magic = TRAILER.unpack_from(
+                    self._data, len(self._data) - TRAILER.size)
+        except struct.error:
+            raise ValueError("Not a revision bundle: %s" % filename)
+        if magic != MAGIC or trailer_magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a revision bundle: %s" % filename)
+        index = json.loads(zlib.decompress(
+                self._data[index_offset:index_offset + index_length]))
+        self.index_offset = index_offset
+        self.contents = index["contents"]
+        self.files = index["files"]
+        self.indexes = index["indexes"]
+
+    def close(self):
+        self._data.close()
+
+    # Returns the content hash of the Histograms.json for a revision, or
+    # None if the bundle doesn't have it.
+    def get_content_hash(self, repo, revision):
+        files = self.files.get(repo)
+        if files is None:
+            return None
+        content_hash = files.get(revision)
+        if content_hash is None:
+            content_revision = self.indexes.get(repo, {}).get(revision[:SHORT_REVISION_LENGTH])
+            if content_revision is not None:
+                content_hash = files.get(content_revision)
+        return content_hash
+
+    def get_contents(self, content_hash):
+        offset, length = self.contents[content_hash]
+        return zlib.decompress(self._data[offset:offset + length])
+
+    def get_revision(self, repo, revision):
+        content_hash = self.get_content_hash(repo, revision)
+        if content_hash is None:
+            return None
+        return self.get_contents(content_hash)
+
+
+def export_bundle(cache, filename, level=9):
+    """Pack every revision in a RevisionCache directory into a bundle. If the
+    bundle already exists, only revisions it doesn't have are added.
+    Returns the number of Histograms.json files added."""
+    contents = dict()
+    files = dict()
+    indexes = dict()
+    if os.path.exists(filename):
+        bundle = RevisionBundle(filename)
+        contents = bundle.contents
+        files = bundle.files
+        indexes = bundle.indexes
+        offset = bundle.index_offset
+        bundle.close()
+        # Write to a copy, so that readers of the old bundle are unaffected.
+        # The new blobs replace the old index and trailer.
+        tmp_name = "%s.tmp.%d" % (filename, os.getpid())
+        with open(filename, "rb") as fin:
+            with open(tmp_name, "wb") as fout:
+                remaining = offset
+                while remaining > 0:
+                    chunk = fin.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        raise ValueError("Truncated revision bundle: %s" % filename)
+                    fout.write(chunk)
+                    remaining -= len(chunk)
+    else:
+        tmp_name = "%s.tmp.%d" % (filename, os.getpid())
+        with open(tmp_name, "wb") as fout:
+            fout.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+        offset = HEADER.size
+
+    added = 0
+    with open(tmp_name, "ab") as fout:
+        for repo, revision, path in cache.cached_revisions():
+            repo_files = files.setdefault(repo, {})
+            if revision in repo_files:
+                continue
+            with open(path, "rb") as f:
+                histograms_json = f.read()
+            content_hash = hashlib.sha1(histograms_json).hexdigest()
+            if content_hash not in contents:
+                blob = zlib.compress(histograms_json, level)
+                fout.write(blob)
+                contents[content_hash] = [offset, len(blob)]
+                offset += len(blob)
+                added += 1
+            repo_files[revision] = content_hash
+
+        for repo in cache.indexed_repos():
+            indexes[repo] = cache.get_index(repo)
+
+        index = zlib.compress(json.dumps({
+            "contents": contents,
+            "files": files,
+            "indexes": indexes
+        }, separators=(',', ':')), level)
+        fout.write(index)
+        fout.write(TRAILER.pack(offset, len(index), MAGIC))
+    os.rename(tmp_name, filename)
+    return added
+
+
+def import_bundle(bundle, cache):
+    """Write every revision in a bundle into a RevisionCache directory, along
+    with the indexes of prefetched repositories. Revisions already in the
+    cache are left alone. Returns the number of revisions written."""
+    written = 0
+    for repo, repo_files in bundle.files.iteritems():
+        for revision, content_hash in repo_files.iteritems():
+            if os.path.exists(cache.get_cache_filename(repo, revision)):
+                continue
+            cache.save_to_cache(repo, revision, bundle.get_contents(content_hash))
+            written += 1
+    for repo, index in bundle.indexes.iteritems():
+        merged = dict(cache.get_index(repo))
+        merged.update(index)
+        cache.save_index(repo, merged)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a histogram revision cache to a bundle file, or import one.")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("-c", "--cache-dir", help="Histogram revision cache directory", required=True)
+    parser.add_argument("-b", "--bundle", help="Bundle file", required=True)
+    args = parser.parse_args()
+
+    cache = RevisionCache(args.cache_dir, None)
+    if args.action == "export":
+        added = export_bundle(cache, args.bundle)
+        print "Added {0} Histograms.json files to {1}".format(added, args.bundle)
+    else:
+        bundle = RevisionBundle(args.bundle)
+        written = import_bundle(bundle, cache)
+        bundle.close()
+        print "Imported {0} revisions into {1}".format(written, args.cache_dir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
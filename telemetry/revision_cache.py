@@ -7,54 +7,262 @@ try:
 except ImportError:
     import json
 import sys
+import hashlib
 import logging
+import marshal
+import argparse
+import fcntl
+import httplib
 import os
 import re
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
 import urllib2
 import telemetry.util.files as fu
+from telemetry.util.lru import LRUCache
+
+# Revisions in revision URLs are abbreviated to this many hex digits.
+SHORT_REVISION_LENGTH = 12
+NULL_REVISION = "0" * SHORT_REVISION_LENGTH
+
+# Bug 920169 - replace calculated values/constants with their actual values.
+def fix_histograms_json(histograms_json):
+    histograms_json = histograms_json.replace('"JS::gcreason::NUM_TELEMETRY_REASONS"', "101")
+    histograms_json = histograms_json.replace('"mozilla::StartupTimeline::MAX_EVENT_ID"', "12")
+    histograms_json = histograms_json.replace('"80 + 1"', "81")
+    return histograms_json
+
+
+# The fields of a histogram definition that determine its bucket layout.
+LAYOUT_FIELDS = ("kind", "low", "high", "n_buckets", "n_values")
+
+def histogram_fingerprint(definition):
+    """A hashable summary of the parts of a histogram definition that its
+    bucket layout depends on. Definitions with equal fingerprints have the
+    same buckets."""
+    return tuple(definition.get(field) for field in LAYOUT_FIELDS)
+
+
+# Format of the pre-parsed Histograms.json files. Bump this whenever their
+# contents change.
+PARSED_FORMAT = 1
+PARSED_MAGIC = "telemetry-histograms"
+PARSED_SUFFIX = ".bin"
+
+
+class HgHistory:
+    """The history of a file in a local mercurial repository (a mirror, or
+    a bundle file created with "hg bundle --all"), read with the hg command
+    line tool. Anything with the same three methods can be passed to
+    RevisionCache.prefetch instead."""
+
+    def __init__(self, path, hg="hg"):
+        self._path = path
+        self._hg = hg
+
+    def run(self, *args):
+        return subprocess.check_output((self._hg, "-R", self._path) + args)
+
+    # Yields (revision, first parent, second parent) for every changeset in
+    # the repository, parents first.
+    def changesets(self):
+        out = self.run("log", "-r", "0:tip", "--template",
+                "{node|short} {p1node|short} {p2node|short}\n")
+        for line in out.splitlines():
+            yield tuple(line.split())
+
+    # The set of changesets that modified the given file.
+    def touched(self, filepath):
+        out = self.run("log", "-r", "file('path:%s')" % filepath,
+                "--template", "{node|short}\n")
+        return set(out.split())
+
+    def cat(self, revision, filepath):
+        return self.run("cat", "-r", revision, filepath)
+
 
-# TODO:
-# [ ] Pre-fetch (and cache) all revisions of Histograms.json using something like:
-#      https://hg.mozilla.org/mozilla-central/log/tip/toolkit/components/telemetry/Histograms.json
-#      https://hg.mozilla.org/releases/mozilla-aurora/log/tip/toolkit/components/telemetry/Histograms.json
-#      https://hg.mozilla.org/releases/mozilla-beta/log/tip/toolkit/components/telemetry/Histograms.json
-#      https://hg.mozilla.org/releases/mozilla-release/log/tip/toolkit/components/telemetry/Histograms.json
-#     then link other repository revisions to the relevant Histograms.json revision.
 class RevisionCache:
-    """A class for fetching and caching revisions of a file in mercurial"""
+    """A class for fetching and caching revisions of a file in mercurial
 
-    def __init__(self, cache_dir, server):
+    Use prefetch() to load the complete history of Histograms.json for a
+    repository ahead of time. After that, any revision of that repository is
+    resolved from the local cache. A bundle of a whole cache directory (see
+    revision_bundle.py) can also be read in place. Pass server=None to never
+    go to the network at all.
+
+    Revisions that can't be fetched from the server are not retried until
+    the TTL for that kind of failure (see NEGATIVE_TTLS) has passed. Failures
+    are remembered in memory and on disk, so other processes using the same
+    cache directory don't retry them either.
+
+    The cache can be shared between threads. Only one thread (and, through
+    a lock file, only one process using the same cache directory) fetches a
+    given revision at a time; the others wait for its result."""
+    # Seconds to remember each kind of failure for.
+    NEGATIVE_TTLS = {
+        # No such repository or revision
+        "not_found": 24 * 60 * 60,
+        # The server returned something that isn't valid JSON
+        "bad_content": 24 * 60 * 60,
+        # The revision or repository doesn't make a valid URL
+        "bad_url": 24 * 60 * 60,
+        # Any other HTTP error status
+        "http_error": 10 * 60,
+        # Connection failures, timeouts, etc.
+        "network": 60,
+        "other": 10 * 60
+    }
+    NEGATIVE_CACHE_SIZE = 10000
+    # Failures and lock files are kept on disk in at most
+    # 16 ** FLAT_HASH_CHARS files each, named by a prefix of the hash of the
+    # repo and revision, so that revisions which don't exist don't leave
+    # directories behind.
+    FLAT_HASH_CHARS = 4
+
+    def __init__(self, cache_dir, server, negative_ttls=None, bundle=None):
         self._cache_dir = cache_dir
         self._server = server
+        # Revisions that aren't in the cache directory are read from this
+        # revision_bundle.RevisionBundle, if there is one.
+        self._bundle = bundle
         self._repos = dict()
+        # (repo, revision) => (kind of failure, time of the failure)
+        self._failures = LRUCache(max_entries=RevisionCache.NEGATIVE_CACHE_SIZE)
+        self._negative_ttls = dict(RevisionCache.NEGATIVE_TTLS)
+        if negative_ttls:
+            self._negative_ttls.update(negative_ttls)
+        self._negative_hits = 0
+        self._negative_misses = 0
+        # kind of failure => number of failed fetches
+        self._failure_counts = dict()
+        # Protects the dicts above, and _in_flight.
+        self._lock = threading.Lock()
+        # (repo, revision) => [lock held while fetching it, number of users]
+        self._in_flight = dict()
+        # repo => {revision: revision of the Histograms.json in effect}, for
+        # prefetched repositories.
+        self._indexes = dict()
+        # content hash => {histogram name: bucket ranges}, for pre-parsed
+        # files that include them.
+        self._ranges = dict()
+        # Many revisions share a byte-identical Histograms.json, so only keep
+        # one copy of each distinct file, keyed by the hash of its contents.
+        self._contents = dict()
+        self._content_hashes = dict()
         self._hist_filename = "Histograms.json"
         self._hist_filepath = "toolkit/components/telemetry/" + self._hist_filename
         self._valid_revisions = re.compile('^(http[s]?://[^/]+)/(.+)/rev/([0-9a-f]+)/?$')
+        self._valid_revision_ids = re.compile('^[0-9a-f]+$')
 
     # TODO:
     #  [ ] deal with 'tip' and other named revisions / tags (fetch from source
     #      with no local cache?)
     def get_revision(self, repo, revision, parse=True):
-        if repo not in self._repos:
-            self._repos[repo] = dict()
+        cached_repo = self._repos.get(repo)
+        if cached_repo is not None:
+            cached_revision = cached_repo.get(revision)
+            if cached_revision is not None:
+                return cached_revision
 
-        cached_repo = self._repos[repo]
+        # The repo and revision come from pings, and name paths under the
+        # cache directory.
+        if not self.is_valid_revision(repo, revision):
+            logging.info("refusing to load invalid revision '%s' of '%s'\n" % (revision, repo))
+            return None
+        if cached_repo is None:
+            cached_repo = self._repos.setdefault(repo, dict())
 
-        cached_revision = None
-        if revision not in cached_repo:
+        with self.fetching(repo, revision):
+            # Another thread may have fetched it while we waited.
+            cached_revision = cached_repo.get(revision)
+            if cached_revision is not None:
+                return cached_revision
+            if self.failed_recently(repo, revision):
+                self._negative_hits += 1
+                return None
             # Fetch it from disk cache
             cached_revision = self.fetch_disk(repo, revision, parse)
+            if not cached_revision:
+                # Look it up in the prefetched history
+                cached_revision = self.fetch_index(repo, revision, parse)
+            if not cached_revision and self._bundle is not None:
+                cached_revision = self.fetch_bundle(repo, revision, parse)
+            if not cached_revision and self._server is not None:
+                with self.lock_file(repo, revision):
+                    # Another process may have fetched it while we waited.
+                    cached_revision = self.fetch_disk(repo, revision, parse)
+                    if not cached_revision:
+                        if self.failed_recently(repo, revision, check_disk=True):
+                            self._negative_hits += 1
+                            return None
+                        self._negative_misses += 1
+                        # Fetch it from the server
+                        cached_revision = self.fetch_server(repo, revision, parse)
             if cached_revision:
                 cached_repo[revision] = cached_revision
-            else:
-                # Fetch it from the server
-                cached_revision = self.fetch_server(repo, revision, parse)
-                if cached_revision:
-                    cached_repo[revision] = cached_revision
-        else:
-            cached_revision = cached_repo[revision]
         return cached_revision
 
+    # Hold the lock for fetching a revision in this process.
+    @contextmanager
+    def fetching(self, repo, revision):
+        key = (repo, revision)
+        with self._lock:
+            entry = self._in_flight.get(key)
+            if entry is None:
+                entry = self._in_flight[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._in_flight[key]
+
+    # Hold the lock for fetching a revision from the server, across all the
+    # processes using this cache directory. If the lock can't be taken (for
+    # example because the cache directory isn't writable), fetch without it.
+    @contextmanager
+    def lock_file(self, repo, revision):
+        # Revisions that share a lock file are fetched one at a time, which
+        # is harmless.
+        filename = self.get_flat_filename(".locks", repo, revision)
+        f = None
+        try:
+            try:
+                f = open(filename, "a")
+            except IOError:
+                fu.makedirs_concurrent(os.path.dirname(filename))
+                f = open(filename, "a")
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except (IOError, OSError), e:
+            logging.info("fetching without lock file '%s': %s\n" % (filename, e))
+            if f is not None:
+                f.close()
+                f = None
+        try:
+            yield
+        finally:
+            # Closing the file releases the lock.
+            if f is not None:
+                f.close()
+
+    # Check that a repository and revision can be used to name files in the
+    # cache directory: the revision must be hex, and the repository a
+    # relative path that stays inside the cache directory.
+    def is_valid_revision(self, repo, revision):
+        if not self._valid_revision_ids.match(revision):
+            return False
+        if not repo or repo.startswith("/") or "\\" in repo:
+            return False
+        for part in repo.split("/"):
+            if part in ("", ".", ".."):
+                return False
+        return True
+
     # Returns (repository name, revision)
     def revision_url_to_parts(self, revision_url):
         m = self._valid_revisions.match(revision_url)
@@ -76,51 +284,340 @@ class RevisionCache:
         repo, revision = self.revision_url_to_parts(revision_url)
         return self.get_revision(repo, revision, parse)
 
-    def fetch_disk(self, repo, revision, parse=True):
-        filename = os.path.join(self._cache_dir, repo, revision, self._hist_filename)
-        histograms = None
-        try:
-            f = open(filename, "r")
+    # Returns the hash of the Histograms.json contents for the given revision,
+    # or None if that revision hasn't been loaded.
+    def get_content_hash(self, revision_url):
+        repo, revision = self.revision_url_to_parts(revision_url)
+        return self._content_hashes.get((repo, revision))
+
+    def intern(self, repo, revision, histograms_json, parse=True):
+        content_hash = hashlib.sha1(histograms_json).hexdigest()
+        key = (content_hash, parse)
+        histograms = self._contents.get(key)
+        if histograms is None:
             if parse:
-                histograms = json.load(f)
+                histograms = json.loads(histograms_json)
                 # TODO: validate the resulting obj.
             else:
-                histograms = f.read()
+                histograms = histograms_json
+            self._contents[key] = histograms
+        # Only once it has parsed, so a bad file doesn't get a content hash.
+        self._content_hashes[(repo, revision)] = content_hash
+        return histograms
+
+    # Like intern, for definitions that have already been parsed.
+    def intern_parsed(self, repo, revision, content_hash, histograms):
+        self._content_hashes[(repo, revision)] = content_hash
+        key = (content_hash, True)
+        return self._contents.setdefault(key, histograms)
+
+    # Returns the precomputed bucket ranges of each histogram for the given
+    # content hash (see get_content_hash), or None if there aren't any.
+    def get_ranges(self, content_hash):
+        return self._ranges.get(content_hash)
+
+    def get_cache_filename(self, repo, revision):
+        return os.path.join(self._cache_dir, repo, revision, self._hist_filename)
+
+    def fetch_disk(self, repo, revision, parse=True, content_revision=None):
+        if content_revision is None:
+            content_revision = revision
+        filename = self.get_cache_filename(repo, content_revision)
+        histograms = None
+        if parse:
+            histograms = self.fetch_parsed(repo, revision, filename)
+            if histograms is not None:
+                return histograms
+        try:
+            with open(filename, "r") as f:
+                histograms = self.intern(repo, revision, f.read(), parse)
         except:
             # TODO: log an info / debug message
             #sys.stderr.write("INFO: failed to load '%s' from disk cache\n" % filename)
             pass
+        if parse and histograms is not None:
+            # Next time, skip the JSON parsing.
+            self.save_parsed(filename, self._content_hashes[(repo, revision)],
+                    histograms)
         return histograms
 
+    # Load the pre-parsed form of a cached Histograms.json, if it is
+    # present and up to date.
+    def fetch_parsed(self, repo, revision, filename):
+        try:
+            st = os.stat(filename)
+            with open(filename + PARSED_SUFFIX, "rb") as f:
+                header = f.readline().split()
+                if len(header) != 6 or header[0] != PARSED_MAGIC or \
+                        int(header[1]) != PARSED_FORMAT or \
+                        int(header[2]) != marshal.version or \
+                        int(header[3]) != st.st_size or \
+                        float(header[4]) != st.st_mtime:
+                    # Stale, or written by something else.
+                    return None
+                content_hash = header[5]
+                histograms, ranges = marshal.load(f)
+        except (IOError, OSError, ValueError, EOFError, TypeError):
+            return None
+        if ranges is not None:
+            self._ranges[content_hash] = ranges
+        return self.intern_parsed(repo, revision, content_hash, histograms)
+
+    # Store parsed definitions (and optionally their bucket ranges) next to
+    # the Histograms.json they came from. This is only an optimization, so
+    # failures are ignored.
+    def save_parsed(self, filename, content_hash, histograms, ranges=None):
+        try:
+            st = os.stat(filename)
+            header = "%s %d %d %d %r %s\n" % (PARSED_MAGIC, PARSED_FORMAT,
+                    marshal.version, st.st_size, st.st_mtime, content_hash)
+            self.write_file(filename + PARSED_SUFFIX,
+                    header + marshal.dumps((histograms, ranges)))
+        except (IOError, OSError, ValueError):
+            pass
+
+    def precompute_ranges(self, repo, revision):
+        """Compute the bucket ranges of every histogram in a cached revision
+        and store them in its pre-parsed file, so that converters don't
+        need to compute them again. Returns the number of histograms."""
+        # Only needed here, and histogram_tools comes from a separate
+        # download (bin/get_histogram_tools.sh).
+        from histogram_tools import Histogram
+        filename = self.get_cache_filename(repo, revision)
+        with open(filename, "r") as f:
+            histograms_json = f.read()
+        content_hash = hashlib.sha1(histograms_json).hexdigest()
+        histograms = json.loads(histograms_json)
+        ranges = dict()
+        for name, definition in histograms.iteritems():
+            try:
+                ranges[name] = Histogram(name, definition).ranges()
+            except Exception:
+                # Converters report bad definitions themselves.
+                pass
+        self.save_parsed(filename, content_hash, histograms, ranges)
+        self._ranges[content_hash] = ranges
+        return len(ranges)
+
+    def fetch_bundle(self, repo, revision, parse=True):
+        histograms_json = self._bundle.get_revision(repo, revision)
+        if histograms_json is None:
+            return None
+        return self.intern(repo, revision, histograms_json, parse)
+
     def fetch_server(self, repo, revision, parse=True):
         url = '/'.join(('https:/', self._server, repo, 'raw-file', revision, self._hist_filepath))
         histograms = None
+        histograms_json = None
+        failure = None
         try:
             response = urllib2.urlopen(url)
-            histograms_json = response.read()
-            # Bug 920169 - replace calculated values/constants with their
-            #              actual values:
-            histograms_json = histograms_json.replace('"JS::gcreason::NUM_TELEMETRY_REASONS"', "101")
-            histograms_json = histograms_json.replace('"mozilla::StartupTimeline::MAX_EVENT_ID"', "12")
-            histograms_json = histograms_json.replace('"80 + 1"', "81")
-            if parse:
-                histograms = json.loads(histograms_json)
-                # TODO: validate the resulting obj.
+            histograms_json = fix_histograms_json(response.read())
+            histograms = self.intern(repo, revision, histograms_json, parse)
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                failure = "not_found"
             else:
-                histograms = histograms_json
+                failure = "http_error"
+        except (urllib2.URLError, IOError, httplib.HTTPException):
+            failure = "network"
+        except ValueError:
+            # Either from urlopen or from parsing the contents
+            if histograms_json is None:
+                failure = "bad_url"
+            else:
+                failure = "bad_content"
+        except Exception:
+            failure = "other"
+
+        if failure is not None:
+            logging.info("failed to load '%s' from server (%s)\n" % (url, failure))
+            self.remember_failure(repo, revision, failure)
+            return None
+
+        try:
             self.save_to_cache(repo, revision, histograms_json)
-        except:
-            # TODO: better error handling
-            # TODO: cache 404s so we don't keep trying them
-            logging.info("failed to load '%s' from server\n" % url)
+        except (IOError, OSError), e:
+            logging.info("failed to save '%s' to disk cache: %s\n" % (url, e))
+            return histograms
+        if parse:
+            self.save_parsed(self.get_cache_filename(repo, revision),
+                    self._content_hashes[(repo, revision)], histograms)
         return histograms
 
+    def get_flat_filename(self, dirname, repo, revision):
+        key = hashlib.sha1("%s %s" % (repo, revision)).hexdigest()
+        return os.path.join(self._cache_dir, dirname,
+                key[:RevisionCache.FLAT_HASH_CHARS])
+
+    def get_failure_filename(self, repo, revision):
+        return self.get_flat_filename(".failures", repo, revision)
+
+    def remember_failure(self, repo, revision, kind):
+        failed_at = time.time()
+        with self._lock:
+            self._failure_counts[kind] = self._failure_counts.get(kind, 0) + 1
+            self._failures.put((repo, revision), (kind, failed_at))
+        try:
+            # Other revisions can share the file, so it names the revision
+            # too.
+            self.write_file(self.get_failure_filename(repo, revision),
+                    "%s %f\n%s %s\n" % (kind, failed_at, repo, revision))
+        except (IOError, OSError):
+            # We'll just try again from other processes.
+            pass
+
+    # Check if fetching this revision failed recently, optionally looking
+    # for failures recorded on disk by other processes too.
+    def failed_recently(self, repo, revision, check_disk=False):
+        key = (repo, revision)
+        with self._lock:
+            entry = self._failures.get(key)
+        if (entry is None or self.expired(entry)) and check_disk:
+            try:
+                with open(self.get_failure_filename(repo, revision), "r") as f:
+                    failure, failed_revision = f.read().split("\n")[:2]
+                if failed_revision == "%s %s" % (repo, revision):
+                    kind, failed_at = failure.split()
+                    entry = (kind, float(failed_at))
+                    with self._lock:
+                        self._failures.put(key, entry)
+            except (IOError, ValueError):
+                pass
+        return entry is not None and not self.expired(entry)
+
+    def expired(self, failure):
+        kind, failed_at = failure
+        return failed_at + self._negative_ttls.get(kind, 0) <= time.time()
+
+    def get_stats(self):
+        stats = {
+            "negative_entries": len(self._failures),
+            "negative_evictions": self._failures.evictions,
+            "negative_hits": self._negative_hits,
+            "negative_misses": self._negative_misses
+        }
+        for kind, count in self._failure_counts.iteritems():
+            stats["failed." + kind] = count
+        return stats
+
     def save_to_cache(self, repo, revision, contents):
-        filename = os.path.join(self._cache_dir, repo, revision, "Histograms.json")
+        self.write_file(self.get_cache_filename(repo, revision), contents)
+
+    # Write a file atomically, so that readers (in this or other processes)
+    # never see a partial file.
+    def write_file(self, filename, contents):
+        tmp_name = "%s.tmp.%d.%d" % (filename, os.getpid(), threading.current_thread().ident)
         try:
-            fout = open(filename, 'w')
+            fout = open(tmp_name, 'w')
         except IOError:
             fu.makedirs_concurrent(os.path.dirname(filename))
-            fout = open(filename, 'w')
-        fout.write(contents)
-        fout.close()
+            fout = open(tmp_name, 'w')
+        try:
+            fout.write(contents)
+            fout.close()
+            os.rename(tmp_name, filename)
+        except:
+            fout.close()
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+    def get_index_filename(self, repo):
+        return os.path.join(self._cache_dir, repo, self._hist_filename + ".index")
+
+    # Returns the index of a prefetched repository, or an empty one.
+    def get_index(self, repo):
+        index = self._indexes.get(repo)
+        if index is None:
+            index = dict()
+            try:
+                with open(self.get_index_filename(repo), "r") as f:
+                    for line in f:
+                        revision, content_revision = line.split()
+                        index[revision] = content_revision
+            except IOError:
+                # This repository hasn't been prefetched.
+                pass
+            self._indexes[repo] = index
+        return index
+
+    def fetch_index(self, repo, revision, parse=True):
+        content_revision = self.get_index(repo).get(revision[:SHORT_REVISION_LENGTH])
+        if content_revision is None:
+            return None
+        return self.fetch_disk(repo, revision, parse, content_revision)
+
+    def prefetch(self, repo, history):
+        """Load every revision of Histograms.json in the given history (see
+        HgHistory) into the disk cache, and index all revisions of the
+        repository by the revision of Histograms.json in effect for them.
+
+        A changeset uses the Histograms.json of its nearest first-parent
+        ancestor (or itself) that modified the file. A merge that takes the
+        file from its second parent isn't listed as modifying it, so merges
+        are only indexed when both parents use the same Histograms.json. The
+        others (and their descendants, up to the next change to the file)
+        are left to be fetched as usual. Returns the number of indexed
+        revisions."""
+        touched = history.touched(self._hist_filepath)
+        index = dict()
+        for revision, p1, p2 in history.changesets():
+            if revision in touched:
+                index[revision] = revision
+            elif p1 != NULL_REVISION and p1 in index:
+                if p2 == NULL_REVISION or index.get(p2) == index[p1]:
+                    index[revision] = index[p1]
+
+        for content_revision in set(index.itervalues()):
+            filename = self.get_cache_filename(repo, content_revision)
+            if not os.path.exists(filename):
+                contents = history.cat(content_revision, self._hist_filepath)
+                self.save_to_cache(repo, content_revision,
+                        fix_histograms_json(contents))
+
+        self.save_index(repo, index)
+        return len(index)
+
+    def save_index(self, repo, index):
+        lines = ["%s %s\n" % r for r in sorted(index.iteritems())]
+        self.write_file(self.get_index_filename(repo), "".join(lines))
+        self._indexes[repo] = index
+        # Forget what we looked up before, it may have been missing.
+        self._repos.pop(repo, None)
+
+    # Yields (repo, revision, filename) for every Histograms.json in the
+    # disk cache.
+    def cached_revisions(self):
+        for dirpath, dirnames, filenames in os.walk(self._cache_dir):
+            if self._hist_filename in filenames:
+                repo, revision = os.path.split(os.path.relpath(dirpath, self._cache_dir))
+                yield repo, revision, os.path.join(dirpath, self._hist_filename)
+
+    # The repositories that have been prefetched.
+    def indexed_repos(self):
+        for dirpath, dirnames, filenames in os.walk(self._cache_dir):
+            if self._hist_filename + ".index" in filenames:
+                yield os.path.relpath(dirpath, self._cache_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefetch the history of Histograms.json into a revision cache.")
+    parser.add_argument("-c", "--cache-dir", help="Histogram revision cache directory", required=True)
+    parser.add_argument("-r", "--repo", help="Repository name, as in revision URLs (such as releases/mozilla-beta)", required=True)
+    parser.add_argument("-m", "--mirror", help="Local mercurial mirror or bundle of the repository", required=True)
+    parser.add_argument("--hg", help="Mercurial command", default="hg")
+    parser.add_argument("--ranges", help="Also precompute the bucket ranges of all histograms", action="store_true")
+    args = parser.parse_args()
+
+    cache = RevisionCache(args.cache_dir, None)
+    count = cache.prefetch(args.repo, HgHistory(args.mirror, args.hg))
+    print "Indexed {0} revisions of {1}".format(count, args.repo)
+    if args.ranges:
+        for revision in sorted(set(cache.get_index(args.repo).itervalues())):
+            cache.precompute_ranges(args.repo, revision)
+        print "Precomputed bucket ranges"
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,17 +7,112 @@
 
 import re
 import os
+from telemetry.util.lru import LRUCache
+
+SAFE_FILENAME = re.compile(r'[^a-zA-Z0-9_/.]')
+
+
+# Matchers for the "allowed_values" of a dimension. The schema compiles each
+# dimension's allowed values once, rather than working out what kind of spec
+# it is for every record.
+class AnyValue(object):
+    """"*": anything is allowed"""
+    def matches(self, value):
+        return True
+
+
+class ValueSet(object):
+    """A list of allowed values, or a single string"""
+    def __init__(self, values):
+        self.values = frozenset(values)
+
+    def matches(self, value):
+        try:
+            return value in self.values
+        except TypeError:
+            # Unhashable, so not one of the allowed values.
+            return False
+
+
+class ValueRange(object):
+    """{"min": ..., "max": ...}, either of which may be left out"""
+    def __init__(self, spec):
+        self.has_min = "min" in spec
+        self.min = spec.get("min")
+        self.has_max = "max" in spec
+        self.max = spec.get("max")
+
+    def matches(self, value):
+        if self.has_min and value < self.min:
+            return False
+        if self.has_max and value > self.max:
+            return False
+        return True
+
+
+class ValuePattern(object):
+    """{"regex": ...}: values that match the whole pattern"""
+    def __init__(self, pattern):
+        self.regex = re.compile("(?:%s)\\Z" % pattern)
+
+    def matches(self, value):
+        return isinstance(value, basestring) and self.regex.match(value) is not None
+
+
+class ValuePrefix(object):
+    """{"prefix": ...}: values that start with the prefix"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def matches(self, value):
+        return isinstance(value, basestring) and value.startswith(self.prefix)
+
+
+class NoValue(object):
+    """An allowed values spec we don't understand, which allows nothing"""
+    def matches(self, value):
+        return False
+
+
+MATCHER_TYPES = (AnyValue, ValueSet, ValueRange, ValuePattern, ValuePrefix, NoValue)
 
 
 class TelemetrySchema:
     DISALLOWED_VALUE = "OTHER"
+    # Remember the filenames for this many distinct cleaned dimensions.
+    FILENAME_CACHE_SIZE = 10000
 
     def __init__(self, spec):
         self._spec = spec
         self._dimensions = self._spec["dimensions"]
+        self._matchers = [TelemetrySchema.compile_matcher(d["allowed_values"])
+                for d in self._dimensions]
+        self._field_indexes = dict()
+        for i, d in enumerate(self._dimensions):
+            self._field_indexes.setdefault(d["field_name"], i)
+        # (basedir, cleaned dimensions, submission date, version) => filename
+        self._filenames = LRUCache(max_entries=TelemetrySchema.FILENAME_CACHE_SIZE)
+
+    @staticmethod
+    def compile_matcher(allowed_values):
+        if allowed_values == "*":
+            return AnyValue()
+        elif isinstance(allowed_values, list):
+            return ValueSet(allowed_values)
+        elif isinstance(allowed_values, dict):
+            if "regex" in allowed_values:
+                return ValuePattern(allowed_values["regex"])
+            if "prefix" in allowed_values:
+                return ValuePrefix(allowed_values["prefix"])
+            return ValueRange(allowed_values)
+        # Treat a string the same as a single-element array:
+        elif isinstance(allowed_values, basestring):
+            return ValueSet([allowed_values])
+        # elif it's a special case (date-in-past, uuid, etc)
+        return NoValue()
 
     def safe_filename(self, value):
-        return re.sub(r'[^a-zA-Z0-9_/.]', "_", value)
+        return SAFE_FILENAME.sub("_", value)
 
     def sanitize_allowed_values(self):
         dims = []
@@ -37,27 +132,16 @@ class TelemetrySchema:
                 # ie. if someone passed in 100 dims.
                 if i >= num_dims:
                     break
-                cleaned[i] = self.get_allowed_value(v, self._dimensions[i]["allowed_values"])
+                if self._matchers[i].matches(v):
+                    cleaned[i] = str(v)
         return cleaned
 
+    # allowed_values is either an "allowed_values" spec (for example one
+    # returned by sanitize_allowed_values) or a compiled matcher.
     def is_allowed(self, value, allowed_values):
-        if allowed_values == "*":
-            return True
-        elif isinstance(allowed_values, list):
-            if value in allowed_values:
-                return True
-        elif isinstance(allowed_values, dict):
-            if "min" in allowed_values and value < allowed_values["min"]:
-                return False
-            if "max" in allowed_values and value > allowed_values["max"]:
-                return False
-            return True
-        # Treat a string the same as a single-element array:
-        elif isinstance(allowed_values, basestring):
-            return value == allowed_values
-        # elif it's a regex, apply the regex.
-        # elif it's a special case (date-in-past, uuid, etc)
-        return False
+        if not isinstance(allowed_values, MATCHER_TYPES):
+            allowed_values = TelemetrySchema.compile_matcher(allowed_values)
+        return allowed_values.matches(value)
 
     def get_allowed_value(self, value, allowed_values):
         if self.is_allowed(value, allowed_values):
@@ -90,8 +174,13 @@ class TelemetrySchema:
         return self.get_current_file(basedir, clean_dims, submission_date, version)
 
     def get_current_file(self, basedir, dims, submission_date, version=1):
-        dirname = os.path.join(*dims)
-        return ".".join((os.path.join(basedir, self.safe_filename(dirname)), submission_date, "v" + str(version), "log"))
+        key = (basedir, tuple(dims), submission_date, version)
+        filename = self._filenames.get(key)
+        if filename is None:
+            dirname = os.path.join(*dims)
+            filename = ".".join((os.path.join(basedir, self.safe_filename(dirname)), submission_date, "v" + str(version), "log"))
+            self._filenames.put(key, filename)
+        return filename
 
     def dimensions_from(self, info, submission_date):
         dimensions = []
@@ -109,17 +198,11 @@ class TelemetrySchema:
         return dim_map
 
     def get_field(self, dims, field_name, limit_to_allowed=False, sanitize=False):
-        dim_idx = -1
-        allowed_values = None
-        for i in range(len(self._dimensions)):
-            if self._dimensions[i]["field_name"] == field_name:
-                dim_idx = i
-                allowed_values = self._dimensions[i]["allowed_values"]
-                break
+        dim_idx = self._field_indexes.get(field_name, -1)
         if dim_idx >= 0 and dim_idx < len(dims):
             val = dims[dim_idx]
             if limit_to_allowed:
-                val = self.get_allowed_value(val, allowed_values)
+                val = self.get_allowed_value(val, self._matchers[dim_idx])
             if sanitize:
                 val = self.safe_filename(val)
             return val
@@ -6,10 +6,15 @@ import os
 import revision_cache
 import shutil
 import simplejson as json
+import sys
 import unittest
+from StringIO import StringIO
 from telemetry_schema import TelemetrySchema
-from convert import Converter, BadPayloadError
+from convert import Converter, BadPayloadError, HistogramLayout, convert_lines
+from histogram_store import StoredHistogram
+from histogram_tools import DefinitionException
 import telemetry.util.files as fu
+from telemetry.util.histograms import expand_histograms
 
 # python -m unittest telemetry.test_convert
 #   - or -
@@ -252,6 +257,126 @@ class ConvertTest(unittest.TestCase):
         for h in expected_converted_histograms.keys():
             self.assertEqual(rewritten[h], expected_converted_histograms[h])
 
+    def test_histogram_layout(self):
+        revision = self.get_revision()
+        histogram_defs = ConvertTest.cache.get_histograms_for_revision(revision)
+        definition = histogram_defs["DNS_LOOKUP_TIME"]
+        layout = ConvertTest.converter.histocache(revision, "STARTUP_DNS_LOOKUP_TIME", definition)
+        self.assertEqual(layout.n_buckets, 50)
+        self.assertEqual(layout.template, [0] * 50)
+        # Layouts are compiled once per revision and histogram.
+        self.assertIs(layout, ConvertTest.converter.histocache(revision, "STARTUP_DNS_LOOKUP_TIME", definition))
+
+        # Bucket labels that aren't in canonical form still find their bucket.
+        raw = self.get_raw_histograms()["STARTUP_DNS_LOOKUP_TIME"]
+        raw["values"] = {"077": 1}
+        expected = self.get_converted_histograms()["STARTUP_DNS_LOOKUP_TIME"]
+        self.assertEqual(ConvertTest.converter.map_value(layout, raw), expected)
+        # The template must not be modified by conversion.
+        self.assertEqual(layout.template, [0] * 50)
+
+    def test_stored_layout(self):
+        layout = HistogramLayout.from_stored("STARTUP_FOO", StoredHistogram(3, [0, 1, 2], None, None))
+        self.assertEqual(layout.name, "STARTUP_FOO")
+        self.assertEqual(layout.template, [0, 0, 0])
+        self.assertEqual(layout.bucket_index, {"0": 0, "1": 1, "2": 2})
+        self.assertIs(layout.error, None)
+
+        layout = HistogramLayout.from_stored("FOO", StoredHistogram(3, None, "no ranges", None))
+        self.assertIs(layout.bucket_index, None)
+        self.assertEqual(layout.error, "no ranges")
+        layout = HistogramLayout.from_stored("FOO", StoredHistogram(None, None, None, None))
+        self.assertIs(layout.n_buckets, None)
+        with self.assertRaises(DefinitionException):
+            HistogramLayout.from_stored("FOO", StoredHistogram(None, None, None, "bad"))
+
+    def test_histocache_stats(self):
+        converter = Converter(ConvertTest.cache, ConvertTest.schema, histocache_max_entries=1)
+        self.assertEqual(converter.get_stats()["histocache"]["entries"], 0)
+
+        converter.rewrite_hists(self.get_revision(), self.get_raw_histograms())
+        stats = converter.get_stats()["histocache"]
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["evictions"], 0)
+        # Three histograms were compiled for this revision.
+        self.assertTrue(stats["bytes"] > 3 * HistogramLayout.BASE_BYTES)
+        self.assertEqual(converter.get_stats()["shared_layouts"]["bytes"], stats["bytes"])
+
+    def test_shared_layouts(self):
+        cache_dir = "/tmp/test_convert_shared_layouts"
+        assert not os.path.exists(cache_dir)
+        try:
+            # The two revisions differ, but not in the bucket layout of FOO.
+            for rev, description in (("000000000001", "old"), ("000000000002", "new")):
+                filename = os.path.join(cache_dir, "mozilla-central", rev, "Histograms.json")
+                os.makedirs(os.path.dirname(filename))
+                with open(filename, "w") as fout:
+                    json.dump({"FOO": {"kind": "enumerated", "n_values": 5,
+                                       "description": description}}, fout)
+            cache = revision_cache.RevisionCache(cache_dir, None)
+            converter = Converter(cache, ConvertTest.schema)
+            url = "https://hg.mozilla.org/mozilla-central/rev/"
+            layouts = []
+            for rev in ("000000000001", "000000000002"):
+                definition = cache.get_histograms_for_revision(url + rev)["FOO"]
+                layouts.append(converter.histocache(url + rev, "FOO", definition))
+            self.assertIs(layouts[0], layouts[1])
+            stats = converter.get_stats()
+            self.assertEqual(stats["histocache"]["entries"], 2)
+            # Each revision is charged for the layout it holds.
+            self.assertEqual(stats["histocache"]["bytes"], 2 * layouts[0].size)
+            self.assertEqual(stats["shared_layouts"]["entries"], 1)
+            self.assertEqual(stats["shared_layouts"]["bytes"], layouts[0].size)
+
+            # Revisions that only hold shared layouts are still evicted to
+            # stay within the byte limit.
+            converter = Converter(cache, ConvertTest.schema,
+                    histocache_max_bytes=layouts[0].size)
+            for rev in ("000000000001", "000000000002"):
+                definition = cache.get_histograms_for_revision(url + rev)["FOO"]
+                converter.histocache(url + rev, "FOO", definition)
+            stats = converter.get_stats()["histocache"]
+            self.assertEqual(stats["entries"], 1)
+            self.assertEqual(stats["evictions"], 1)
+            self.assertEqual(stats["bytes"], layouts[0].size)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_evicted_layouts(self):
+        converter = Converter(ConvertTest.cache, ConvertTest.schema, histocache_max_entries=1)
+        converter._last_revision = ("a", {}, "a", {})
+        key, layouts = converter.get_layouts("a", "a")
+        # Compiling a layout for a revision that has been evicted in the
+        # meantime forgets the revision rather than keeping it uncounted.
+        converter.get_layouts("b", "b")
+        layout = converter.compile_layout(key, layouts, "FOO", StoredHistogram(3, [0, 1, 2], None, None))
+        self.assertIs(layouts["FOO"], layout)
+        self.assertEqual(converter._last_revision, (None, None, None, None))
+        self.assertEqual(converter.get_stats()["histocache"]["bytes"], 0)
+
+    def test_stage_stats(self):
+        self.assertEqual(ConvertTest.converter.get_stage_stats(), {})
+        converter = Converter(ConvertTest.cache, ConvertTest.schema, instrument=True,
+                passthrough_converted=True)
+        payload = json.dumps(self.get_payload("normal"))
+        serialized, dims = converter.convert_json_serialized(payload, "20131114")
+        converter.convert_json_serialized(serialized, "20131114")
+
+        stats = converter.get_stats()
+        parse = stats["stage.parse.classic.v1"]
+        self.assertEqual(parse["calls"], 1)
+        self.assertEqual(parse["bytes"], len(payload))
+        self.assertTrue(parse["seconds"] >= 0)
+        self.assertEqual(stats["stage.histograms.classic.v1"]["calls"], 1)
+        self.assertEqual(stats["stage.dimensions.classic.v1"]["calls"], 1)
+        self.assertEqual(stats["stage.dimensions.passthrough"]["calls"], 1)
+        self.assertEqual(stats["stage.serialize.classic.v1"]["bytes"], len(serialized))
+        self.assertEqual(stats["stage.passthrough.fallback"]["calls"], 1)
+        self.assertEqual(stats["stage.passthrough.converted"]["bytes"], len(serialized))
+        self.assertNotIn("stage.geoip.classic.v1", stats)
+        self.assertIn("histocache", stats)
+
     def convert(self, raw, submission_date="20131114", ip=None):
         return ConvertTest.converter.convert_json(json.dumps(raw), submission_date, ip)
 
@@ -291,6 +416,45 @@ class ConvertTest(unittest.TestCase):
             self.assertEqual(converted["histograms"][h], expected_converted_histograms[h])
         self.assertIs(converted["info"].get("geoCountry"), None)
 
+    def test_sparse_histograms(self):
+        converter = Converter(ConvertTest.cache, ConvertTest.schema, sparse_histograms=True)
+        payload = json.dumps(self.get_payload("normal"))
+        converted, dimensions = converter.convert_json(payload, "20131114")
+        self.assertEqual(converted["ver"], Converter.VERSION_SPARSE)
+        self.assertEqual(expand_histograms(converted["histograms"]),
+                self.get_converted_histograms())
+
+        # Sparse pings count as converted, with either converter.
+        serialized = converter.serialize(converted)
+        self.assertEqual(converter.passthrough(serialized, "20131114"), (serialized, dimensions))
+        self.assertEqual(ConvertTest.converter.convert_json(serialized, "20131114"),
+                (converted, dimensions))
+
+        # Unified pings get their own sparse version, but only if they have
+        # histograms.
+        application = {"name": "Firefox", "channel": "nightly", "version": "40.0a1",
+                       "buildId": "20150401030204"}
+        unified = {"version": Converter.VERSION_UNIFIED, "type": "main",
+                   "application": application,
+                   "payload": {"info": {"revision": self.get_revision()},
+                               "histograms": self.get_raw_histograms()}}
+        converted, dimensions = converter.convert_json(json.dumps(unified), "20131114")
+        self.assertEqual(converted["version"], Converter.VERSION_UNIFIED_SPARSE)
+        self.assertEqual(expand_histograms(converted["payload"]["histograms"]),
+                self.get_converted_histograms())
+        serialized = converter.serialize(converted)
+        self.assertEqual(ConvertTest.converter.convert_json(serialized, "20131114"),
+                (converted, dimensions))
+        activation = {"version": Converter.VERSION_UNIFIED, "type": "activation",
+                      "application": application, "payload": {}}
+        converted, dimensions = converter.convert_json(json.dumps(activation), "20131114")
+        self.assertEqual(converted["version"], Converter.VERSION_UNIFIED_CONVERTED)
+        no_histograms = self.get_payload("normal")
+        del no_histograms["histograms"]
+        del no_histograms["info"]["revision"]
+        converted, dimensions = converter.convert_json(json.dumps(no_histograms), "20131114")
+        self.assertEqual(converted["ver"], Converter.VERSION_CONVERTED)
+
     def print_byte_range(self, data, start=None, end=None):
         if start is None:
             start = 0
@@ -377,6 +541,17 @@ class ConvertTest(unittest.TestCase):
         self.assertIs(ConvertTest.converter.get_geo_country("127.0.0.1"), None)
         self.assertIs(ConvertTest.converter.get_geo_country("::1"), None)
 
+    def test_geo_cache(self):
+        converter = Converter(ConvertTest.cache, ConvertTest.schema, geo_cache_size=10)
+        self.assertEqual(converter.get_geo_country("8.8.8.8"), "US")
+        self.assertEqual(converter.get_geo_country("127.0.0.1, 8.8.8.8"), "US")
+        # Unknown addresses are remembered too.
+        self.assertIs(converter.get_geo_country("127.0.0.1"), None)
+        stats = converter.get_stats()["geocache"]
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["entries"], 2)
+
     def test_convert_geo(self):
         # Google public DNS
         google_ipv4 = "8.8.8.8"
@@ -496,6 +671,68 @@ class ConvertTest(unittest.TestCase):
         except BadPayloadError as e:
             self.assertTrue(e.msg.startswith("Found invalid bucket "))
 
+    def test_convert_batch(self):
+        descs = ["normal", "anr", "fxos", "normal"]
+        records = [(json.dumps(self.get_payload(d)), "20131114", None) for d in descs]
+        no_revision = self.get_payload("normal")
+        del no_revision["info"]["revision"]
+        records.insert(2, (json.dumps(no_revision), "20131114", None))
+        records.insert(1, ("{bogus", "20131114", None))
+
+        results = ConvertTest.converter.convert_batch(records)
+        self.assertEqual(len(results), len(records))
+        for i, (converted, dimensions, err) in enumerate(results):
+            jsonstr, date, ip = records[i]
+            if i == 1:
+                self.assertIs(converted, None)
+                self.assertIsNot(err, None)
+            elif i == 3:
+                self.assertIs(converted, None)
+                self.assertEqual(err.message, "Missing in payload: info.revision")
+            else:
+                self.assertIs(err, None)
+                expected, expected_dims = ConvertTest.converter.convert_json(jsonstr, date)
+                self.assertEqual(converted, expected)
+                self.assertEqual(dimensions, expected_dims)
+
+    def test_convert_lines(self):
+        payload = json.dumps(self.get_payload("normal"))
+        lines = ["a\t" + payload + "\n", "no tab\n", "b\t{bogus\n", "c\t" + payload + "\n"]
+        output, errors = convert_lines(ConvertTest.converter, lines, 11, "20131114")
+        converted = output.splitlines()
+        self.assertEqual(len(converted), 2)
+        self.assertTrue(converted[0].startswith("a\t"))
+        self.assertTrue(converted[1].startswith("c\t"))
+        self.assertEqual([n for n, message in errors], [12, 13])
+        self.assertEqual(errors[0][1], "Error on line 12: no tab found\n")
+        self.assertTrue(errors[1][1].startswith("Error converting line 13: "))
+
+    def test_passthrough(self):
+        converter = Converter(ConvertTest.cache, ConvertTest.schema, passthrough_converted=True)
+        converted, dims = converter.convert_json(json.dumps(self.get_payload("normal")), "20131114")
+        serialized = converter.serialize(converted)
+        result = converter.passthrough(serialized + "\n", "20131114")
+        self.assertIsNot(result, None)
+        self.assertEqual(result[0], serialized)
+        self.assertEqual(result[1], dims)
+        self.assertEqual(converter.convert_json_serialized(serialized, "20131114"), (serialized, dims))
+
+        # Unconverted and malformed pings go through the regular conversion.
+        self.assertIs(converter.passthrough(json.dumps(self.get_payload("normal")), "20131114"), None)
+        self.assertIs(converter.passthrough(serialized + "}", "20131114"), None)
+        self.assertIs(converter.passthrough(serialized[:-1], "20131114"), None)
+        serialized, dims = converter.convert_json_serialized(json.dumps(self.get_payload("normal")), "20131114")
+        self.assertEqual(json.loads(serialized), converted)
+
+        # Only the top level is checked, so pings from anywhere else always
+        # go through the regular conversion, which rejects invalid JSON.
+        invalid = serialized[:-1] + ',"junk":{"n": eeee, "a": [1,2,,3 x]}}'
+        self.assertEqual(converter.convert_json_serialized(invalid, "20131114")[0], invalid)
+        with self.assertRaises(ValueError):
+            ConvertTest.converter.convert_json_serialized(invalid, "20131114")
+        results = ConvertTest.converter.convert_batch([(invalid, "20131114", None)], serialize=True)
+        self.assertIsInstance(results[0][2], ValueError)
+
     def test_serialize(self):
         t = {"foo": 1, "bar": 2}
         serialized = ConvertTest.converter.serialize(t)
@@ -537,6 +774,26 @@ class ConvertTest(unittest.TestCase):
         for h in expected_converted_histograms.keys():
             self.assertEqual(rewritten[h], expected_converted_histograms[h])
 
+    def test_diagnostics(self):
+        converter = Converter(ConvertTest.cache, ConvertTest.schema)
+        histograms = self.get_raw_histograms()
+        bogus_name = "I_DO_NOT_EXIST"
+        histograms[bogus_name] = histograms["STARTUP_DNS_LOOKUP_TIME"]
+        revision = self.get_revision()
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            converter.rewrite_hists(revision, histograms)
+            converter.rewrite_hists(revision, histograms)
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        # Reported once, but counted every time.
+        self.assertEqual(output.count(bogus_name), 1)
+        self.assertEqual(converter.get_stats()["diagnostics"], {"unknown_histogram": 2})
+        self.assertEqual(converter.get_diagnostics(),
+                [(revision, bogus_name, "unknown_histogram", 2)])
+
     def test_map_key(self):
         for k in ["hello", 5, {"foo": "bar"}]:
             self.assertEqual(k, ConvertTest.converter.map_key(None, k))
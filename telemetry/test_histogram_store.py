@@ -0,0 +1,95 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+from histogram_store import LayoutStore, build_store, write_store
+from revision_cache import RevisionCache
+
+class TestLayoutStore(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.test_dir, "layouts.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_lookup(self):
+        first = "a" * 40
+        second = "b" * 40
+        tables = {
+            first: {
+                u"A11Y_INSTANTIATED_FLAG": (3, [0, 1, 2], None, None),
+                "BAD_RANGES": (10, None, "Could not find ranges", None),
+                "NON_NUMERIC": (None, None, None, None),
+            },
+            second: {
+                "BAD_DEFINITION": (None, None, None, "unknown kind"),
+            }
+        }
+        revisions = {
+            ("mozilla-central", "26cb30a532a1"): first,
+            ("releases/mozilla-beta", "53c447ff5fd3"): first,
+            ("mozilla-central", "000000000001"): second,
+            # Revisions of unknown tables are left out.
+            ("mozilla-central", "000000000002"): "c" * 40
+        }
+        write_store(self.filename, tables, revisions)
+        store = LayoutStore(self.filename)
+        self.assertEqual(store.get_stats()["tables"], 2)
+        self.assertEqual(store.get_stats()["revisions"], 3)
+
+        table = store.lookup("mozilla-central", "26cb30a532a1")
+        self.assertEqual(table.content_hash, first)
+        self.assertEqual(len(table), 3)
+        # Full revisions are found by their short form.
+        self.assertIs(table, store.lookup("releases/mozilla-beta", "53c447ff5fd3" + "0" * 28))
+        self.assertIn("A11Y_INSTANTIATED_FLAG", table)
+        self.assertIn(u"NON_NUMERIC", table)
+        self.assertNotIn("BAD_DEFINITION", table)
+        self.assertNotIn("STARTUP_A11Y_INSTANTIATED_FLAG", table)
+
+        flag = table["A11Y_INSTANTIATED_FLAG"]
+        self.assertEqual(flag.n_buckets, 3)
+        self.assertEqual(flag.ranges, [0, 1, 2])
+        self.assertIs(flag.error, None)
+        self.assertEqual(table["BAD_RANGES"].error, "Could not find ranges")
+        self.assertIs(table["NON_NUMERIC"].n_buckets, None)
+        with self.assertRaises(KeyError):
+            table["BAD_DEFINITION"]
+
+        other = store.lookup("mozilla-central", "000000000001")
+        self.assertEqual(other["BAD_DEFINITION"].definition_error, "unknown kind")
+        self.assertIs(store.lookup("mozilla-central", "000000000002"), None)
+        self.assertIs(store.lookup("mozilla-aurora", "26cb30a532a1"), None)
+        store.close()
+
+    def test_build_store(self):
+        cache_dir = os.path.join(self.test_dir, "cache")
+        histograms_json = '{"A11Y_INSTANTIATED_FLAG": {"kind": "flag"}}'
+        json_path = os.path.join(cache_dir, "mozilla-central", "26cb30a532a1", "Histograms.json")
+        os.makedirs(os.path.dirname(json_path))
+        with open(json_path, "w") as fout:
+            fout.write(histograms_json)
+
+        cache = RevisionCache(cache_dir, None)
+        self.assertEqual(build_store(cache, self.filename), (1, 1))
+        # The cached file is left alone.
+        with open(json_path) as fin:
+            self.assertEqual(fin.read(), histograms_json)
+        store = LayoutStore(self.filename)
+        table = store.lookup("mozilla-central", "26cb30a532a1")
+        self.assertIn("A11Y_INSTANTIATED_FLAG", table)
+        store.close()
+
+    def test_bad_file(self):
+        with open(self.filename, "w") as fout:
+            fout.write("not a layout store, but long enough")
+        with self.assertRaises(ValueError):
+            LayoutStore(self.filename)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,7 @@ import unittest
 from telemetry.persist import StorageLayout
 from telemetry.telemetry_schema import TelemetrySchema
 import telemetry.util.files as fileutil
+from telemetry.util.compress import CompressedFile
 
 class TestPersist(unittest.TestCase):
     def setUp(self):
@@ -99,5 +100,145 @@ class TestPersist(unittest.TestCase):
         self.assertTrue(rolled.startswith(test_file))
         self.assertTrue(rolled.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX))
 
+    def test_open_files(self):
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, max_open_files=2)
+        dims = ["r1", "a1", "c1", "v1", "b1", "20130102"]
+        test_file = self.schema.get_filename(self.get_test_dir(), dims)
+        self.assertEqual(storage.write("foo", '{"bar":"baz"}', dims), test_file)
+        # Nothing is written until the file is closed (or evicted).
+        self.assertEqual(os.path.getsize(test_file), 0)
+        storage.close()
+        md5, size = fileutil.md5file(test_file)
+        self.assertEqual(md5, "0ea91df239ea79ed2ebab34b46d455fc")
+
+        # Opening a third file evicts the least recently used one.
+        files = [os.path.join(self.get_test_dir(), "test%d.log" % i) for i in range(3)]
+        for f in files:
+            storage.write_filename("foo", {"bar": "baz"}, f)
+        self.assertEqual(os.path.getsize(files[0]), 18)
+        self.assertEqual(os.path.getsize(files[2]), 0)
+        storage.close()
+        for f in files:
+            md5, size = fileutil.md5file(f)
+            self.assertEqual(md5, "0ea91df239ea79ed2ebab34b46d455fc")
+
+    def test_open_files_rotate(self):
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, max_open_files=10)
+        other = StorageLayout(self.schema, self.get_test_dir(), 10000, max_open_files=10)
+        test_file = os.path.join(self.get_test_dir(), "test.log")
+        key = "01234567890123456789012345678901234567890123456789"
+        value = '{"some filler stuff here":"fffffffffffffffffff"}'
+        for i in range(99):
+            self.assertEqual(storage.write_filename(key, value, test_file), test_file)
+        rolled = storage.write_filename(key, value, test_file)
+        self.assertTrue(rolled.endswith(StorageLayout.PENDING_COMPRESSION_SUFFIX))
+        self.assertEqual(os.path.getsize(rolled), 10000)
+        self.assertFalse(os.path.exists(test_file))
+
+        # A writer whose file was rotated by someone else starts a new file.
+        storage.write_filename(key, value, test_file)
+        rolled = other.rotate(test_file)
+        storage.close()
+        self.assertEqual(os.path.getsize(rolled), 0)
+        self.assertEqual(os.path.getsize(test_file), 100)
+
+    def test_flush_limits(self):
+        files = [os.path.join(self.get_test_dir(), "test%d.log" % i) for i in range(3)]
+        # Each record is 18 bytes.
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000,
+                max_open_files=10, flush_bytes=60, max_buffer_bytes=60)
+        storage.write_filename("foo", {"bar": "baz"}, files[0])
+        storage.write_filename("foo", {"bar": "baz"}, files[0])
+        storage.write_filename("foo", {"bar": "baz"}, files[0])
+        self.assertEqual(os.path.getsize(files[0]), 0)
+        # Crossing flush_bytes writes out the file's records in one go.
+        storage.write_filename("foo", {"bar": "baz"}, files[0])
+        self.assertEqual(os.path.getsize(files[0]), 72)
+        storage.write_filename("foo", {"bar": "baz"}, files[1])
+        storage.write_filename("foo", {"bar": "baz"}, files[1])
+        storage.write_filename("foo", {"bar": "baz"}, files[2])
+        self.assertEqual(os.path.getsize(files[1]), 0)
+        # Crossing max_buffer_bytes writes out the largest buffers first.
+        storage.write_filename("foo", {"bar": "baz"}, files[1])
+        self.assertEqual(os.path.getsize(files[1]), 54)
+        self.assertEqual(os.path.getsize(files[2]), 0)
+        storage.close()
+        self.assertEqual(os.path.getsize(files[2]), 18)
+
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000,
+                max_open_files=10, max_age=-1)
+        storage.write_filename("foo", {"bar": "baz"}, files[2])
+        self.assertEqual(os.path.getsize(files[2]), 36)
+
+    def test_partial_record(self):
+        test_file = os.path.join(self.get_test_dir(), "test.log")
+        with open(test_file, "w") as fout:
+            fout.write("foo\t{\"bar\":")
+        storage = StorageLayout(self.schema, self.get_test_dir(), 10000, max_open_files=10)
+        storage.write_filename("foo", {"bar": "baz"}, test_file)
+        storage.close()
+        with open(test_file) as fin:
+            self.assertEqual(fin.read(), "foo\t{\"bar\":\nfoo\t{\"bar\":\"baz\"}\n")
+
+    def test_compress(self):
+        storage = StorageLayout(self.schema, self.get_test_dir(), 1000,
+                max_open_files=10, compress=True)
+        dims = ["r1", "a1", "c1", "v1", "b1", "20130102"]
+        test_file = self.schema.get_filename(self.get_test_dir(), dims)
+        test_dir = os.path.dirname(test_file)
+        key = "01234567890123456789012345678901234567890123456789"
+        value = '{"some filler stuff here":"fffffffffffffffffff"}'
+        for i in range(9):
+            self.assertEqual(storage.write(key, value, dims), test_file)
+        # Nothing is ready to upload until the file is finished.
+        self.assertEqual([f for f in os.listdir(test_dir) if f.endswith(StorageLayout.COMPRESSED_SUFFIX)], [])
+        finished = storage.write(key, value, dims)
+        self.assertTrue(finished.startswith(test_file + "."))
+        self.assertTrue(finished.endswith(StorageLayout.COMPRESSED_SUFFIX))
+        self.assertEqual(os.listdir(test_dir), [os.path.basename(finished)])
+        self.assertEqual(list(CompressedFile(finished)), [key + "\t" + value + "\n"] * 10)
+
+        storage.write(key, value, dims)
+        partial = [f for f in os.listdir(test_dir) if f.endswith(StorageLayout.PARTIAL_SUFFIX)]
+        self.assertEqual(len(partial), 1)
+        storage.close()
+        self.assertEqual(len(os.listdir(test_dir)), 2)
+        self.assertIn(partial[0][:-len(StorageLayout.PARTIAL_SUFFIX)], os.listdir(test_dir))
+
+        with self.assertRaises(ValueError):
+            StorageLayout(self.schema, self.get_test_dir(), 1000, compress=True)
+
+    def test_shards(self):
+        dims = ["r1", "a1", "c1", "v1", "b1", "20130102"]
+        test_file = self.schema.get_filename(self.get_test_dir(), dims)
+        writers = []
+        for writer_id in range(2):
+            storage = StorageLayout(self.schema, self.get_test_dir(), 10000,
+                    max_open_files=10, sharded=True)
+            storage.set_writer_id(writer_id)
+            writers.append(storage)
+        self.assertEqual(writers[0].write("foo", '{"bar":"baz"}', dims),
+                         test_file + ".0" + StorageLayout.SHARD_SUFFIX)
+        self.assertEqual(writers[1].write("foo", {"bar": "baz"}, dims),
+                         test_file + ".1" + StorageLayout.SHARD_SUFFIX)
+        for storage in writers:
+            storage.close()
+        self.assertFalse(os.path.exists(test_file))
+
+        # Shards of the same partition end up in one file.
+        self.assertEqual(writers[0].merge_shards(), [test_file])
+        self.assertEqual(os.listdir(os.path.dirname(test_file)), [os.path.basename(test_file)])
+        with open(test_file) as fin:
+            self.assertEqual(fin.read(), 'foo\t{"bar":"baz"}\n' * 2)
+
+        # Unpooled writers are sharded too, and a lone shard is renamed.
+        other = StorageLayout(self.schema, self.get_test_dir(), 10000, sharded=True)
+        other_file = self.schema.get_filename(self.get_test_dir(), ["r2"] + dims[1:])
+        self.assertEqual(other.write("foo", '{"bar":"baz"}', ["r2"] + dims[1:]),
+                         "%s.%d%s" % (other_file, os.getpid(), StorageLayout.SHARD_SUFFIX))
+        self.assertEqual(other.merge_shards(), [other_file])
+        md5, size = fileutil.md5file(other_file)
+        self.assertEqual(md5, "0ea91df239ea79ed2ebab34b46d455fc")
+
 if __name__ == "__main__":
     unittest.main()
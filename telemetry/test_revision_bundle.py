@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+from revision_cache import RevisionCache
+from revision_bundle import RevisionBundle, export_bundle, import_bundle
+
+class TestRevisionBundle(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.test_dir, "source")
+        self.target_dir = os.path.join(self.test_dir, "target")
+        self.filename = os.path.join(self.test_dir, "revisions.bundle")
+        self.source = RevisionCache(self.source_dir, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_round_trip(self):
+        foo = '{"FOO": {"kind": "flag"}}'
+        bar = '{"BAR": {"kind": "flag"}}'
+        self.source.save_to_cache('mozilla-central', '000000000001', foo)
+        self.source.save_to_cache('releases/mozilla-beta', '000000000002', foo)
+        self.source.save_index('mozilla-central', {'000000000003': '000000000001'})
+        self.assertEqual(export_bundle(self.source, self.filename), 1)
+
+        # Only new revisions are added to an existing bundle.
+        self.source.save_to_cache('mozilla-central', '000000000004', bar)
+        self.assertEqual(export_bundle(self.source, self.filename), 1)
+        self.assertEqual(export_bundle(self.source, self.filename), 0)
+
+        bundle = RevisionBundle(self.filename)
+        self.assertEqual(bundle.get_revision('mozilla-central', '000000000001'), foo)
+        self.assertEqual(bundle.get_revision('releases/mozilla-beta', '000000000002'), foo)
+        self.assertEqual(bundle.get_revision('mozilla-central', '000000000004'), bar)
+        # Prefetched revisions are resolved through the index.
+        self.assertEqual(bundle.get_revision('mozilla-central', '000000000003' + '0' * 28), foo)
+        self.assertIs(bundle.get_revision('mozilla-central', '000000000005'), None)
+        self.assertIs(bundle.get_revision('mozilla-aurora', '000000000001'), None)
+
+        # Read in place.
+        cache = RevisionCache(self.target_dir, None, bundle=bundle)
+        self.assertIn("BAR", cache.get_revision('mozilla-central', '000000000004'))
+        self.assertIn("FOO", cache.get_revision('mozilla-central', '000000000003'))
+        self.assertFalse(os.path.exists(self.target_dir))
+
+        # Imported.
+        target = RevisionCache(self.target_dir, None)
+        self.assertEqual(import_bundle(bundle, target), 3)
+        self.assertEqual(import_bundle(bundle, target), 0)
+        bundle.close()
+        target = RevisionCache(self.target_dir, None)
+        self.assertIn("FOO", target.get_revision('releases/mozilla-beta', '000000000002'))
+        self.assertIn("FOO", target.get_revision('mozilla-central', '000000000003'))
+        self.assertIn("BAR", target.get_revision('mozilla-central', '000000000004'))
+
+    def test_bad_bundle(self):
+        with open(self.filename, "w") as fout:
+            fout.write("not a bundle, but long enough to have a trailer")
+        with self.assertRaises(ValueError):
+            RevisionBundle(self.filename)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,8 @@
 import os
 import revision_cache
 import shutil
+import threading
+import time
 import unittest
 import json
 
@@ -122,5 +124,227 @@ class TestRevisionCache(unittest.TestCase):
         parsed = json.loads(revision)
         self.assertIn("A11Y_INSTANTIATED_FLAG", parsed)
 
+    def write_cached(self, repo, rev, contents):
+        filename = os.path.join(self.get_test_dir(), repo, rev, "Histograms.json")
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, "w") as fout:
+            fout.write(contents)
+
+    def test_intern(self):
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), 'hg.mozilla.org')
+        contents = '{"A11Y_INSTANTIATED_FLAG": {"kind": "flag"}}'
+        self.write_cached('mozilla-central', '000000000001', contents)
+        self.write_cached('mozilla-central', '000000000002', contents)
+        self.write_cached('releases/mozilla-beta', '000000000003', contents)
+        self.write_cached('mozilla-central', '000000000004', '{"FOO": {"kind": "flag"}}')
+
+        first = rcache.get_histograms_for_revision('https://hg.mozilla.org/mozilla-central/rev/000000000001')
+        second = rcache.get_histograms_for_revision('https://hg.mozilla.org/mozilla-central/rev/000000000002')
+        third = rcache.get_histograms_for_revision('https://hg.mozilla.org/releases/mozilla-beta/rev/000000000003')
+        other = rcache.get_histograms_for_revision('https://hg.mozilla.org/mozilla-central/rev/000000000004')
+        # Identical files are only parsed (and kept) once.
+        self.assertIs(first, second)
+        self.assertIs(first, third)
+        self.assertIsNot(first, other)
+
+        first_hash = rcache.get_content_hash('https://hg.mozilla.org/mozilla-central/rev/000000000001')
+        self.assertIsNotNone(first_hash)
+        self.assertEqual(first_hash, rcache.get_content_hash('https://hg.mozilla.org/releases/mozilla-beta/rev/000000000003'))
+        self.assertNotEqual(first_hash, rcache.get_content_hash('https://hg.mozilla.org/mozilla-central/rev/000000000004'))
+        self.assertIs(rcache.get_content_hash('https://hg.mozilla.org/mozilla-central/rev/000000000005'), None)
+
+        # Files that don't parse don't get a content hash.
+        with self.assertRaises(ValueError):
+            rcache.intern('mozilla-central', '000000000006', '{"FOO": ')
+        self.assertIs(rcache.get_content_hash('https://hg.mozilla.org/mozilla-central/rev/000000000006'), None)
+
+    def test_prefetch(self):
+        history = FakeHistory()
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), None)
+        self.assertEqual(rcache.prefetch('mozilla-central', history), 5)
+        self.assertEqual(history.cat_calls, 2)
+
+        url = 'https://hg.mozilla.org/mozilla-central/rev/'
+        self.assertIn("FOO", rcache.get_histograms_for_revision(url + '000000000001'))
+        self.assertIn("FOO", rcache.get_histograms_for_revision(url + '000000000002'))
+        self.assertIn("BAR", rcache.get_histograms_for_revision(url + '000000000003'))
+        # A merge whose parents have the same file uses it.
+        self.assertIn("FOO", rcache.get_histograms_for_revision(url + '000000000007' + '0' * 28))
+        # Other merges (and what follows them) aren't indexed, since the
+        # merge may have taken the file from either parent, and aren't
+        # fetched without a server.
+        self.assertIs(rcache.get_histograms_for_revision(url + '000000000004'), None)
+        self.assertIs(rcache.get_histograms_for_revision(url + '000000000005'), None)
+        # Unknown revisions are not fetched without a server.
+        self.assertIs(rcache.get_histograms_for_revision(url + '000000000008'), None)
+        # Calculated values are replaced, as for files from the server.
+        self.assertEqual(rcache.get_histograms_for_revision(url + '000000000003')["BAR"]["n_values"], 101)
+
+        # Other caches see the index on disk.
+        other = revision_cache.RevisionCache(self.get_test_dir(), None)
+        self.assertIn("BAR", other.get_histograms_for_revision(url + '000000000003'))
+        self.assertEqual(other.get_content_hash(url + '000000000007' + '0' * 28),
+                         other.get_content_hash(url + '000000000001'))
+
+    def test_negative_cache(self):
+        # Nothing listens on this port, so fetches fail quickly.
+        server = 'localhost:1'
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), server)
+        repo = 'mozilla-central'
+        rev = '0000000000ff'
+        self.assertIs(rcache.get_revision(repo, rev), None)
+        self.assertIs(rcache.get_revision(repo, rev), None)
+        stats = rcache.get_stats()
+        self.assertEqual(stats["negative_misses"], 1)
+        self.assertEqual(stats["negative_hits"], 1)
+        self.assertEqual(stats["negative_entries"], 1)
+        self.assertEqual(stats["failed.network"], 1)
+        # Nothing is left in the cache directory for the revision itself.
+        self.assertEqual(sorted(os.listdir(self.get_test_dir())), [".failures", ".locks"])
+        self.assertFalse(rcache.failed_recently(repo, '0000000000fe', check_disk=True))
+
+        # Other caches see the failure on disk.
+        other = revision_cache.RevisionCache(self.get_test_dir(), server)
+        self.assertIs(other.get_revision(repo, rev), None)
+        self.assertEqual(other.get_stats()["negative_hits"], 1)
+        self.assertEqual(other.get_stats()["negative_misses"], 0)
+
+        # Expired failures are retried.
+        expired = revision_cache.RevisionCache(self.get_test_dir(), server,
+                negative_ttls={"network": -1})
+        self.assertIs(expired.get_revision(repo, rev), None)
+        self.assertIs(expired.get_revision(repo, rev), None)
+        self.assertEqual(expired.get_stats()["negative_hits"], 0)
+        self.assertEqual(expired.get_stats()["negative_misses"], 2)
+
+    def test_parsed_format(self):
+        repo = 'mozilla-central'
+        rev = '000000000001'
+        self.write_cached(repo, rev, '{"FOO": {"kind": "flag"}}')
+        filename = os.path.join(self.get_test_dir(), repo, rev, "Histograms.json")
+        rcache = revision_cache.RevisionCache(self.get_test_dir(), None)
+        self.assertIs(rcache.fetch_parsed(repo, rev, filename), None)
+        self.assertIn("FOO", rcache.get_revision(repo, rev))
+        # The pre-parsed form is written the first time the JSON is parsed.
+        self.assertTrue(os.path.exists(filename + ".bin"))
+
+        other = revision_cache.RevisionCache(self.get_test_dir(), None)
+        parsed = other.fetch_parsed(repo, rev, filename)
+        self.assertEqual(parsed, {"FOO": {"kind": "flag"}})
+        content_hash = other.get_content_hash('https://hg.mozilla.org/mozilla-central/rev/' + rev)
+        self.assertEqual(content_hash, rcache.get_content_hash('https://hg.mozilla.org/mozilla-central/rev/' + rev))
+        self.assertIs(other.get_ranges(content_hash), None)
+
+        # Ranges are stored along with the definitions.
+        other.save_parsed(filename, content_hash, parsed, {"FOO": [0, 1, 2]})
+        third = revision_cache.RevisionCache(self.get_test_dir(), None)
+        self.assertIn("FOO", third.get_revision(repo, rev))
+        self.assertEqual(third.get_ranges(content_hash), {"FOO": [0, 1, 2]})
+
+        # A pre-parsed file that doesn't match the JSON is ignored.
+        with open(filename, "w") as fout:
+            fout.write('{"BAR": {"kind": "flag"}}')
+        self.assertIs(third.fetch_parsed(repo, rev, filename), None)
+        with open(filename + ".bin", "w") as fout:
+            fout.write("garbage")
+        fourth = revision_cache.RevisionCache(self.get_test_dir(), None)
+        self.assertIn("BAR", fourth.get_revision(repo, rev))
+
+    def test_single_flight(self):
+        rcache = SlowRevisionCache(self.get_test_dir(), 'stand-in')
+        repo = 'mozilla-central'
+        rev = '000000000001'
+        results = []
+        def fetch():
+            results.append(rcache.get_revision(repo, rev))
+        threads = [threading.Thread(target=fetch) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(rcache.server_fetches, 1)
+        self.assertEqual(len(results), 8)
+        for result in results:
+            self.assertIs(result, results[0])
+        self.assertEqual(rcache._in_flight, {})
+
+        # Other caches find it on disk, and no temporary files are left.
+        other = SlowRevisionCache(self.get_test_dir(), 'stand-in')
+        self.assertIn("FOO", other.get_revision(repo, rev))
+        self.assertEqual(other.server_fetches, 0)
+        rev_dir = os.path.join(self.get_test_dir(), repo, rev)
+        self.assertEqual([f for f in os.listdir(rev_dir) if ".tmp." in f], [])
+
+    def test_invalid_revisions(self):
+        rcache = SlowRevisionCache(self.get_test_dir(), 'stand-in')
+        outside = os.path.join(os.path.dirname(self.get_test_dir()), "revision_cache_escape")
+        url = 'https://hg.mozilla.org/../revision_cache_escape/x/rev/abcdef'
+        self.assertIs(rcache.get_histograms_for_revision(url), None)
+        for repo, rev in [('/tmp/x', 'abcdef'), ('a//b', 'abcdef'), ('a/./b', 'abcdef'),
+                          ('mozilla-central', 'tip'), ('mozilla-central', '../../x')]:
+            self.assertIs(rcache.get_revision(repo, rev), None)
+        self.assertEqual(rcache.server_fetches, 0)
+        self.assertFalse(os.path.exists(outside))
+        self.assertEqual(os.listdir(self.get_test_dir()), [])
+        self.assertIn("FOO", rcache.get_revision('releases/mozilla-beta', '000000000001'))
+
+    def test_unwritable_cache(self):
+        # The cache directory can't be created under a regular file.
+        not_a_dir = os.path.join(self.get_test_dir(), "file")
+        with open(not_a_dir, "w") as fout:
+            fout.write("not a directory")
+        rcache = SlowRevisionCache(os.path.join(not_a_dir, "cache"), 'stand-in')
+        self.assertIn("FOO", rcache.get_histograms_for_revision(
+                'https://hg.mozilla.org/mozilla-central/rev/000000000001'))
+        self.assertEqual(rcache.server_fetches, 1)
+
+
+class SlowRevisionCache(revision_cache.RevisionCache):
+    """Stands in for fetching from hg.mozilla.org, slowly"""
+    def __init__(self, cache_dir, server):
+        revision_cache.RevisionCache.__init__(self, cache_dir, server)
+        self.server_fetches = 0
+
+    def fetch_server(self, repo, revision, parse=True):
+        self.server_fetches += 1
+        time.sleep(0.1)
+        contents = '{"FOO": {"kind": "flag"}}'
+        histograms = self.intern(repo, revision, contents, parse)
+        try:
+            self.save_to_cache(repo, revision, contents)
+        except (IOError, OSError):
+            pass
+        return histograms
+
+
+class FakeHistory:
+    """A stand-in for HgHistory with a small made-up history:
+        1 (adds FOO) - 2 - 3 (changes to BAR)
+        4 (merge of 2 and 3, taking BAR from 3) - 5
+        1 - 6, 7 (merge of 2 and 6)"""
+    def __init__(self):
+        self.cat_calls = 0
+
+    def changesets(self):
+        return [
+            ('000000000000', '000000000000', '000000000000'),
+            ('000000000001', '000000000000', '000000000000'),
+            ('000000000002', '000000000001', '000000000000'),
+            ('000000000003', '000000000002', '000000000000'),
+            ('000000000004', '000000000002', '000000000003'),
+            ('000000000005', '000000000004', '000000000000'),
+            ('000000000006', '000000000001', '000000000000'),
+            ('000000000007', '000000000002', '000000000006'),
+        ]
+
+    def touched(self, filepath):
+        return set(['000000000001', '000000000003'])
+
+    def cat(self, revision, filepath):
+        self.cat_calls += 1
+        if revision == '000000000001':
+            return '{"FOO": {"kind": "flag"}}'
+        return '{"BAR": {"kind": "enumerated", "n_values": "JS::gcreason::NUM_TELEMETRY_REASONS"}}'
+
 if __name__ == "__main__":
     unittest.main()
@@ -281,5 +281,48 @@ class TelemetrySchemaTest(unittest.TestCase):
         self.assertFalse(schema.is_allowed("one_specific_build ", allowed[4]))
         self.assertFalse(schema.is_allowed("one-specific-build", allowed[4]))
 
+    def test_patterns(self):
+        spec = {
+            "version": 1,
+            "dimensions": [
+                {
+                    "field_name": "appVersion",
+                    "allowed_values": {"regex": "[0-9]+\\.0a?[12]?"}
+                },
+                {
+                    "field_name": "appBuildID",
+                    "allowed_values": {"prefix": "2014"}
+                },
+                {
+                    "field_name": "submission_date",
+                    "allowed_values": "*"
+                }
+            ]
+        }
+        schema = TelemetrySchema(spec)
+        allowed = schema.sanitize_allowed_values()
+        self.assertTrue(schema.is_allowed("28.0", allowed[0]))
+        self.assertTrue(schema.is_allowed("31.0a1", allowed[0]))
+        self.assertFalse(schema.is_allowed("31.0a1 ", allowed[0]))
+        self.assertFalse(schema.is_allowed("x31.0", allowed[0]))
+        self.assertFalse(schema.is_allowed(None, allowed[0]))
+        self.assertTrue(schema.is_allowed("20140401001122", allowed[1]))
+        self.assertFalse(schema.is_allowed("20130401001122", allowed[1]))
+        self.assertEqual(schema.apply_schema(["31.0a1", "2013", {"not": "hashable"}]),
+                         ["31.0a1", TelemetrySchema.DISALLOWED_VALUE, "{'not': 'hashable'}"])
+
+    def test_unhashable_values(self):
+        self.assertEqual(self.schema.apply_schema([["saved-session"], {}, "nightly"])[:3],
+                         [TelemetrySchema.DISALLOWED_VALUE, "{}", "nightly"])
+
+    def test_filename_memo(self):
+        dims = ["saved-session", "someAppName", "nightly", "someAppVersion", "someBuildID", "20130908"]
+        first = self.schema.get_filename("foo", dims)
+        self.assertIs(self.schema.get_filename("foo", list(dims)), first)
+        self.assertEqual(self.schema.get_filename("bar", dims),
+                         "bar/saved_session/someAppName/nightly/someAppVersion/someBuildID.20130908.v1.log")
+        self.assertEqual(self.schema.get_filename("foo", dims, 2),
+                         "foo/saved_session/someAppName/nightly/someAppVersion/someBuildID.20130908.v2.log")
+
 if __name__ == "__main__":
     unittest.main()
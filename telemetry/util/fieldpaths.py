@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Compiled field-path maps, as used to rebuild the classic "info" section
+# from the nested sections of a unified ping.
+#
+# A field map (see telemetry/infoFieldsMap.py) looks like
+#   {"cpucount": ["system", "cpu", "count"], "memsize": ["system", "memoryMB"]}
+# FieldPlan turns it into a tree of path components, so that paths sharing
+# a prefix ("system" above) look it up only once, and all destination names
+# (including their suffix and fallback name) are worked out up front.
+
+
+class FieldPlan(object):
+    """Copies the fields named by a field map from a nested source section
+    into a flat destination dict.
+
+    Missing and null source fields are skipped. A destination field that is
+    already present is kept, and the value is stored under "environment."
+    plus its name instead."""
+
+    def __init__(self, rules, suffix=""):
+        # key => [destination fields, subtree]
+        root = {}
+        for dst_field, src_fields in rules.iteritems():
+            dst_field += suffix
+            node = root
+            for i, field in enumerate(src_fields):
+                entry = node.get(field)
+                if entry is None:
+                    entry = node[field] = [[], {}]
+                if i == len(src_fields) - 1:
+                    entry[0].append((dst_field, "environment." + dst_field))
+                node = entry[1]
+        self._plan = FieldPlan.freeze(root)
+
+    # Turn the dicts into nested tuples of
+    #   (key, ((field, fallback field), ...), subtree or None)
+    @staticmethod
+    def freeze(node):
+        frozen = []
+        for key in sorted(node):
+            fields, children = node[key]
+            if children:
+                children = FieldPlan.freeze(children)
+            else:
+                children = None
+            frozen.append((key, tuple(fields), children))
+        return tuple(frozen)
+
+    def copy(self, src, dst):
+        FieldPlan.copy_node(self._plan, src, dst)
+
+    @staticmethod
+    def copy_node(plan, src, dst):
+        for key, fields, children in plan:
+            if key not in src:
+                # this ping doesn't report this particular field
+                continue
+            val = src[key]
+            if val is not None:
+                for field, fallback in fields:
+                    if field in dst:
+                        dst[fallback] = val
+                    else:
+                        dst[field] = val
+            if children is not None:
+                FieldPlan.copy_node(children, val, dst)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Helpers for the sparse histogram encoding of converted pings.
+#
+# A converted histogram is normally a dense list of bucket counts followed by
+# the five sum fields:
+#   [c0, c1, ..., cN-1, sum, log_sum, log_sum_squares, sum_squares_lo, sum_squares_hi]
+# In the sparse encoding the buckets are replaced with the number of buckets
+# and a flat list of (index, count) pairs for the non-zero buckets only:
+#   [N, [i, ci, j, cj, ...], sum, log_sum, log_sum_squares, sum_squares_lo, sum_squares_hi]
+# so the sum fields are at the same offsets from the end in both forms.
+#
+# Converted classic pings using the sparse encoding have their "ver" set to
+# VERSION_SPARSE instead of 2. Converted unified pings have their "version"
+# (and, for saved-session pings, their "ver") set to VERSION_UNIFIED_SPARSE
+# instead of 5. Only pings whose histograms were actually re-encoded are
+# marked as sparse.
+
+VERSION_SPARSE = 6
+VERSION_UNIFIED_SPARSE = 7
+SPARSE_VERSIONS = (VERSION_SPARSE, VERSION_UNIFIED_SPARSE)
+SUM_FIELDS = 5
+
+
+def is_sparse_ping(ping):
+    return ping.get("ver") in SPARSE_VERSIONS or ping.get("version") in SPARSE_VERSIONS
+
+
+def is_sparse(value):
+    return len(value) > 1 and isinstance(value[1], list)
+
+
+def sparse_histogram(dense):
+    n_buckets = len(dense) - SUM_FIELDS
+    counts = []
+    for index, count in enumerate(dense[:n_buckets]):
+        if count:
+            counts.append(index)
+            counts.append(count)
+    return [n_buckets, counts] + dense[n_buckets:]
+
+
+def expand_histogram(value):
+    """Return a converted histogram in the dense format.
+
+    Histograms that are already dense are returned unchanged."""
+    if not is_sparse(value):
+        return value
+    dense = [0] * value[0]
+    counts = value[1]
+    for i in xrange(0, len(counts), 2):
+        dense[counts[i]] = counts[i + 1]
+    dense.extend(value[2:])
+    return dense
+
+
+def expand_histograms(histograms):
+    """Return a copy of a converted "histograms" section with every histogram
+    in the dense format."""
+    return dict((name, expand_histogram(value)) for name, value in histograms.iteritems())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Pull a few top-level fields out of a JSON object without decoding the
+# whole document. Nested values we aren't interested in are skipped over by
+# matching brackets, using regular expressions to jump over strings, flat
+# arrays (such as converted histograms) and everything else in one go.
+
+import re
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+KEY = re.compile(r'[ \t\n\r]*"([^"\\]*(?:\\.[^"\\]*)*)"[ \t\n\r]*:[ \t\n\r]*')
+SEPARATOR = re.compile(r'[ \t\n\r]*([,}])')
+# A scalar value (string, number, true, false or null).
+SCALAR = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[-+0-9.eEtruefalsn]+')
+# Anything that doesn't change the nesting depth: strings, arrays without
+# any nested arrays, objects or strings, and runs of other characters.
+FILLER = re.compile(r'(?:"[^"\\]*(?:\\.[^"\\]*)*"|\[[^\[\]{}"]*\]|[^"{}\[\]]+)*')
+
+decoder = json.JSONDecoder()
+
+
+def skip_value(s, pos):
+    """Return the position just past the JSON value starting at pos."""
+    if s[pos] not in "{[":
+        m = SCALAR.match(s, pos)
+        if m is None:
+            raise ValueError("Invalid JSON value at {0}".format(pos))
+        return m.end()
+    depth = 0
+    while True:
+        pos = FILLER.match(s, pos).end()
+        if pos >= len(s) or s[pos] == '"':
+            raise ValueError("Unterminated JSON value")
+        if s[pos] in "{[":
+            depth += 1
+        else:
+            depth -= 1
+        pos += 1
+        if depth == 0:
+            return pos
+
+
+def scan_top_level(s, wanted):
+    """Scan the top-level object in the JSON string s.
+
+    Returns (keys, values) where keys is the set of all top-level keys and
+    values is a dict of the decoded values of the keys in `wanted`. Values of
+    other keys are skipped without being validated. Raises ValueError if the
+    top level isn't a well-formed object."""
+    keys = set()
+    values = {}
+    pos = WHITESPACE.match(s).end()
+    if s[pos:pos + 1] != "{":
+        raise ValueError("Expected a JSON object")
+    pos += 1
+    m = SEPARATOR.match(s, pos)
+    if m is not None and m.group(1) == "}":
+        pos = m.end()
+    else:
+        while True:
+            m = KEY.match(s, pos)
+            if m is None:
+                raise ValueError("Expected an object key at {0}".format(pos))
+            key = m.group(1)
+            if "\\" in key:
+                key = decoder.decode('"' + key + '"')
+            keys.add(key)
+            pos = m.end()
+            if key in wanted:
+                values[key], pos = decoder.raw_decode(s, pos)
+            else:
+                pos = skip_value(s, pos)
+            m = SEPARATOR.match(s, pos)
+            if m is None:
+                raise ValueError("Expected ',' or '}}' at {0}".format(pos))
+            pos = m.end()
+            if m.group(1) == "}":
+                break
+    if WHITESPACE.match(s, pos).end() != len(s):
+        raise ValueError("Extra data after the JSON object")
+    return keys, values
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# For compatibility with python 2.6
+try:
+    from collections import OrderedDict
+except ImportError:
+    from simplejson import OrderedDict
+
+
+class LRUCache(object):
+    """A size-bounded cache that evicts the least recently used entries.
+
+    The bound can be a number of entries, an estimated number of bytes (as
+    supplied by the caller for each entry), or both. Set either limit to
+    None to leave it unbounded. Hits, misses and evictions are counted so
+    they can be reported with the rest of the pipeline stats.
+
+    If on_evict is given, it is called with the key and value of each entry
+    that is evicted to stay within the limits, so that values holding
+    resources (such as open files) can release them."""
+
+    def __init__(self, max_entries=None, max_bytes=None, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        # key => [value, estimated size], oldest first.
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    # (key, value) pairs, oldest first. Doesn't count as using them.
+    def items(self):
+        return [(key, entry[0]) for key, entry in self._entries.iteritems()]
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+        # Re-insert to mark it as the most recently used.
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size=0):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._entries[key] = [value, size]
+        self.bytes += size
+        self.evict()
+
+    # Remove an entry without counting it as an eviction.
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self.bytes -= entry[1]
+        return entry[0]
+
+    # Account for an entry that has grown (or shrunk) since it was added,
+    # which also marks it as the most recently used. Returns False if there
+    # is no such entry (for example because it has been evicted).
+    def resize(self, key, delta):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._entries[key] = entry
+        entry[1] += delta
+        self.bytes += delta
+        self.evict()
+        return True
+
+    def evict(self):
+        # Always keep the most recently used entry, even if it is larger than
+        # max_bytes on its own.
+        while len(self._entries) > 1 and self.over_limit():
+            key, entry = self._entries.popitem(last=False)
+            self.bytes -= entry[1]
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key, entry[0])
+
+    def over_limit(self):
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            return True
+        return False
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def get_stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
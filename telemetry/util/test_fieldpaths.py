@@ -0,0 +1,43 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from telemetry.util.fieldpaths import FieldPlan
+
+class TestFieldPlan(unittest.TestCase):
+    rules = {
+        "cpucount": ["system", "cpu", "count"],
+        "memsize": ["system", "memoryMB"],
+        "OS": ["system", "os", "name"],
+        "locale": ["settings", "locale"],
+        "isTablet": ["system", "device", "isTablet"],
+    }
+
+    def test_copy(self):
+        src = {
+            "system": {
+                "cpu": {"count": 4},
+                "memoryMB": 2048,
+                "os": {"name": None},
+                "device": {"isTablet": False}
+            }
+        }
+        info = {}
+        FieldPlan(self.rules).copy(src, info)
+        # Missing and null fields are skipped, other falsy values are kept.
+        self.assertEqual(info, {"cpucount": 4, "memsize": 2048, "isTablet": False})
+
+    def test_suffix_and_existing_fields(self):
+        src = {"system": {"memoryMB": 2048}, "settings": {"locale": "en-US"}}
+        info = {"locale": "fr"}
+        FieldPlan(self.rules, "2").copy(src, info)
+        self.assertEqual(info, {"locale": "fr", "memsize2": 2048, "locale2": "en-US"})
+
+        info = {"locale": "fr"}
+        FieldPlan(self.rules).copy(src, info)
+        self.assertEqual(info, {"locale": "fr", "memsize": 2048,
+                                "environment.locale": "en-US"})
+
+if __name__ == "__main__":
+    unittest.main()
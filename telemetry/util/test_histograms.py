@@ -0,0 +1,36 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from telemetry.util.histograms import VERSION_SPARSE, VERSION_UNIFIED_SPARSE, \
+        is_sparse_ping, sparse_histogram, expand_histogram, expand_histograms
+
+class TestHistograms(unittest.TestCase):
+    def test_round_trip(self):
+        dense = [0, 0, 3, 0, 1, 0, 10, 1.5, 2.5, -1, -1]
+        sparse = sparse_histogram(dense)
+        self.assertEqual(sparse, [6, [2, 3, 4, 1], 10, 1.5, 2.5, -1, -1])
+        self.assertEqual(expand_histogram(sparse), dense)
+        # Dense histograms are left alone.
+        self.assertIs(expand_histogram(dense), dense)
+
+        empty = [0, 0, 0, -1, -1, -1, -1]
+        self.assertEqual(sparse_histogram(empty), [2, [], 0, -1, -1, -1, -1])
+        self.assertEqual(expand_histogram(sparse_histogram(empty)), empty)
+
+    def test_expand_histograms(self):
+        histograms = {"A": [1, 0, 1, -1, -1, -1, -1], "B": [2, [1, 7], 7, -1, -1, -1, -1]}
+        expanded = expand_histograms(histograms)
+        self.assertEqual(expanded["A"], histograms["A"])
+        self.assertEqual(expanded["B"], [0, 7, 7, -1, -1, -1, -1])
+
+    def test_is_sparse_ping(self):
+        self.assertTrue(is_sparse_ping({"ver": VERSION_SPARSE}))
+        self.assertTrue(is_sparse_ping({"version": VERSION_UNIFIED_SPARSE}))
+        self.assertTrue(is_sparse_ping({"ver": VERSION_UNIFIED_SPARSE}))
+        self.assertFalse(is_sparse_ping({"ver": 2}))
+        self.assertFalse(is_sparse_ping({"version": 5}))
+
+if __name__ == "__main__":
+    unittest.main()
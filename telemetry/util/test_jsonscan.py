@@ -0,0 +1,25 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from telemetry.util.jsonscan import scan_top_level
+
+class TestJSONScan(unittest.TestCase):
+    def test_scan(self):
+        s = ' {"ver": 2, "info": {"a": [1, {"b": "}"}]}, "histograms": ' \
+            '{"X": [0, 1, 2, {"c": "\\"]"}], "Y": []}, "s\\u0074r": "[{",' \
+            ' "n": null, "t": true} \n'
+        keys, values = scan_top_level(s, frozenset(("ver", "info", "missing")))
+        self.assertEqual(keys, set(["ver", "info", "histograms", "str", "n", "t"]))
+        self.assertEqual(values, {"ver": 2, "info": {"a": [1, {"b": "}"}]}})
+
+        self.assertEqual(scan_top_level('{}', ["ver"]), (set(), {}))
+
+    def test_malformed(self):
+        for s in ['', '[]', '{"a": 1', '{"a": [1, 2}', '{"a": 1}}',
+                  '{"a": 1} x', '{"a" 1}', '{a: 1}', '{"a": {"b": "}']:
+            self.assertRaises(ValueError, scan_top_level, s, ["a"])
+
+if __name__ == "__main__":
+    unittest.main()
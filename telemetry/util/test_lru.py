@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from telemetry.util.lru import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def test_max_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        # Touch "a" so that "b" is the least recently used.
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertIs(cache.get("b"), None)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["entries"], 2)
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_bytes=100)
+        cache.put("a", "x", 40)
+        cache.put("b", "y", 40)
+        self.assertEqual(cache.bytes, 80)
+        self.assertTrue(cache.resize("a", 30))
+        # "a" is now 70 bytes, so the total is over the limit. Resizing "a"
+        # used it, so "b" is the oldest entry and goes.
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.bytes, 70)
+        self.assertFalse(cache.resize("b", 10))
+        self.assertEqual(cache.bytes, 70)
+
+        # A single oversized entry is kept.
+        cache.put("c", "z", 500)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("c"), "z")
+        self.assertEqual(cache.get_stats()["evictions"], 2)
+
+    def test_replace(self):
+        cache = LRUCache()
+        cache.put("a", 1, 10)
+        cache.put("a", 2, 20)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.bytes, 20)
+        self.assertEqual(cache.get("a"), 2)
+        self.assertEqual(cache.get("missing", "default"), "default")
+        cache.put("b", 3)
+        self.assertEqual(cache.items(), [("a", 2), ("b", 3)])
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_on_evict(self):
+        evicted = []
+        cache = LRUCache(max_entries=1, on_evict=lambda k, v: evicted.append((k, v)))
+        cache.put("a", 1, 10)
+        cache.put("b", 2, 20)
+        self.assertEqual(evicted, [("a", 1)])
+        # Popped entries aren't evictions.
+        self.assertEqual(cache.pop("b"), 2)
+        self.assertIs(cache.pop("b"), None)
+        self.assertEqual(cache.bytes, 0)
+        self.assertEqual(evicted, [("a", 1)])
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+if __name__ == "__main__":
+    unittest.main()